@@ -0,0 +1,128 @@
+"""
+Calculates summary statistics for many users' databases at once, without needing Kivy.
+
+Usage:
+    python analytics.py summary.db databases/*.db [--processes N]
+
+The databases are shared between a pool of processes and each row of the summary is one substance
+tracked by one user: the database, substance, last week's cost, current level, goal, goal streak and
+when the level will be down to the goal. The databases are only read, so ones that haven't been
+upgraded to the latest version by the app are skipped.
+"""
+import argparse
+from dataclasses import dataclass, astuple, fields
+import multiprocessing
+import sqlite3
+import time
+from typing import Iterable, List, Optional
+
+from calculations import (
+    calculate_current_level, calculate_goal_streak_days, calculate_under_goal_time, calculate_weekly_costs
+)
+from repository import SqlRepository
+
+
+@dataclass
+class SubstanceSummary:
+    """
+    Properties:
+        database, substance, last_week_cost (in pounds), current_level, goal (None if the goal is for a
+        different substance), goal_streak (in days), under_goal_time (when the level will be at or below
+        the goal if the substance isn't used again)
+    """
+    database: str
+    substance: str
+    last_week_cost: float
+    current_level: float
+    goal: Optional[int]
+    goal_streak: Optional[int]
+    under_goal_time: Optional[float]
+
+
+def summarise_database(filepath: str, current_time: int = None) -> List[SubstanceSummary]:
+    """
+    Calculates the summary of every substance tracked in a database. The database is opened read-only,
+    and skipped if it doesn't exist or isn't at the latest version, as upgrading it would change it.
+    """
+    if current_time is None:
+        current_time = int(time.time())
+    summaries = []
+    repository = SqlRepository(filepath, read_only=True)
+    try:
+        if not repository.start():
+            print(f"Skipped '{filepath}'")
+            return summaries
+        person = repository.get_person(1)
+        if not person:
+            return summaries
+        goal = repository.get_goal(1)  # Currently, only one goal is used
+        for substance, tracking in repository.get_substances_and_tracking(person.id):
+            weekly_costs = calculate_weekly_costs(tracking.id, current_time)
+            has_goal = goal is not None and goal.substance_tracking_id == tracking.id
+            summaries.append(SubstanceSummary(
+                filepath,
+                substance.name,
+                weekly_costs[-1][1] if len(weekly_costs) else 0,
+                calculate_current_level(tracking.id, current_time),
+                goal.value if has_goal else None,
+                calculate_goal_streak_days(goal, current_time) if has_goal else None,
+                calculate_under_goal_time(goal, current_time) if has_goal else None
+            ))
+    finally:
+        repository.close()
+    return summaries
+
+
+def write_summaries(connection, summaries: Iterable[SubstanceSummary]):
+    connection.executemany(
+        f"INSERT INTO SubstanceSummary VALUES ({', '.join('?' * len(fields(SubstanceSummary)))});",
+        (astuple(summary) for summary in summaries)
+    )
+
+
+def run(output_filepath: str, database_filepaths: List[str], processes: int = None, chunk_size: int = 16) -> int:
+    """
+    Summarises each database in a pool of processes, writing the results to a SubstanceSummary table
+    in the output database as they arrive.
+
+    :return: the number of summary rows written
+    """
+    current_time = int(time.time())
+    connection = sqlite3.connect(output_filepath)
+    connection.execute("DROP TABLE IF EXISTS SubstanceSummary;")
+    connection.execute("""
+        CREATE TABLE SubstanceSummary (
+            database TEXT,
+            substance TEXT,
+            last_week_cost REAL,
+            current_level REAL,
+            goal INTEGER,
+            goal_streak INTEGER,
+            under_goal_time REAL
+        );
+    """)
+    count = 0
+    with multiprocessing.Pool(processes) as pool:
+        arguments = ((filepath, current_time) for filepath in database_filepaths)
+        for summaries in pool.imap_unordered(summarise_database_arguments, arguments, chunk_size):
+            write_summaries(connection, summaries)
+            count += len(summaries)
+    connection.commit()
+    connection.close()
+    return count
+
+
+def summarise_database_arguments(arguments) -> List[SubstanceSummary]:
+    return summarise_database(*arguments)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("output", help="database to write the SubstanceSummary table to")
+    parser.add_argument("databases", nargs="+", help="user databases to summarise")
+    parser.add_argument("--processes", type=int, default=None, help="number of processes (default: CPU count)")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    rows = run(args.output, args.databases, args.processes)
+    print(f"Summarised {len(args.databases)} databases ({rows} rows) in {time.perf_counter() - start:.1f} s")
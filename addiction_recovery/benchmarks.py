@@ -0,0 +1,589 @@
+"""
+Benchmarks for the parts of the app that get slower as more substance uses are logged.
+
+Usage:
+    python benchmarks.py [benchmark ...] [--size N]
+
+Runs every benchmark if none are named. --size overrides the size each benchmark runs at, e.g. the
+number of uses or databases.
+"""
+import argparse
+from concurrent.futures import Future, ThreadPoolExecutor
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import time
+from typing import Callable, Dict
+
+from analytics import run as run_analytics
+from calculations import (
+    calculate_bucket_series, calculate_cost_series, calculate_current_level, calculate_goal_streak_days,
+    calculate_graph, calculate_level_series, calculate_under_goal_time, calculate_weekly_costs, fetch_graph_inputs,
+    get_half_life
+)
+from entities import *
+from eventlog import EventLogRepository
+from exporter import export_history
+from importer import import_file
+import migrations
+from repository import MemoryRepository, SqlRepository, DAY_BUCKET
+from pharmacokinetics import MODELS
+from snapshot import load_snapshot, save_snapshot, take_snapshot
+
+BENCHMARKS: Dict[str, Callable] = {}
+
+
+def benchmark(function: Callable) -> Callable:
+    """ Registers a function as a benchmark that can be run from the command line. """
+    BENCHMARKS[function.__name__] = function
+    return function
+
+
+def time_function(function: Callable, repeat: int = 5) -> float:
+    """
+    Times a function, returning the fastest of several runs.
+
+    :return: the time taken in milliseconds
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def populate_repository(repository, uses: int, amounts: int = 50, trackings: int = 3, seed: int = 0):
+    """
+    Fills a repository with random uses spread over the last year, logged in time order.
+
+    :return: the ids of the substance trackings that were created
+    """
+    rng = random.Random(seed)
+    person_id = repository.create_person(Person("benchmark", 70, 170, 0))
+    tracking_ids = []
+    for i in range(trackings):
+        substance_id = repository.create_substance(Substance(f"Substance {i}", 240))
+        tracking_ids.append(repository.create_substance_tracking(SubstanceTracking(person_id, substance_id)))
+
+    amount_ids = []
+    for i in range(amounts):
+        tracking_id = rng.choice(tracking_ids)
+        amount = SubstanceAmount(rng.randrange(1, 20), rng.randrange(50, 500), f"amount {i}")
+        amount_ids.append((tracking_id, repository.get_or_create_amount(amount, tracking_id)))
+    now = int(time.time())
+    year = 365 * 24 * 60 * 60
+    # Uses are logged in time order, as they are in the app
+    for use_time in sorted(now - rng.randrange(year) for _ in range(uses)):
+        tracking_id, amount_id = rng.choice(amount_ids)
+        repository.create_substance_use(SubstanceUse(tracking_id, amount_id, use_time))
+    return tracking_ids
+
+
+def report(name: str, milliseconds: float):
+    print(f"  {name:<40} {milliseconds:10.3f} ms")
+
+
+@benchmark
+def preset_ranking(uses: int = 100_000):
+    """ Compares counting uses on every query with reading the maintained usage counters. """
+    print(f"preset_ranking ({uses:,} uses)")
+    with SqlRepository(":memory:") as repository:
+        populate_repository(repository, uses)
+
+        def group_by():
+            repository.try_execute_query(
+                """
+                SELECT SubstanceAmount.*
+                FROM SubstanceAmount, (
+                    SELECT SubstanceUse.amount_id, COUNT(*) AS uses
+                    FROM SubstanceUse
+                    GROUP BY SubstanceUse.amount_id
+                    ORDER BY uses DESC
+                    LIMIT ?
+                ) AS CommonAmounts
+                WHERE CommonAmounts.amount_id = SubstanceAmount.id
+                ORDER BY CommonAmounts.uses DESC;
+                """,
+                (4,)
+            )
+
+        report("GROUP BY over SubstanceUse", time_function(group_by))
+        report("get_common_substance_amounts", time_function(lambda: repository.get_common_substance_amounts(4)))
+        report("get_recent_substance_amounts", time_function(lambda: repository.get_recent_substance_amounts(4)))
+        report("create_substance_use", time_function(
+            lambda: repository.create_substance_use(SubstanceUse(1, 1, int(time.time()))), repeat=100
+        ))
+
+
+@benchmark
+def bulk_import(rows: int = 1_000_000):
+    """ Imports a CSV file of uses into a new database. """
+    print(f"bulk_import ({rows:,} rows)")
+    rng = random.Random(0)
+    now = int(time.time())
+    with tempfile.TemporaryDirectory() as directory:
+        csv_filepath = os.path.join(directory, "history.csv")
+        with open(csv_filepath, "w") as file:
+            file.write("substance,time,amount,cost,name\n")
+            for _ in range(rows):
+                size = rng.randrange(3)
+                file.write(f"Coffee,{now - rng.randrange(10 ** 8)},{size + 1},{size + 1.5},size {size}\n")
+
+        with SqlRepository(os.path.join(directory, "database.db")) as repository:
+            person_id = repository.create_person(Person("benchmark", 70, 170, 0))
+            substance_id = repository.create_substance(Substance("Coffee", 480))
+            repository.create_substance_tracking(SubstanceTracking(person_id, substance_id))
+
+            start = time.perf_counter()
+            result = import_file(repository, csv_filepath, person_id)
+            report(f"import_file ({result.imported:,} imported)", (time.perf_counter() - start) * 1000)
+
+
+@benchmark
+def history_export(uses: int = 1_000_000):
+    """ Compares exporting the history in chunks with querying each tracking's whole history. """
+    print(f"history_export ({uses:,} uses)")
+    with tempfile.TemporaryDirectory() as directory, SqlRepository(":memory:") as repository:
+        tracking_ids = populate_repository(repository, 0)
+        amount_ids = [repository.get_or_create_amount(SubstanceAmount(i, i, str(i)), tracking_ids[0]) for i in range(10)]
+        repository.create_substance_uses(
+            SubstanceUse(tracking_ids[i % len(tracking_ids)], amount_ids[i % len(amount_ids)], i) for i in range(uses)
+        )
+        repository.rebuild_aggregates()
+
+        report("get_uses_from_time_period per tracking", time_function(
+            lambda: [repository.get_uses_from_time_period(-1, uses, tracking_id) for tracking_id in tracking_ids],
+            repeat=1
+        ))
+        filepath = os.path.join(directory, "uses.bin")
+        report("export_history", time_function(lambda: export_history(repository, filepath), repeat=1))
+        print(f"  {'exported file size':<40} {os.path.getsize(filepath) / 2 ** 20:10.3f} MiB")
+
+
+@benchmark
+def time_period_query(uses: int = 1_000_000):
+    """ Compares finding a week of uses with each repository implementation. """
+    print(f"time_period_query ({uses:,} uses)")
+    now = int(time.time())
+    with tempfile.TemporaryDirectory() as directory:
+        for name, repository in (
+                ("SqlRepository", SqlRepository(os.path.join(directory, "sql.db"))),
+                ("EventLogRepository", EventLogRepository(os.path.join(directory, "log.db"), directory)),
+                ("MemoryRepository", MemoryRepository())
+        ):
+            with repository:
+                tracking_ids = populate_repository(repository, 0, amounts=10)
+                repository.create_substance_uses(
+                    SubstanceUse(tracking_ids[i % len(tracking_ids)], 1 + i % 10, now - (uses - i) * 60)
+                    for i in range(uses)
+                )
+                week = 7 * 24 * 60 * 60
+                report(f"{name} last week", time_function(
+                    lambda: repository.get_uses_from_time_period(now - week, now, tracking_ids[0])
+                ))
+
+
+def create_legacy_database(filepath: str, uses: int, version: int, duplicated: float = 0.2, seed: int = 0):
+    """
+    Creates a database at an old schema version with uses spread over the last year. Like the app
+    before presets existed, a fraction of the uses have their own copy of an amount.
+    """
+    rng = random.Random(seed)
+    repository = SqlRepository(filepath)
+    repository.connect()
+    migrations.migrate(repository, target_version=version)
+    cursor = repository.cursor
+    cursor.execute("INSERT INTO Person(name, weight, height, dob) VALUES ('benchmark', 70, 170, 0);")
+    for i in range(3):
+        cursor.execute("INSERT INTO Substance(name, half_life) VALUES (?, 240);", (f"Substance {i}",))
+        cursor.execute("INSERT INTO SubstanceTracking(person_id, substance_id) VALUES (1, ?);", (i + 1,))
+    amounts = [(rng.randrange(1, 20) / 4, rng.randrange(50, 500), f"amount {i}") for i in range(50)]
+    cursor.executemany("INSERT INTO SubstanceAmount(amount, cost, name) VALUES (?, ?, ?);", amounts)
+
+    now = int(time.time())
+    year = 365 * 24 * 60 * 60
+    rows = []
+    for _ in range(uses):
+        amount_index = rng.randrange(len(amounts))
+        amount_id = amount_index + 1
+        if rng.random() < duplicated:
+            cursor.execute("INSERT INTO SubstanceAmount(amount, cost, name) VALUES (?, ?, ?);", amounts[amount_index])
+            amount_id = cursor.lastrowid
+        rows.append((1 + amount_index % 3, amount_id, now - rng.randrange(year)))
+    rows.sort(key=lambda row: row[2])
+    cursor.executemany("INSERT INTO SubstanceUse(substance_tracking_id, amount_id, time) VALUES (?, ?, ?);", rows)
+    # The aggregates as the app kept them at that version, which the current rebuild_aggregates can't fill
+    if version >= 2:
+        repository.fill_substance_presets()
+    if version >= 3:
+        repository.fill_substance_amount_usage()
+    repository.connection.commit()
+    repository.close()
+
+
+def copy_database(repository, filepath: str):
+    """ Copies a repository to a database file, e.g. after filling it in memory to save committing every use. """
+    connection = sqlite3.connect(filepath)
+    repository.connection.backup(connection)
+    # Like a database the app created, which would otherwise only be set when it's migrated
+    connection.execute("PRAGMA journal_mode = WAL;")
+    connection.close()
+
+
+def get_database_size(filepath: str) -> float:
+    """ Gets the size of a database in MiB after vacuuming it and checkpointing its write-ahead log. """
+    connection = sqlite3.connect(filepath)
+    connection.execute("VACUUM;")
+    connection.execute("PRAGMA wal_checkpoint(TRUNCATE);")
+    connection.close()
+    return os.path.getsize(filepath) / 2 ** 20
+
+
+def query_last_week(connection, now: int):
+    """ Runs the query behind SqlRepository.get_uses_from_time_period for the last week's uses. """
+    week = 7 * 24 * 60 * 60
+    return connection.execute(
+        """
+        SELECT SubstanceUse.*, SubstanceAmount.*
+        FROM SubstanceUse, SubstanceAmount
+        WHERE SubstanceUse.time > ?
+            AND SubstanceUse.time < ?
+            AND SubstanceUse.substance_tracking_id = ?
+            AND SubstanceAmount.id = SubstanceUse.amount_id
+        ORDER BY SubstanceUse.time ASC;
+        """,
+        (now - week, now, 1)
+    ).fetchall()
+
+
+@benchmark
+def long_range_graph(uses: int = 10_000):
+    """ Compares graphing a year of levels from every use with reading the daily use buckets. """
+    print(f"long_range_graph ({uses:,} uses)")
+    now = int(time.time())
+    year = 364 * 24 * 60 * 60
+    with SqlRepository(":memory:") as repository:
+        tracking_id = populate_repository(repository, uses, trackings=1)[0]
+
+        def from_uses():
+            use_amounts = repository.get_uses_from_time_period(now - year, now, tracking_id)
+            points = [((use.time - now + year) / 86400, amount.amount) for use, amount in use_amounts]
+            calculate_graph(points, tracking_id)
+
+        report("calculate_graph over the uses", time_function(from_uses, repeat=1))
+        report("calculate_bucket_series", time_function(
+            lambda: calculate_bucket_series(tracking_id, DAY_BUCKET, now - year, now, lambda b: b.peak_level)
+        ))
+
+
+@benchmark
+def graph_screen(uses: int = 100_000):
+    """
+    Compares updating the graph screen's week view one graph at a time on the main thread with fetching
+    once and calculating the graphs in a pool of workers, and with showing graphs that were prefetched.
+    """
+    print(f"graph_screen ({uses:,} uses)")
+    week = 7 * 24 * 60 * 60
+    with SqlRepository(":memory:") as repository, ThreadPoolExecutor(max_workers=3) as workers:
+        tracking_id = populate_repository(repository, uses, trackings=1)[0]
+        now = int(time.time())
+
+        def one_at_a_time():
+            for time_start in (now - week, now - 2 * week):
+                use_amounts = repository.get_uses_from_time_period(time_start, time_start + week, tracking_id)
+                points = [((use.time - time_start) / 86400, amount.amount) for use, amount in use_amounts]
+                calculate_graph(points, tracking_id)
+            calculate_weekly_costs(tracking_id, now)
+
+        def fetch():
+            return fetch_graph_inputs(tracking_id, now, week)
+
+        def fetch_and_calculate():
+            inputs = fetch()
+            futures = [
+                workers.submit(calculate_level_series, inputs),
+                workers.submit(calculate_level_series, inputs, True),
+                workers.submit(calculate_cost_series, inputs)
+            ]
+            for future in futures:
+                future.result()
+
+        report("one graph at a time", time_function(one_at_a_time))
+        report("fetch (on the main thread)", time_function(fetch))
+        report("fetch and calculate in the workers", time_function(fetch_and_calculate))
+
+        # The screen needs Kivy, which nothing else here does
+        from main import AddictionRecovery, GraphScreen
+
+        class ImmediateClock:
+            """ Calls back straight away instead of in the next frame. """
+
+            @staticmethod
+            def schedule_once(callback, timeout=0):
+                callback(0)
+                return None
+
+        class InlineExecutor:
+            """ Calculates on the calling thread, so the screen's cache is warm as soon as it's shown. """
+
+            @staticmethod
+            def submit(function, *args) -> Future:
+                future = Future()
+                future.set_result(function(*args))
+                return future
+
+        AddictionRecovery.substance_tracking_ids = {"Substance 0": tracking_id}
+        screen = GraphScreen(name="graph")
+        screen.clock = ImmediateClock()
+        screen.workers = InlineExecutor()
+        screen.select_substance(tracking_id)
+        # Not including drawing the points, as the screen has no graphs without its kv rules
+        report("switch to prefetched graphs", time_function(lambda: screen.select_substance(tracking_id)))
+
+
+@benchmark
+def pharmacokinetic_models(uses: int = 200):
+    """ Times sampling a week of levels every 5 minutes with each pharmacokinetic model, as the week graph does. """
+    print(f"pharmacokinetic_models ({uses:,} uses)")
+    rng = random.Random(0)
+    week = 7 * 24 * 60
+    doses = sorted((rng.uniform(0, week), rng.randrange(1, 5)) for _ in range(uses))
+    models = (("first_order", {}), ("bateman", {"absorption_half_life": 10}), ("widmark", {"elimination_rate": 1}))
+    for name, parameters in models:
+        model = MODELS[name](240, **parameters)
+        points = len(model.curve(doses, 5))
+        report(f"{name} curve ({points:,} points)", time_function(lambda: model.curve(doses, 5)))
+
+
+@benchmark
+def compaction(uses_per_year: int = 20_000):
+    """ Times reading the costs, goal streak and week graph after years of uses, before and after compaction. """
+    print(f"compaction ({uses_per_year:,} uses a year)")
+    rng = random.Random(0)
+    now = int(time.time())
+    year = 365 * 24 * 60 * 60
+    for years in (1, 2, 4, 8):
+        with tempfile.TemporaryDirectory() as directory:
+            filepath = os.path.join(directory, "database.db")
+            with SqlRepository(filepath) as repository:
+                person_id = repository.create_person(Person("benchmark", 70, 170, 0))
+                tracking_id = repository.create_substance_tracking(
+                    SubstanceTracking(person_id, repository.create_substance(Substance("Coffee", 240)))
+                )
+                amount_ids = [
+                    repository.get_or_create_amount(SubstanceAmount(i + 1, 100 * (i + 1), f"amount {i}"), tracking_id)
+                    for i in range(5)
+                ]
+                repository.create_substance_uses(
+                    SubstanceUse(tracking_id, rng.choice(amount_ids), now - rng.randrange(years * year))
+                    for _ in range(years * uses_per_year)
+                )
+                repository.rebuild_aggregates()
+                goal = Goal(tracking_id, 1, 5, now - years * year)
+
+                def read_screens():
+                    calculate_weekly_costs(tracking_id, now)
+                    calculate_goal_streak_days(goal, now)
+                    repository.get_uses_from_time_period(now - 7 * 24 * 60 * 60, now, tracking_id)
+
+                print(f"  {years} year(s)")
+                report("  reading every use", time_function(
+                    lambda: repository.get_uses_from_time_period(0, now, tracking_id)
+                ))
+                report("  costs, streak and week before", time_function(read_screens))
+                print(f"    {'size before':<38} {get_database_size(filepath):10.3f} MiB")
+                start = time.perf_counter()
+                repository.compact_uses(now - year)
+                report("  compact_uses", (time.perf_counter() - start) * 1000)
+                report("  costs, streak and week after", time_function(read_screens))
+            print(f"    {'size after':<38} {get_database_size(filepath):10.3f} MiB")
+
+
+@benchmark
+def cold_start(uses: int = 100_000):
+    """ Compares calculating the start-up statistics from the history with loading them from a snapshot. """
+    print(f"cold_start ({uses:,} uses)")
+    with tempfile.TemporaryDirectory() as directory:
+        filepath = os.path.join(directory, "database.db")
+        snapshot_filepath = os.path.join(directory, "database.db.snapshot.json")
+        with SqlRepository(":memory:") as repository:
+            tracking_ids = populate_repository(repository, uses)
+            repository.create_goal(Goal(tracking_ids[0], 1, 5, int(time.time())))
+            substance_tracking_ids = {
+                substance.name: tracking.id for substance, tracking in repository.get_substances_and_tracking(1)
+            }
+            copy_database(repository, filepath)
+        with SqlRepository(filepath):
+            save_snapshot(take_snapshot(1, substance_tracking_ids), snapshot_filepath)
+
+        def calculate():
+            with SqlRepository(filepath):
+                take_snapshot(1, substance_tracking_ids)
+
+        def load():
+            with SqlRepository(filepath) as r:
+                load_snapshot(snapshot_filepath, r.get_database_id(), r.get_data_version())
+
+        report("start and calculate", time_function(calculate))
+        report("start and load snapshot", time_function(load))
+
+
+@benchmark
+def goal_prediction(uses: int = 100_000):
+    """ Compares stepping the current level forward 5 minutes at a time with solving for the goal crossing. """
+    print(f"goal_prediction ({uses:,} uses)")
+    with SqlRepository(":memory:") as repository:
+        tracking_id = populate_repository(repository, uses, trackings=1)[0]
+        now = int(time.time())
+        goal = Goal(tracking_id, 1, 0.01, 0)
+
+        def step():
+            half_life = get_half_life(tracking_id) * 60
+            t = now
+            level = calculate_current_level(tracking_id, now)
+            while level > goal.value:
+                t += 5 * 60
+                level *= 0.5 ** (5 * 60 / half_life)
+            return t
+
+        report("stepping from the current level", time_function(step))
+        report("calculate_under_goal_time", time_function(lambda: calculate_under_goal_time(goal, now)))
+
+
+@benchmark
+def open_repository(uses: int = 100_000):
+    """ Times starting a repository on a database that's already up to date. """
+    print(f"open_repository ({uses:,} uses)")
+    with tempfile.TemporaryDirectory() as directory:
+        filepath = os.path.join(directory, "database.db")
+        with SqlRepository(":memory:") as repository:
+            populate_repository(repository, uses)
+            copy_database(repository, filepath)
+
+        def start_and_close():
+            repository = SqlRepository(filepath)
+            repository.start()
+            repository.close()
+
+        def start_and_query():
+            with SqlRepository(filepath) as repository:
+                repository.get_person(1)
+
+        report("start and close", time_function(start_and_close, repeat=100))
+        report("start, first query and close", time_function(start_and_query, repeat=100))
+
+
+@benchmark
+def pause_resume(uses: int = 100_000):
+    """ Compares closing and restarting the repository around a pause with keeping it open. """
+    print(f"pause_resume ({uses:,} uses)")
+    with tempfile.TemporaryDirectory() as directory:
+        filepath = os.path.join(directory, "database.db")
+        with SqlRepository(":memory:") as repository:
+            populate_repository(repository, uses)
+            copy_database(repository, filepath)
+
+        repository = SqlRepository(filepath)
+        repository.start()
+
+        def first_queries():
+            # What the menu and logging screens read first
+            repository.get_person(1)
+            repository.get_substances_and_tracking(1)
+            repository.get_common_substance_amounts(4)
+            repository.get_recent_substance_amounts(4)
+
+        def close_and_start():
+            repository.close()
+            repository.start()
+            first_queries()
+
+        def pause_and_resume():
+            repository.pause()
+            repository.resume()
+            first_queries()
+
+        report("close, start and first queries", time_function(close_and_start, repeat=20))
+        report("pause, resume and first queries", time_function(pause_and_resume, repeat=20))
+        repository.create_substance_use(SubstanceUse(1, 1, int(time.time())))
+        report("pause after a use (checkpoint)", time_function(repository.pause, repeat=1))
+        repository.close()
+
+
+@benchmark
+def migration(uses: int = 1_000_000):
+    """ Times upgrading a database from before the presets and usage counts were added. """
+    print(f"migration ({uses:,} uses)")
+    with tempfile.TemporaryDirectory() as directory:
+        filepath = os.path.join(directory, "database.db")
+        create_legacy_database(filepath, uses, 1)
+
+        repository = SqlRepository(filepath)
+        start = time.perf_counter()
+        repository.start()
+        report(f"start (upgrade to version {migrations.latest_version()})", (time.perf_counter() - start) * 1000)
+        repository.close()
+
+        def start_up_to_date():
+            with SqlRepository(filepath):
+                pass
+
+        report("start (up to date)", time_function(start_up_to_date))
+
+
+@benchmark
+def compact_storage(uses: int = 1_000_000):
+    """ Compares the database size and time period queries before and after the compact storage migration. """
+    print(f"compact_storage ({uses:,} uses)")
+    now = int(time.time())
+    with tempfile.TemporaryDirectory() as directory:
+        filepath = os.path.join(directory, "database.db")
+        create_legacy_database(filepath, uses, 3)
+        print(f"  {'size before':<40} {get_database_size(filepath):10.3f} MiB")
+        connection = sqlite3.connect(filepath)
+        report("last week query before", time_function(lambda: query_last_week(connection, now)))
+        connection.close()
+
+        start = time.perf_counter()
+        with SqlRepository(filepath) as repository:
+            report("upgrade", (time.perf_counter() - start) * 1000)
+            print(f"  {'size after':<40} {get_database_size(filepath):10.3f} MiB")
+            report("last week query after", time_function(lambda: query_last_week(repository.connection, now)))
+
+
+@benchmark
+def batch_analytics(databases: int = 1_000):
+    """ Compares summarising many users' databases in one process with a process per CPU. """
+    print(f"batch_analytics ({databases:,} databases, {os.cpu_count()} CPUs)")
+    with tempfile.TemporaryDirectory() as directory:
+        template_filepath = os.path.join(directory, "template.db")
+        with SqlRepository(template_filepath) as repository:
+            tracking_ids = populate_repository(repository, 500, amounts=10, trackings=2)
+            repository.create_goal(Goal(tracking_ids[0], 1, 5, int(time.time())))
+        filepaths = []
+        for i in range(databases):
+            filepaths.append(os.path.join(directory, f"database_{i}.db"))
+            shutil.copyfile(template_filepath, filepaths[-1])
+
+        output_filepath = os.path.join(directory, "summary.db")
+        for processes in sorted({1, os.cpu_count() or 1}):
+            report(f"{processes} process(es)", time_function(
+                lambda: run_analytics(output_filepath, filepaths, processes), repeat=1
+            ))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("benchmarks", nargs="*", help=f"benchmarks to run ({', '.join(BENCHMARKS)})")
+    parser.add_argument("--size", type=int, default=None, help="size to run the benchmarks at")
+    args = parser.parse_args()
+    for unknown in set(args.benchmarks) - set(BENCHMARKS):
+        parser.error(f"unknown benchmark '{unknown}'")
+    for name in args.benchmarks or BENCHMARKS:
+        if args.size is None:
+            BENCHMARKS[name]()
+        else:
+            BENCHMARKS[name](args.size)
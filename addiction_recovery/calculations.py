@@ -0,0 +1,289 @@
+"""
+Calculations on the substance use history that are shown on the screens. These don't depend on Kivy
+so they can also be run headlessly, e.g. by analytics.py.
+"""
+from dataclasses import dataclass, field
+import math
+import time
+from typing import Callable, List, Optional, Tuple
+
+import entities
+import instrumentation
+import pharmacokinetics
+from repository import Repository, LEVEL_HORIZON_HALF_LIVES, WEEK_BUCKET
+
+DAY_LENGTH = 24 * 60 * 60
+WEEK_LENGTH = 7 * DAY_LENGTH
+
+
+def get_half_life(tracking_id: int) -> float:
+    """ Gets the half-life (in minutes) of the substance being tracked. """
+    substance_id = Repository.instance.get_substance_tracking(tracking_id).substance_id
+    return Repository.instance.get_substance(substance_id).half_life
+
+
+def get_tracking_model(tracking_id: int) -> pharmacokinetics.PharmacokineticModel:
+    substance_id = Repository.instance.get_substance_tracking(tracking_id).substance_id
+    return pharmacokinetics.get_substance_model(Repository.instance.get_substance(substance_id))
+
+
+@instrumentation.timed()
+def calculate_graph(points, tracking_id):
+    """
+    Calculates the level of the substance every 5 minutes from (days, amount) use points, with the
+    substance's pharmacokinetic model.
+
+    :return: (days, level) points, leaving out those where there's almost none of the substance
+    """
+    return calculate_model_graph(points, get_tracking_model(tracking_id))
+
+
+def calculate_model_graph(points, model: pharmacokinetics.PharmacokineticModel) -> List[Tuple[float, float]]:
+    day = 24 * 60
+    curve = model.curve([(t * day, amount) for t, amount in points], 5)
+    return [(t / day, level) for t, level in curve]
+
+
+@instrumentation.timed()
+def calculate_weekly_costs(tracking_id, current_time: int = None) -> List[Tuple[float, float]]:
+    """
+    Calculates the total cost of each week from the weekly use buckets, so compacted uses are still
+    counted and the number of rows read doesn't depend on how many uses there were. The weeks are those
+    of the buckets, starting from the one with the first use.
+
+    :return: (days to the middle of the week, cost in pounds) points
+    """
+    if current_time is None:
+        current_time = int(time.time())
+    weeks = Repository.instance.get_use_buckets(tracking_id, WEEK_BUCKET, 0, current_time)
+    return get_weekly_costs(weeks, current_time)
+
+
+def get_weekly_costs(weeks: List[entities.UseBucket], current_time: int) -> List[Tuple[float, float]]:
+    if len(weeks):
+        # Find from what times the graph should show data from
+        start_time = weeks[0].start
+
+        # Calculate the total cost for each week
+        weekly_costs = [((t + WEEK_LENGTH / 2 - start_time) / DAY_LENGTH, 0)
+                        for t in range(start_time, current_time, WEEK_LENGTH)]
+        for week in weeks:
+            t, c = weekly_costs[(week.start - start_time) // WEEK_LENGTH]
+            weekly_costs[(week.start - start_time) // WEEK_LENGTH] = (t, c + week.cost / 100)
+        return weekly_costs
+    return []
+
+
+@instrumentation.timed()
+def calculate_goal_streak_start(goal: entities.Goal, current_time: int = None) -> Optional[float]:
+    """
+    Calculates when the level of the substance last decayed down to the goal, or when the goal was set
+    if it has never been above it. This is infinite if the goal can't be met, or None if the substance
+    hasn't been used.
+    """
+    if current_time is None:
+        current_time = int(time.time())
+    tracking_id = goal.substance_tracking_id
+    peak = Repository.instance.get_last_level_peak(tracking_id, goal.value)
+    if peak is None:
+        if not len(Repository.instance.get_use_buckets(tracking_id, WEEK_BUCKET, -2 ** 63, current_time)):
+            return None
+        return goal.time_set
+
+    peak_time, level = peak
+    return calculate_decay_time(peak_time, level, goal.value, get_half_life(tracking_id) * 60)
+
+
+def calculate_decay_time(start_time: float, level: float, target_level: float, half_life: float) -> float:
+    """
+    Calculates when a level will have decayed down to a target level if nothing more is used. Every use
+    of a substance decays with the same half-life (in seconds), so their sum does too, and the level is
+    down to the target log2(level / target) half-lives after start_time. This is infinite if the target
+    can't be reached.
+    """
+    if target_level <= 0:
+        return math.inf
+    if half_life <= 0 or level <= target_level:
+        return start_time
+    return start_time + half_life * math.log2(level / target_level)
+
+
+@instrumentation.timed()
+def calculate_under_goal_time(goal: entities.Goal, current_time: int = None) -> float:
+    """
+    Predicts when the level of the substance will be at or below the goal if it isn't used again, from
+    the last peak above the goal, so it takes the same time however many uses there have been. This is
+    the current time if the level is already at or below the goal.
+    """
+    if current_time is None:
+        current_time = int(time.time())
+    peak = Repository.instance.get_last_level_peak(goal.substance_tracking_id, goal.value)
+    if peak is None:
+        return current_time
+    peak_time, level = peak
+    half_life = get_half_life(goal.substance_tracking_id) * 60
+    return max(current_time, calculate_decay_time(peak_time, level, goal.value, half_life))
+
+
+def get_streak_days(streak_start: float, current_time: int) -> int:
+    return int(max(0, (current_time - streak_start) // DAY_LENGTH))
+
+
+def calculate_goal_streak_days(goal: entities.Goal, current_time: int = None) -> Optional[int]:
+    """
+    Calculates for how many whole days the level of the substance has been at or below the goal, or None
+    if the substance hasn't been used.
+    """
+    if current_time is None:
+        current_time = int(time.time())
+    streak_start = calculate_goal_streak_start(goal, current_time)
+    if streak_start is None:
+        return None
+    return get_streak_days(streak_start, current_time)
+
+
+def calculate_goal_streak(goal: entities.Goal) -> Optional[str]:
+    return format_streak(calculate_goal_streak_days(goal))
+
+
+def format_streak(streak_length: Optional[int]) -> Optional[str]:
+    if streak_length is None:
+        return None
+    if streak_length == 1:
+        return str(streak_length) + " day"
+    else:
+        return str(streak_length) + " days"
+
+
+@instrumentation.timed()
+def calculate_current_level(tracking_id: int, current_time: int = None) -> float:
+    """ Calculates how much of the substance is currently in the user's system. """
+    if current_time is None:
+        current_time = int(time.time())
+    half_life = get_half_life(tracking_id) * 60
+    uses = Repository.instance.get_uses_from_time_period(
+        int(current_time - LEVEL_HORIZON_HALF_LIVES * half_life),
+        current_time + 1,
+        tracking_id
+    )
+    return sum(amount.amount * 0.5 ** ((current_time - use.time) / half_life) for use, amount in uses)
+
+
+@instrumentation.timed()
+def calculate_bucket_series(
+        tracking_id: int,
+        resolution: int,
+        time_start: int,
+        time_end: int,
+        value: Callable[[entities.UseBucket], float]
+) -> List[Tuple[float, float]]:
+    """
+    Calculates one point per bucket between two times from the use buckets, e.g. the peak level in
+    each hour, so the number of rows read doesn't depend on how many uses there were. Buckets without
+    any uses are 0.
+
+    :return: (days since time_start, value) points
+    """
+    buckets = Repository.instance.get_use_buckets(
+        tracking_id, resolution, time_start - time_start % resolution, time_end
+    )
+    return get_bucket_series(buckets, resolution, time_start, time_end, value)
+
+
+def get_bucket_series(
+        buckets: List[entities.UseBucket],
+        resolution: int,
+        time_start: int,
+        time_end: int,
+        value: Callable[[entities.UseBucket], float]
+) -> List[Tuple[float, float]]:
+    """ Gets the points of calculate_bucket_series from buckets, ignoring those outside of the times. """
+    time_start -= time_start % resolution
+    values = [0] * ((time_end - time_start + resolution - 1) // resolution)
+    for bucket in buckets:
+        if time_start <= bucket.start < time_end:
+            values[(bucket.start - time_start) // resolution] = value(bucket)
+    return [(i * resolution / DAY_LENGTH, v) for i, v in enumerate(values)]
+
+
+@dataclass
+class GraphInputs:
+    """
+    Everything the graphs of a substance need from the repository, so they can be calculated away from it.
+
+    Properties:
+        current_time, period (the length of the current and the previous period that are shown),
+        level_resolution (of the level buckets, or None to graph the levels from the uses),
+        cost_resolution (of the cost buckets, or None for the cost of every week), model (the
+        substance's pharmacokinetic model), uses ((time, amount) of the uses in both periods),
+        level_buckets (in both periods), cost_buckets
+    """
+    current_time: int
+    period: int
+    level_resolution: Optional[int]
+    cost_resolution: Optional[int]
+    model: pharmacokinetics.PharmacokineticModel
+    uses: List[Tuple[int, float]] = field(default_factory=list)
+    level_buckets: List[entities.UseBucket] = field(default_factory=list)
+    cost_buckets: List[entities.UseBucket] = field(default_factory=list)
+
+
+@instrumentation.timed()
+def fetch_graph_inputs(
+        tracking_id: int,
+        current_time: int,
+        period: int,
+        level_resolution: Optional[int] = None,
+        cost_resolution: Optional[int] = None
+) -> GraphInputs:
+    """
+    Reads what the level and cost graphs of a substance need with one query for each: the uses or level
+    buckets of both periods at once, and the cost buckets.
+    """
+    inputs = GraphInputs(current_time, period, level_resolution, cost_resolution, get_tracking_model(tracking_id))
+    time_start = current_time - 2 * period
+    if level_resolution is None:
+        inputs.uses = Repository.instance.get_use_amounts(tracking_id, time_start, current_time)
+    else:
+        inputs.level_buckets = Repository.instance.get_use_buckets(
+            tracking_id, level_resolution, time_start - time_start % level_resolution, current_time
+        )
+    if cost_resolution is None:
+        inputs.cost_buckets = Repository.instance.get_use_buckets(tracking_id, WEEK_BUCKET, 0, current_time)
+    else:
+        cost_start = current_time - period
+        inputs.cost_buckets = Repository.instance.get_use_buckets(
+            tracking_id, cost_resolution, cost_start - cost_start % cost_resolution, current_time
+        )
+    return inputs
+
+
+def calculate_level_series(inputs: GraphInputs, previous: bool = False) -> List[Tuple[float, float]]:
+    """
+    Calculates the level graph of the current or the previous period, without using the repository.
+
+    :return: (days since the start of the period, level) points
+    """
+    time_end = inputs.current_time - inputs.period if previous else inputs.current_time
+    time_start = time_end - inputs.period
+    if inputs.level_resolution is None:
+        points = [((t - time_start) / DAY_LENGTH, amount) for t, amount in inputs.uses if time_start < t < time_end]
+        return calculate_model_graph(points, inputs.model)
+    return get_bucket_series(
+        inputs.level_buckets, inputs.level_resolution, time_start, time_end, lambda bucket: bucket.peak_level
+    )
+
+
+def calculate_cost_series(inputs: GraphInputs) -> List[Tuple[float, float]]:
+    """
+    Calculates the cost of every week, or of each cost bucket in the current period, without using the
+    repository.
+
+    :return: (days, cost in pounds) points
+    """
+    if inputs.cost_resolution is None:
+        return get_weekly_costs(inputs.cost_buckets, inputs.current_time)
+    return get_bucket_series(
+        inputs.cost_buckets, inputs.cost_resolution, inputs.current_time - inputs.period, inputs.current_time,
+        lambda bucket: bucket.cost / 100
+    )
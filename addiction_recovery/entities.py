@@ -90,3 +90,19 @@ class GoalType:
     name: str
     description: str
     id: int = None
+
+
+@dataclass
+class UseBucket:
+    """
+    Properties:
+        substance_tracking_id, resolution (length in seconds), start (unix timestamp), uses, amount (total),
+        cost (total in pence), peak_level (the highest level of the substance straight after a use)
+    """
+    substance_tracking_id: int
+    resolution: int
+    start: int  # Unix timestamp
+    uses: int
+    amount: float
+    cost: int
+    peak_level: float
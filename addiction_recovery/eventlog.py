@@ -0,0 +1,368 @@
+from bisect import bisect_left, bisect_right
+import heapq
+import mmap
+import os
+import sqlite3
+import struct
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from entities import *
+from repository import SqlRepository, log_add_exp2, RECENCY_HALF_LIFE
+
+# Each file starts with a header of the magic bytes and the largest use id in the file, followed by
+# fixed-width (time, amount_id, id) records sorted by time
+MAGIC = b"ARUSES1\0"
+HEADER = struct.Struct("<8sq")
+RECORD = struct.Struct("<qqq")
+FIELDS = 3  # int64 values per record
+
+
+class UseLog:
+    """ A memory-mapped file of one substance tracking's uses, sorted by time. """
+
+    def __init__(self, filepath: str):
+        self.filepath = filepath
+        self.map = None
+        self.view = None
+        if not os.path.exists(filepath):
+            with open(filepath, "wb") as file:
+                file.write(HEADER.pack(MAGIC, 0))
+        with open(filepath, "rb") as file:
+            magic, self.max_id = HEADER.unpack(file.read(HEADER.size))
+        if magic != MAGIC:
+            raise ValueError(f"'{filepath}' is not a substance use log")
+
+    def records(self) -> memoryview:
+        """ Gets a read-only view of the records, mapping the file into memory if it isn't already. """
+        if self.view is None:
+            with open(self.filepath, "rb") as file:
+                self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.view = memoryview(self.map)[HEADER.size:]
+        return self.view
+
+    def close(self):
+        if self.view is not None:
+            self.view.release()
+            self.map.close()
+            self.view = None
+            self.map = None
+
+    def __len__(self):
+        return len(self.records()) // RECORD.size
+
+    def find(self, time_start: int, time_end: int) -> List[Tuple[int, int, int]]:
+        """ Gets the (time, amount_id, id) records with time_start < time < time_end using binary search. """
+        records = self.records()
+        with records.cast("q") as values, values[0::FIELDS] as times:
+            start = bisect_right(times, time_start)
+            end = max(start, bisect_left(times, time_end))
+        with records[start * RECORD.size:end * RECORD.size] as found:
+            return list(RECORD.iter_unpack(found))
+
+    def find_id(self, use_id: int) -> Optional[Tuple[int, int, int]]:
+        if use_id > self.max_id:
+            return None
+        records = self.records()
+        with records.cast("q") as values, values[2::FIELDS] as ids:
+            try:
+                index = ids.tolist().index(use_id)
+            except ValueError:
+                return None
+        return RECORD.unpack_from(records, index * RECORD.size)
+
+    def insert(self, records: Iterable[Tuple[int, int, int]]):
+        """ Adds (time, amount_id, id) records, keeping the file sorted by time. """
+        records = sorted(records, key=lambda record: record[0])
+        if not len(records):
+            return
+        last_time = None
+        if len(self):
+            last_time = RECORD.unpack_from(self.records(), len(self.records()) - RECORD.size)[0]
+        self.close()
+        self.max_id = max(self.max_id, max(record[2] for record in records))
+
+        with open(self.filepath, "r+b") as file:
+            if last_time is None or records[0][0] >= last_time:
+                # Uses are nearly always logged in order so they can just be appended
+                file.seek(0, os.SEEK_END)
+            else:
+                # Merge the new records with the ones they are older than, keeping existing records first
+                file.seek(HEADER.size)
+                data = file.read()
+                existing = list(RECORD.iter_unpack(data))
+                start = bisect_right([record[0] for record in existing], records[0][0])
+                records = list(heapq.merge(existing[start:], records, key=lambda record: record[0]))
+                file.seek(HEADER.size + start * RECORD.size)
+            file.write(b"".join(RECORD.pack(*record) for record in records))
+            file.seek(0)
+            file.write(HEADER.pack(MAGIC, self.max_id))
+
+    def count_before(self, time_end: int) -> int:
+        """ Counts the records with time < time_end. """
+        records = self.records()
+        with records.cast("q") as values, values[0::FIELDS] as times:
+            return bisect_left(times, time_end)
+
+    def remove_before(self, time_end: int) -> int:
+        """
+        Removes the records with time < time_end, returning how many were removed. The kept records are
+        written to a new file that replaces the log, so the log is never left half written.
+        """
+        end = self.count_before(time_end)
+        if end == 0:
+            return 0
+        temporary_filepath = f"{self.filepath}.tmp"
+        with open(temporary_filepath, "wb") as file:
+            file.write(HEADER.pack(MAGIC, self.max_id))
+            file.write(self.records()[end * RECORD.size:])
+            file.flush()
+            os.fsync(file.fileno())
+        self.close()
+        os.replace(temporary_filepath, self.filepath)
+        return end
+
+
+class EventLogRepository(SqlRepository):
+    """
+    A repository that stores substance uses in an append-only log file for each substance tracking
+    instead of in the database. The log files are sorted by time, so the uses in a time period are
+    found with a binary search and read straight from the memory-mapped file. Everything else,
+    including the presets and usage counts derived from the uses, is kept in the database.
+
+    Finding a single use by its id has to search every log, as uses are only indexed by time.
+    """
+
+    def __init__(self, filepath="database.db", log_directory="uses"):
+        super().__init__(filepath)
+        self.log_directory = log_directory
+        self.logs: Dict[int, UseLog] = {}
+        self.amounts: Dict[int, SubstanceAmount] = {}
+        self.next_use_id = 1
+
+    def start(self) -> bool:
+        if not super().start():
+            return False
+        try:
+            os.makedirs(self.log_directory, exist_ok=True)
+            compacted_before = self.get_compacted_before()
+            for tracking_id in self.get_logged_tracking_ids():
+                log = self.get_log(tracking_id)
+                self.next_use_id = max(self.next_use_id, log.max_id + 1)
+                # Finish any compaction that was committed without its log being rewritten
+                if tracking_id in compacted_before:
+                    log.remove_before(compacted_before[tracking_id])
+        except (sqlite3.Error, OSError, ValueError) as e:
+            print(f"Error in opening substance use logs: {e.args}")
+            return False
+        return True
+
+    def close(self):
+        for log in self.logs.values():
+            log.close()
+        self.logs = {}
+        self.amounts = {}
+        super().close()
+
+    def pause(self):
+        # The logs are written straight to their files, so unmapping them just frees the memory
+        for log in self.logs.values():
+            log.close()
+        super().pause()
+
+    def reset(self):
+        for tracking_id in self.get_logged_tracking_ids():
+            self.get_log(tracking_id).close()
+            os.remove(self.get_log_filepath(tracking_id))
+        self.logs = {}
+        self.amounts = {}
+        self.next_use_id = 1
+        super().reset()
+
+    def get_log_filepath(self, tracking_id: int) -> str:
+        return os.path.join(self.log_directory, f"uses_{tracking_id}.log")
+
+    def get_logged_tracking_ids(self) -> List[int]:
+        try:
+            filenames = os.listdir(self.log_directory)
+        except OSError:
+            return []
+        return sorted(
+            int(filename[5:-4]) for filename in filenames
+            if filename.startswith("uses_") and filename.endswith(".log") and filename[5:-4].isdigit()
+        )
+
+    def get_log(self, tracking_id: int) -> UseLog:
+        log = self.logs.get(tracking_id)
+        if log is None:
+            log = self.logs[tracking_id] = UseLog(self.get_log_filepath(tracking_id))
+        return log
+
+    def get_cached_amount(self, amount_id: int) -> Optional[SubstanceAmount]:
+        amount = self.amounts.get(amount_id)
+        if amount is None:
+            amount = self.amounts[amount_id] = self.get_substance_amount(amount_id)
+        return amount
+
+    """ Create entities """
+
+    def create_substance_use(self, use: SubstanceUse) -> int:
+        use_id = self.next_use_id
+        self.next_use_id += 1
+        self.get_log(use.substance_tracking_id).insert([(use.time, use.amount_id, use_id)])
+        try:
+            self.cursor.execute("BEGIN IMMEDIATE;")
+            bucket_commands = self.get_use_bucket_commands(use)
+            for command, parameters in self.substance_use_aggregate_commands(use) + (bucket_commands or []):
+                self.execute_command(command, parameters)
+            if bucket_commands is None:
+                # The use is older than the tracking's latest use, so the levels after it have changed
+                self.fill_use_buckets(use.substance_tracking_id, use.time)
+            self.connection.commit()
+        except sqlite3.Error as e:
+            # The use is in the log, so rebuild_aggregates() can still count it
+            self.connection.rollback()
+            print(f"\033[91m Error in adding substance use to aggregates : {e.args} \033[0m")
+        return use_id
+
+    def create_substance_uses(self, uses: Iterable[SubstanceUse]) -> int:
+        records: Dict[int, List[Tuple[int, int, int]]] = {}
+        for use in uses:
+            records.setdefault(use.substance_tracking_id, []).append((use.time, use.amount_id, self.next_use_id))
+            self.next_use_id += 1
+        for tracking_id, tracking_records in records.items():
+            self.get_log(tracking_id).insert(tracking_records)
+        return sum(len(tracking_records) for tracking_records in records.values())
+
+    def get_compacted_before(self) -> Dict[int, int]:
+        """ Gets the compaction horizon of each substance tracking that has been compacted. """
+        return dict(self.cursor.execute("SELECT substance_tracking_id, before_time FROM SubstanceCompaction;"))
+
+    def rebuild_aggregates(self):
+        presets = []
+        usage = []
+        # Records before the horizon are already counted in the compacted aggregates, and are only still
+        # in a log if it wasn't rewritten after the compaction was committed
+        compacted_before = self.get_compacted_before()
+        for tracking_id in self.get_logged_tracking_ids():
+            counts: Dict[int, List] = {}
+            time_start = compacted_before[tracking_id] - 1 if tracking_id in compacted_before else -2 ** 63
+            for use_time, amount_id, _ in self.get_log(tracking_id).find(time_start, 2 ** 63 - 1):
+                count = counts.get(amount_id)
+                if count is None:
+                    count = counts[amount_id] = [0, use_time, None]
+                    presets.append((tracking_id, amount_id))
+                count[0] += 1
+                count[1] = max(count[1], use_time)
+                count[2] = log_add_exp2(count[2], use_time / RECENCY_HALF_LIFE)
+            usage.extend((amount_id, tracking_id, *count) for amount_id, count in counts.items())
+
+        try:
+            self.cursor.execute("DELETE FROM SubstancePreset;")
+            self.cursor.execute("DELETE FROM SubstanceAmountUsage;")
+            self.fill_compacted_aggregates()
+            self.cursor.executemany(
+                """
+                INSERT OR IGNORE INTO SubstancePreset(substance_tracking_id, amount_id, amount, cost, name)
+                SELECT ?, id, amount, cost, name
+                FROM SubstanceAmount
+                WHERE id = ?;
+                """,
+                presets
+            )
+            self.cursor.executemany(
+                """
+                INSERT INTO SubstanceAmountUsage(amount_id, substance_tracking_id, uses, last_used, recency)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(amount_id) DO UPDATE SET
+                    uses = uses + excluded.uses,
+                    last_used = MAX(last_used, excluded.last_used),
+                    recency = log_add_exp2(recency, excluded.recency);
+                """,
+                usage
+            )
+            self.fill_all_use_buckets()
+            self.connection.commit()
+        except sqlite3.Error as e:
+            self.connection.rollback()
+            print(f"\033[91m Error in rebuilding aggregates : {e.args} \033[0m")
+
+    def delete_uses_before(self, tracking_id: int, before_time: int) -> int:
+        # The log files aren't part of the database's transaction, so the uses are only counted until
+        # it's committed, then removed by remove_compacted_uses
+        if not os.path.exists(self.get_log_filepath(tracking_id)):
+            return 0
+        return self.get_log(tracking_id).count_before(before_time)
+
+    def remove_compacted_uses(self, tracking_ids: List[int], before_time: int):
+        for tracking_id in tracking_ids:
+            if os.path.exists(self.get_log_filepath(tracking_id)):
+                try:
+                    self.get_log(tracking_id).remove_before(before_time)
+                except OSError as e:
+                    # The aggregates ignore the uses left in the log, which are removed when the repository next starts
+                    print(f"\033[91m Error in removing compacted uses : {e.args} \033[0m")
+
+    """ Retrieve data """
+
+    def get_substance_use(self, use_id: int) -> Optional[SubstanceUse]:
+        for tracking_id in self.get_logged_tracking_ids():
+            record = self.get_log(tracking_id).find_id(use_id)
+            if record:
+                use_time, amount_id, _ = record
+                return SubstanceUse(tracking_id, amount_id, use_time, use_id)
+        return None
+
+    def get_use_history(self, chunk_size: int) -> Iterator[List[Tuple]]:
+        rows = []
+        for tracking_id in self.get_logged_tracking_ids():
+            tracking = self.get_substance_tracking(tracking_id)
+            substance = self.get_substance(tracking.substance_id) if tracking else None
+            for use_time, amount_id, use_id in self.get_log(tracking_id).find(-2 ** 63, 2 ** 63 - 1):
+                amount = self.get_cached_amount(amount_id)
+                rows.append((
+                    use_id, use_time, tracking_id,
+                    tracking.person_id if tracking else None,
+                    substance.name if substance else None,
+                    amount_id,
+                    amount.amount if amount else None,
+                    amount.cost if amount else None,
+                    amount.name if amount else None
+                ))
+                if len(rows) == chunk_size:
+                    yield rows
+                    rows = []
+        if len(rows):
+            yield rows
+
+    def get_use_amount_rows(self, tracking_id: int, time_start: int) -> Iterator[Tuple[int, float, int]]:
+        if not os.path.exists(self.get_log_filepath(tracking_id)):
+            return
+        for use_time, amount_id, _ in self.get_log(tracking_id).find(time_start - 1, 2 ** 63 - 1):
+            amount = self.get_cached_amount(amount_id)
+            if amount:
+                yield use_time, amount.amount, amount.cost
+
+    def get_uses_from_time_period(
+            self,
+            time_start: int,
+            time_end: int,
+            substance_tracking_id: int
+    ) -> List[Tuple[SubstanceUse, SubstanceAmount]]:
+        if not os.path.exists(self.get_log_filepath(substance_tracking_id)):
+            return []
+        uses = []
+        for use_time, amount_id, use_id in self.get_log(substance_tracking_id).find(time_start, time_end):
+            amount = self.get_cached_amount(amount_id)
+            if amount:
+                uses.append((SubstanceUse(substance_tracking_id, amount_id, use_time, use_id), amount))
+        return uses
+
+    def get_use_amounts(self, substance_tracking_id: int, time_start: int, time_end: int) -> List[Tuple[int, float]]:
+        if not os.path.exists(self.get_log_filepath(substance_tracking_id)):
+            return []
+        uses = []
+        for use_time, amount_id, _ in self.get_log(substance_tracking_id).find(time_start, time_end):
+            amount = self.get_cached_amount(amount_id)
+            if amount:
+                uses.append((use_time, amount.amount))
+        return uses
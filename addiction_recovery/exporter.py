@@ -0,0 +1,169 @@
+"""
+Exports the substance use history to a columnar file for offline analysis.
+
+Usage:
+    python exporter.py uses.parquet [--database database.db] [--chunk-size 65536]
+
+The format is chosen from the file extension: ".parquet" and ".arrow" need pyarrow to be installed,
+anything else is written in the simple column format read by read_columns(). The history is exported
+in fixed-size chunks so memory use doesn't depend on how many uses have been logged.
+"""
+import argparse
+from array import array
+import json
+import struct
+from typing import Dict, List
+
+from repository import Repository, SqlRepository, USE_HISTORY_COLUMNS
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+MAGIC = b"ARCOLS1\n"
+
+# Column types in the fallback format: "q" and "d" are array typecodes, "s" is a dictionary-encoded string
+COLUMN_TYPES = {
+    "use_id": "q",
+    "time": "q",
+    "substance_tracking_id": "q",
+    "person_id": "q",
+    "substance": "s",
+    "amount_id": "q",
+    "amount": "d",
+    "cost": "q",
+    "name": "s",
+}
+
+
+class ColumnWriter:
+    """
+    Writes chunks of rows to a file in a simple column format. Each chunk is a length-prefixed JSON
+    header followed by one typed array per column. Strings are stored as indexes into a dictionary,
+    and each chunk's header lists the strings that were added to the dictionary by that chunk.
+    """
+
+    def __init__(self, file):
+        self.file = file
+        self.dictionaries: Dict[str, Dict[str, int]] = {
+            column: {} for column, typ in COLUMN_TYPES.items() if typ == "s"
+        }
+        self.file.write(MAGIC)
+
+    def write_chunk(self, rows: List[tuple]):
+        header = {"rows": len(rows), "columns": []}
+        buffers = []
+        for i, column in enumerate(USE_HISTORY_COLUMNS):
+            typ = COLUMN_TYPES[column]
+            if typ == "s":
+                dictionary = self.dictionaries[column]
+                additions = []
+                values = array("q")
+                for row in rows:
+                    value = row[i] if row[i] is not None else ""
+                    code = dictionary.get(value)
+                    if code is None:
+                        code = dictionary[value] = len(dictionary)
+                        additions.append(value)
+                    values.append(code)
+                header["columns"].append({"name": column, "type": "s", "additions": additions})
+            else:
+                values = array(typ, (row[i] if row[i] is not None else 0 for row in rows))
+                header["columns"].append({"name": column, "type": typ})
+            buffers.append(values.tobytes())
+
+        for column, buffer in zip(header["columns"], buffers):
+            column["bytes"] = len(buffer)
+        encoded_header = json.dumps(header).encode("utf-8")
+        self.file.write(struct.pack("<I", len(encoded_header)))
+        self.file.write(encoded_header)
+        for buffer in buffers:
+            self.file.write(buffer)
+
+
+def read_columns(filepath: str) -> Dict[str, list]:
+    """ Reads a whole file written by ColumnWriter into a list of values for each column. """
+    columns = {column: [] for column in USE_HISTORY_COLUMNS}
+    dictionaries = {column: [] for column, typ in COLUMN_TYPES.items() if typ == "s"}
+    with open(filepath, "rb") as file:
+        if file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"'{filepath}' is not a column file")
+        while length_bytes := file.read(4):
+            header = json.loads(file.read(struct.unpack("<I", length_bytes)[0]))
+            for column in header["columns"]:
+                buffer = file.read(column["bytes"])
+                if column["type"] == "s":
+                    dictionary = dictionaries[column["name"]]
+                    dictionary.extend(column["additions"])
+                    codes = array("q")
+                    codes.frombytes(buffer)
+                    columns[column["name"]].extend(dictionary[code] for code in codes)
+                else:
+                    values = array(column["type"])
+                    values.frombytes(buffer)
+                    columns[column["name"]].extend(values)
+    return columns
+
+
+def arrow_schema():
+    return pyarrow.schema([
+        (column, pyarrow.string() if typ == "s" else pyarrow.float64() if typ == "d" else pyarrow.int64())
+        for column, typ in COLUMN_TYPES.items()
+    ])
+
+
+def arrow_batch(rows: List[tuple], schema):
+    return pyarrow.RecordBatch.from_arrays(
+        [pyarrow.array([row[i] for row in rows], type=field.type) for i, field in enumerate(schema)],
+        schema=schema
+    )
+
+
+def export_history(repository: Repository, filepath: str, chunk_size=65536) -> int:
+    """
+    Exports every substance use to a file.
+
+    :return: the number of uses that were exported
+    """
+    count = 0
+    extension = filepath.lower().rsplit(".", 1)[-1]
+    if extension in ("parquet", "arrow"):
+        if pyarrow is None:
+            raise RuntimeError(f"pyarrow is needed to export to .{extension} files")
+        schema = arrow_schema()
+        if extension == "parquet":
+            writer = pyarrow.parquet.ParquetWriter(filepath, schema)
+            write = writer.write_table
+            convert = lambda rows: pyarrow.Table.from_batches([arrow_batch(rows, schema)])
+        else:
+            writer = pyarrow.ipc.new_file(filepath, schema)
+            write = writer.write_batch
+            convert = lambda rows: arrow_batch(rows, schema)
+        try:
+            for rows in repository.get_use_history(chunk_size):
+                write(convert(rows))
+                count += len(rows)
+        finally:
+            writer.close()
+    else:
+        with open(filepath, "wb") as file:
+            writer = ColumnWriter(file)
+            for rows in repository.get_use_history(chunk_size):
+                writer.write_chunk(rows)
+                count += len(rows)
+    return count
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("filepath", help="file to export to")
+    parser.add_argument("--database", default="database.db", help="database to export from")
+    parser.add_argument("--chunk-size", type=int, default=65536, help="number of uses read and written at a time")
+    args = parser.parse_args()
+
+    with SqlRepository(args.database) as r:
+        exported = export_history(r, args.filepath, args.chunk_size)
+    print(f"Exported {exported} uses to {args.filepath}")
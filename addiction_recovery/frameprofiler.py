@@ -0,0 +1,153 @@
+"""
+Measures how long each frame takes and which timed handlers (see instrumentation.timed) ran during
+the frames that went over budget, e.g. a screen's on_pre_enter recalculating its graphs.
+
+Set the ADDICTION_RECOVERY_FRAME_TRACE environment variable to a filepath to profile the app. The
+frames and handlers are written to that file when the app stops, in the Chrome trace event format
+(open it with chrome://tracing or https://ui.perfetto.dev). Also set ADDICTION_RECOVERY_FRAME_OVERLAY
+to show the frame times on screen.
+"""
+from collections import deque
+from dataclasses import dataclass, field
+import json
+import time
+from typing import Deque, List, Optional, Tuple
+
+import instrumentation
+
+FRAME_BUDGET = 1 / 60
+
+
+@dataclass
+class Frame:
+    """
+    Properties:
+        start, end (time.perf_counter() values), spans ((name, start, end) of the handlers that ran)
+    """
+    start: float
+    end: float
+    spans: List[Tuple[str, float, float]] = field(default_factory=list)
+
+    @property
+    def duration(self) -> float:
+        return self.end - self.start
+
+    def culprit(self) -> Optional[str]:
+        """
+        Gets the name of the handler that took the most time during the frame, not counting the time
+        of the handlers it called, so e.g. on_pre_enter isn't blamed for the graphs it updates.
+        """
+        if not len(self.spans):
+            return None
+        # Outer spans come before the spans nested in them
+        spans = sorted(self.spans, key=lambda span: (span[1], -span[2]))
+        self_times = [end - start for _, start, end in spans]
+        # The indices of the spans that enclose the current one, innermost last
+        enclosing: List[int] = []
+        for i, (_, start, end) in enumerate(spans):
+            while len(enclosing) and spans[enclosing[-1]][2] <= start:
+                enclosing.pop()
+            if len(enclosing):
+                self_times[enclosing[-1]] -= end - start
+            enclosing.append(i)
+        return spans[max(range(len(spans)), key=lambda i: self_times[i])][0]
+
+
+class FrameProfiler:
+    """
+    Records frames and the timed handlers that ran in them. Frames are recorded by calling
+    record_frame() once per frame, which start() arranges with the Kivy clock, so the profiler can
+    also be driven by a test or a headless script.
+    """
+
+    def __init__(self, budget=FRAME_BUDGET, history=10000):
+        self.budget = budget
+        self.frames: Deque[Frame] = deque(maxlen=history)
+        self.long_frames: Deque[Frame] = deque(maxlen=history)
+        self.pending_spans: List[Tuple[str, float, float]] = []
+        self.last_frame_time: Optional[float] = None
+        self.event = None
+
+    def start(self):
+        from kivy.clock import Clock
+
+        instrumentation.enable()
+        instrumentation.listeners.append(self.record_span)
+        self.event = Clock.schedule_interval(lambda dt: self.record_frame(), 0)
+
+    def stop(self):
+        if self.record_span in instrumentation.listeners:
+            instrumentation.listeners.remove(self.record_span)
+        if self.event:
+            self.event.cancel()
+            self.event = None
+
+    def record_span(self, name: str, start: float, end: float):
+        self.pending_spans.append((name, start, end))
+
+    def record_frame(self, now: float = None):
+        """ Marks the end of a frame, attributing the handlers that ran since the last frame to it. """
+        if now is None:
+            now = time.perf_counter()
+        if self.last_frame_time is not None:
+            frame = Frame(self.last_frame_time, now, self.pending_spans)
+            self.frames.append(frame)
+            if frame.duration > self.budget:
+                self.long_frames.append(frame)
+        self.pending_spans = []
+        self.last_frame_time = now
+
+    def format_report(self, count=20) -> str:
+        """ Summarises the slowest frames and the handler that caused each of them. """
+        if not len(self.frames):
+            return "No frames recorded"
+        durations = sorted(frame.duration for frame in self.frames)
+        lines = [
+            f"{len(self.frames)} frames, {len(self.long_frames)} over {self.budget * 1000:.1f} ms, "
+            f"median {durations[len(durations) // 2] * 1000:.1f} ms, max {durations[-1] * 1000:.1f} ms"
+        ]
+        for frame in sorted(self.long_frames, key=lambda f: -f.duration)[:count]:
+            lines.append(f"{frame.duration * 1000:>9.1f} ms  {frame.culprit() or 'unknown'}")
+        return "\n".join(lines)
+
+    def export_trace(self, filepath: str):
+        """ Writes the frames and handlers to a Chrome trace event file. """
+        events = []
+        for frame in self.frames:
+            events.append({
+                "name": "long frame" if frame.duration > self.budget else "frame",
+                "ph": "X", "pid": 0, "tid": 0,
+                "ts": frame.start * 1_000_000, "dur": frame.duration * 1_000_000
+            })
+            for name, start, end in frame.spans:
+                events.append({
+                    "name": name, "ph": "X", "pid": 0, "tid": 1,
+                    "ts": start * 1_000_000, "dur": (end - start) * 1_000_000
+                })
+        try:
+            with open(filepath, "w") as file:
+                json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, file)
+        except OSError as e:
+            print(f"\033[91m Error in writing frame trace to '{filepath}' : {e.args} \033[0m")
+
+
+def show_overlay(profiler: FrameProfiler):
+    """ Shows the last frame time and the cause of the last long frame in the corner of the window. """
+    from kivy.clock import Clock
+    from kivy.core.window import Window
+    from kivy.uix.label import Label
+
+    label = Label(size_hint=(None, None), size=(400, 40), halign="left", color=(1, 1, 0, 1))
+    Window.add_widget(label)
+
+    def update(dt):
+        if len(profiler.frames):
+            text = f"frame {profiler.frames[-1].duration * 1000:.1f} ms"
+            if len(profiler.long_frames):
+                long_frame = profiler.long_frames[-1]
+                text += f"\nlast long: {long_frame.duration * 1000:.0f} ms {long_frame.culprit() or ''}"
+            label.text = text
+
+    # Updating the label every frame would itself cost frame time
+    Clock.schedule_interval(update, 0.25)
+    return label
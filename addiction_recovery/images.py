@@ -0,0 +1,163 @@
+from dataclasses import dataclass, asdict
+import json
+import os
+import random
+import struct
+from typing import Dict, List, Optional, Tuple
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+
+@dataclass
+class IndexedImage:
+    """
+    Properties:
+        filename, width, height, mtime (modification time of the file when it was indexed)
+    """
+    filename: str
+    width: int
+    height: int
+    mtime: float
+
+
+def read_image_size(filepath: str) -> Tuple[int, int]:
+    """
+    Reads the dimensions of a JPEG or PNG image from its header without decoding the image.
+
+    :param filepath: the path to the image
+    :return: a tuple of (width, height), or (0, 0) if the size could not be read
+    """
+    try:
+        with open(filepath, "rb") as file:
+            header = file.read(24)
+            if header.startswith(b"\x89PNG\r\n\x1a\n"):
+                return struct.unpack(">II", header[16:24])
+            if not header.startswith(b"\xff\xd8"):
+                return 0, 0
+
+            # Walk the JPEG segments until a start of frame marker is found
+            file.seek(2)
+            while True:
+                marker = file.read(2)
+                if len(marker) < 2 or marker[0] != 0xFF:
+                    return 0, 0
+                length = struct.unpack(">H", file.read(2))[0]
+                if 0xC0 <= marker[1] <= 0xCF and marker[1] not in (0xC4, 0xC8, 0xCC):
+                    height, width = struct.unpack(">xHH", file.read(5))
+                    return width, height
+                file.seek(length - 2, os.SEEK_CUR)
+    except (OSError, struct.error):
+        return 0, 0
+
+
+class ImageIndex:
+    """
+    An index of the motivational images that are available for each substance. The index is kept
+    in a manifest file so that the images don't need to be found again on every start-up, and
+    only the directories that have changed since the manifest was written are scanned again.
+    """
+
+    def __init__(self, root="motivation", manifest_filepath=None):
+        self.root = root
+        self.manifest_filepath = manifest_filepath or os.path.join(root, "manifest.json")
+        # substance name -> (directory mtime, images)
+        self.substances: Dict[str, Tuple[float, List[IndexedImage]]] = {}
+
+    def load(self) -> bool:
+        """
+        Loads the manifest file (if there is one) and brings it up to date with the image directories.
+
+        :return: a bool of whether the manifest had to be updated
+        """
+        try:
+            with open(self.manifest_filepath) as file:
+                manifest = json.load(file)
+            self.substances = {
+                substance: (data["mtime"], [IndexedImage(**image) for image in data["images"]])
+                for substance, data in manifest.items()
+            }
+        except (OSError, ValueError, KeyError, TypeError):
+            self.substances = {}
+
+        changed = self.refresh()
+        if changed:
+            self.save()
+        return changed
+
+    def save(self):
+        """ Writes the index to the manifest file. """
+        manifest = {
+            substance: {"mtime": mtime, "images": [asdict(image) for image in images]}
+            for substance, (mtime, images) in self.substances.items()
+        }
+        try:
+            with open(self.manifest_filepath, "w") as file:
+                json.dump(manifest, file, indent=1)
+        except OSError as e:
+            print(f"\033[91m Error in writing image manifest '{self.manifest_filepath}' : {e.args} \033[0m")
+
+    def refresh(self) -> bool:
+        """
+        Rescans any substance directories that have been modified since they were last indexed.
+
+        :return: a bool of whether the index changed
+        """
+        try:
+            directories = [entry for entry in os.scandir(self.root) if entry.is_dir()]
+        except OSError:
+            directories = []
+
+        changed = False
+        names = {entry.name for entry in directories}
+        for substance in list(self.substances):
+            if substance not in names:
+                del self.substances[substance]
+                changed = True
+
+        for entry in directories:
+            mtime = entry.stat().st_mtime
+            indexed = self.substances.get(entry.name)
+            if indexed is None or indexed[0] != mtime:
+                self.substances[entry.name] = (mtime, self.scan_directory(entry.path, indexed))
+                changed = True
+        return changed
+
+    def scan_directory(self, path: str, indexed: Optional[Tuple[float, List[IndexedImage]]]) -> List[IndexedImage]:
+        """
+        Finds the images in a substance directory, only reading the size of the images that are new or
+        have changed since the directory was last indexed.
+        """
+        previous = {image.filename: image for image in indexed[1]} if indexed else {}
+        images = []
+        for entry in sorted(os.scandir(path), key=lambda e: e.name):
+            if not entry.is_file() or not entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                continue
+            mtime = entry.stat().st_mtime
+            image = previous.get(entry.name)
+            if image is None or image.mtime != mtime:
+                image = IndexedImage(entry.name, *read_image_size(entry.path), mtime)
+            images.append(image)
+        return images
+
+    def get_images(self, substance: str) -> List[IndexedImage]:
+        _, images = self.substances.get(substance, (0, []))
+        return images
+
+    def random_image(self, substance: str) -> Optional[str]:
+        """
+        Picks a random image for the substance.
+
+        :return: the path to the image, or None if the substance doesn't have any images
+        """
+        images = self.get_images(substance)
+        if len(images):
+            return f"{self.root}/{substance}/{random.choice(images).filename}"
+        return None
+
+
+if __name__ == "__main__":
+    # Regenerate the manifest, e.g. after adding images
+    index = ImageIndex()
+    index.load()
+    for name, (_, substance_images) in sorted(index.substances.items()):
+        print(f"{name}: {len(substance_images)} images")
@@ -0,0 +1,154 @@
+"""
+Imports substance use history exported from other trackers.
+
+Usage:
+    python importer.py history.csv [--database database.db] [--person 1]
+
+The file can be CSV (with a header row), JSON Lines or a JSON array of objects. Each record needs the
+fields "substance" (e.g. Coffee), "time" (unix timestamp or ISO 8601 date), "amount" and "cost" (in
+pounds, as entered on the logging screen), and can have a "name" for the specific type.
+"""
+import argparse
+from dataclasses import dataclass
+import csv
+import datetime
+import json
+from typing import Dict, Iterator, List, Tuple
+
+from entities import *
+from repository import Repository, SqlRepository
+
+
+@dataclass
+class ImportResult:
+    """
+    Properties:
+        imported (number of uses added), skipped (number of invalid records)
+    """
+    imported: int = 0
+    skipped: int = 0
+
+
+def read_csv(file) -> Iterator[dict]:
+    yield from csv.DictReader(file)
+
+
+def read_json(file, chunk_size=1 << 16) -> Iterator[dict]:
+    """ Reads either JSON Lines or a JSON array of objects one record at a time. """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    end_of_file = False
+    while True:
+        # Skip anything between records: whitespace, the array brackets and commas
+        buffer = buffer.lstrip(" \t\r\n[],")
+        if not buffer:
+            if end_of_file:
+                return
+            chunk = file.read(chunk_size)
+            end_of_file = not chunk
+            buffer += chunk
+            continue
+
+        try:
+            record, end = decoder.raw_decode(buffer)
+        except json.JSONDecodeError:
+            # The record continues in the next chunk
+            chunk = file.read(chunk_size)
+            if not chunk:
+                raise
+            buffer += chunk
+            continue
+        buffer = buffer[end:]
+        yield record
+
+
+def read_records(filepath: str) -> Iterator[dict]:
+    with open(filepath, newline="", encoding="utf-8") as file:
+        if filepath.lower().endswith(".csv"):
+            yield from read_csv(file)
+        else:
+            yield from read_json(file)
+
+
+def parse_time(value) -> int:
+    try:
+        return int(float(value))
+    except ValueError:
+        return int(datetime.datetime.fromisoformat(value).timestamp())
+
+
+class UseImporter:
+    """
+    Adds substance uses to the repository in large batches. Amounts are matched against the amounts
+    that have already been seen during the import, so the repository is only queried once for each
+    distinct amount, and the derived data is rebuilt once when the import is finished.
+    """
+
+    def __init__(self, repository: Repository, person_id: int, batch_size=50_000):
+        self.repository = repository
+        self.batch_size = batch_size
+        self.tracking_ids = {
+            substance.name: tracking.id for substance, tracking in repository.get_substances_and_tracking(person_id)
+        }
+        self.amount_ids: Dict[Tuple[int, float, int, str], int] = {}
+        self.batch: List[SubstanceUse] = []
+        self.result = ImportResult()
+
+    def add(self, record: dict) -> bool:
+        """
+        Queues a record to be added to the repository.
+
+        :return: a bool of whether the record was valid
+        """
+        try:
+            tracking_id = self.tracking_ids[record["substance"]]
+            amount = float(record["amount"])
+            cost = int(float(record["cost"]) * 100)
+            name = record.get("name") or ""
+            use_time = parse_time(record["time"])
+        except (KeyError, TypeError, ValueError):
+            self.result.skipped += 1
+            return False
+
+        key = (tracking_id, amount, cost, name)
+        amount_id = self.amount_ids.get(key)
+        if amount_id is None:
+            amount_id = self.repository.get_or_create_amount(SubstanceAmount(amount, cost, name), tracking_id)
+            self.amount_ids[key] = amount_id
+
+        self.batch.append(SubstanceUse(tracking_id, amount_id, use_time))
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+        return True
+
+    def flush(self):
+        """ Writes the queued uses to the repository. """
+        if len(self.batch):
+            self.result.imported += self.repository.create_substance_uses(self.batch)
+            self.batch = []
+
+    def finish(self) -> ImportResult:
+        """ Writes any remaining uses and rebuilds the data derived from them. """
+        self.flush()
+        self.repository.rebuild_aggregates()
+        return self.result
+
+
+def import_file(repository: Repository, filepath: str, person_id: int, batch_size=50_000) -> ImportResult:
+    importer = UseImporter(repository, person_id, batch_size)
+    for record in read_records(filepath):
+        importer.add(record)
+    return importer.finish()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("filepath", help="CSV or JSON file to import")
+    parser.add_argument("--database", default="database.db", help="database to import into")
+    parser.add_argument("--person", type=int, default=1, help="id of the person whose history this is")
+    parser.add_argument("--batch-size", type=int, default=50_000, help="number of uses written per transaction")
+    args = parser.parse_args()
+
+    with SqlRepository(args.database) as r:
+        result = import_file(r, args.filepath, args.person, args.batch_size)
+    print(f"Imported {result.imported} uses, skipped {result.skipped} invalid records")
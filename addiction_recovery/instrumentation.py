@@ -0,0 +1,241 @@
+"""
+Optional timing of the repository and the calculations behind each screen.
+
+Instrumentation is disabled by default, in which case a timed function only costs one extra check of
+the enabled flag. Set the ADDICTION_RECOVERY_STATS environment variable to a filepath to enable it
+when the app starts, and the statistics will be written to that file when the app stops.
+
+SQL queries can also be traced by giving a SqlRepository a QueryTracer, which is enabled when the app
+starts by setting ADDICTION_RECOVERY_SLOW_QUERY_MS to the time after which a query counts as slow.
+"""
+from collections import deque
+from dataclasses import dataclass, field, asdict
+import functools
+import json
+import re
+import sqlite3
+import time
+from typing import Callable, Deque, Dict, Iterable, List, Optional, Tuple
+
+from repository import Repository
+
+# Repository methods that are not timed, e.g. because they return a generator
+UNTIMED_REPOSITORY_METHODS = ("start", "close", "get_use_history")
+
+enabled = False
+stats: Dict[str, "CallStats"] = {}
+
+# Functions that are called with (name, start, end) whenever a timed call finishes while enabled
+listeners: List[Callable[[str, float, float], None]] = []
+
+
+@dataclass
+class CallStats:
+    """
+    Properties:
+        calls, total_time (seconds), max_time (seconds), rows (total rows returned), max_rows,
+        histogram (number of calls that took up to 2 ** i microseconds, for each i)
+    """
+    calls: int = 0
+    total_time: float = 0
+    max_time: float = 0
+    rows: int = 0
+    max_rows: int = 0
+    histogram: List[int] = field(default_factory=list)
+
+    def record(self, duration: float, rows: Optional[int] = None):
+        self.calls += 1
+        self.total_time += duration
+        self.max_time = max(self.max_time, duration)
+        if rows is not None:
+            self.rows += rows
+            self.max_rows = max(self.max_rows, rows)
+        bucket = int(duration * 1_000_000).bit_length()
+        if bucket >= len(self.histogram):
+            self.histogram.extend([0] * (bucket + 1 - len(self.histogram)))
+        self.histogram[bucket] += 1
+
+    def percentile(self, fraction: float) -> float:
+        """ Estimates a percentile of the call time from the histogram, in seconds. """
+        target = fraction * self.calls
+        seen = 0
+        for bucket, count in enumerate(self.histogram):
+            seen += count
+            if seen >= target and count:
+                return 2 ** bucket / 1_000_000
+        return self.max_time
+
+
+def enable():
+    global enabled
+    enabled = True
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+def reset():
+    stats.clear()
+
+
+def record(name: str, duration: float, rows: Optional[int] = None):
+    call_stats = stats.get(name)
+    if call_stats is None:
+        call_stats = stats[name] = CallStats()
+    call_stats.record(duration, rows)
+
+
+def count_rows(result) -> Optional[int]:
+    if isinstance(result, list):
+        return len(result)
+    return None
+
+
+def timed(name: str = None):
+    """ Decorator that records how long each call to a function takes while instrumentation is enabled. """
+
+    def decorator(function: Callable) -> Callable:
+        call_name = name or function.__qualname__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            result = function(*args, **kwargs)
+            end = time.perf_counter()
+            record(call_name, end - start, count_rows(result))
+            for listener in listeners:
+                listener(call_name, start, end)
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+def instrument_repository(repository):
+    """
+    Times every method of the Repository interface on a repository, leaving the helpers that those
+    methods call untimed. The methods are replaced on the instance, so other repositories are unaffected.
+    """
+    class_name = type(repository).__name__
+    for method_name in sorted(Repository.__abstractmethods__):
+        if method_name.startswith("_") or method_name in UNTIMED_REPOSITORY_METHODS:
+            continue
+        method = getattr(repository, method_name)
+        if not hasattr(method, "__wrapped__"):
+            setattr(repository, method_name, timed(f"{class_name}.{method_name}")(method))
+    return repository
+
+
+def get_stats() -> Dict[str, CallStats]:
+    return dict(stats)
+
+
+def format_stats() -> str:
+    lines = [f"{'name':<55} {'calls':>7} {'total ms':>10} {'mean ms':>9} {'p95 ms':>9} {'max ms':>9} {'rows':>8}"]
+    for name, call_stats in sorted(stats.items(), key=lambda item: -item[1].total_time):
+        lines.append(
+            f"{name:<55} {call_stats.calls:>7} {call_stats.total_time * 1000:>10.2f} "
+            f"{call_stats.total_time / call_stats.calls * 1000:>9.3f} {call_stats.percentile(0.95) * 1000:>9.3f} "
+            f"{call_stats.max_time * 1000:>9.3f} {call_stats.rows:>8}"
+        )
+    return "\n".join(lines)
+
+
+def dump_stats(filepath: str):
+    """ Writes the statistics to a JSON file. """
+    try:
+        with open(filepath, "w") as file:
+            json.dump({name: asdict(call_stats) for name, call_stats in stats.items()}, file, indent=1)
+    except OSError as e:
+        print(f"\033[91m Error in writing statistics to '{filepath}' : {e.args} \033[0m")
+
+
+@dataclass
+class TracedQuery:
+    """
+    Properties:
+        sql (normalised), parameters (type names of the parameters), duration (seconds), rows,
+        plan (EXPLAIN QUERY PLAN details, only for slow queries)
+    """
+    sql: str
+    parameters: Tuple[str, ...]
+    duration: float
+    rows: int
+    plan: Optional[List[str]] = None
+
+
+def normalise_sql(sql: str) -> str:
+    """ Collapses whitespace and replaces literal values so that the same query always looks the same. """
+    sql = re.sub(r"'(?:[^']|'')*'", "?", sql)
+    sql = re.sub(r"\b\d+(?:\.\d+)?\b", "?", sql)
+    return " ".join(sql.split())
+
+
+class QueryTracer:
+    """
+    Records the SQL executed by a SqlRepository. Statistics are kept for every distinct query, while
+    only the most recent queries and the slow ones are kept individually. The query plan of each slow
+    query is looked up the first time it is slow, to show whether it is scanning whole tables.
+    """
+
+    def __init__(self, slow_threshold=0.05, history=1000):
+        self.slow_threshold = slow_threshold
+        self.stats: Dict[str, CallStats] = {}
+        self.recent: Deque[TracedQuery] = deque(maxlen=history)
+        self.slow: Deque[TracedQuery] = deque(maxlen=history)
+        self.plans: Dict[str, List[str]] = {}
+
+    def trace(self, connection, sql: str, parameters: Iterable, duration: float, rows: int):
+        normalised = normalise_sql(sql)
+        shape = () if parameters is ... else tuple(type(p).__name__ for p in parameters)
+        query_stats = self.stats.get(normalised)
+        if query_stats is None:
+            query_stats = self.stats[normalised] = CallStats()
+        query_stats.record(duration, rows)
+
+        traced = TracedQuery(normalised, shape, duration, rows)
+        self.recent.append(traced)
+        if duration >= self.slow_threshold:
+            traced.plan = self.explain(connection, normalised, sql, parameters)
+            self.slow.append(traced)
+            print(f"\033[93m Slow query ({duration * 1000:.1f} ms, {rows} rows) '{normalised}' : {traced.plan} \033[0m")
+
+    def explain(self, connection, normalised: str, sql: str, parameters: Iterable) -> List[str]:
+        plan = self.plans.get(normalised)
+        if plan is None:
+            try:
+                rows = connection.execute(
+                    f"EXPLAIN QUERY PLAN {sql}",
+                    () if parameters is ... else parameters
+                ).fetchall()
+                plan = [row[-1] for row in rows]
+            except sqlite3.Error as e:
+                plan = [f"unavailable: {e.args}"]
+            self.plans[normalised] = plan
+        return plan
+
+    def format_report(self) -> str:
+        lines = []
+        for sql, query_stats in sorted(self.stats.items(), key=lambda item: -item[1].total_time):
+            lines.append(
+                f"{query_stats.calls:>7} calls {query_stats.total_time * 1000:>10.2f} ms total "
+                f"{query_stats.max_time * 1000:>9.3f} ms max {query_stats.rows:>9} rows  {sql}"
+            )
+            for detail in self.plans.get(sql, []):
+                lines.append(f"{'':>8}{detail}")
+        return "\n".join(lines)
+
+    def dump(self, filepath: str):
+        try:
+            with open(filepath, "w") as file:
+                json.dump({
+                    "queries": {sql: asdict(query_stats) for sql, query_stats in self.stats.items()},
+                    "slow": [asdict(query) for query in self.slow],
+                }, file, indent=1)
+        except OSError as e:
+            print(f"\033[91m Error in writing query trace to '{filepath}' : {e.args} \033[0m")
@@ -1,6 +1,7 @@
 import time
 
 from kivy.app import App
+from kivy.clock import Clock
 from kivy.uix.image import Image
 from kivy.uix.label import Label
 from kivy.uix.gridlayout import GridLayout
@@ -10,14 +11,62 @@ from kivy.uix.widget import Widget
 from kivy.properties import ObjectProperty, ListProperty, NumericProperty, StringProperty
 from kivy.lang import Builder
 from kivy.uix.screenmanager import ScreenManager, Screen
+from kivy.utils import platform
 from kivy.garden.graph import Graph, MeshLinePlot, BarPlot, HBar
-from plyer import notification
 
+from concurrent.futures import Future, ThreadPoolExecutor
 import datetime
+import math
+import os
 import random
+from typing import Callable, Dict, List, Optional, Tuple
 
+from calculations import (
+    calculate_cost_series, calculate_goal_streak, calculate_level_series, calculate_under_goal_time,
+    calculate_weekly_costs, fetch_graph_inputs, format_streak
+)
 import entities
-from repository import SqlRepository, Repository
+import frameprofiler
+import instrumentation
+from images import ImageIndex
+from pharmacokinetics import SUBSTANCE_MODELS
+from reminders import AlarmClock, ReminderScheduler, notify
+from repository import SqlRepository, Repository, HOUR_BUCKET, DAY_BUCKET, WEEK_BUCKET
+from snapshot import Snapshot, load_snapshot, save_snapshot, take_snapshot
+
+DAY_LENGTH = 24 * 60 * 60
+
+# Calculates the level curves and costs of the graphs away from the main thread, so the screen can still
+# be drawn while they're being calculated
+graph_workers = ThreadPoolExecutor(max_workers=3, thread_name_prefix="graphs")
+# How long graphs that have been calculated can be shown for, as they're drawn up to when they were calculated
+CALCULATED_GRAPHS_MAX_AGE = 60
+
+# How long each long-range graph view shows, the bucket resolutions of its level and cost graphs and
+# the number of days between the major ticks on the x-axis. The week view is drawn from the uses.
+GRAPH_VIEWS = {
+    "month": (30 * DAY_LENGTH, HOUR_BUCKET, DAY_BUCKET, 7),
+    "year": (364 * DAY_LENGTH, DAY_BUCKET, WEEK_BUCKET, 28),
+}
+
+# A suggested time to keep uses for before they're compacted into the use buckets, if compaction is
+# turned on with keep_uses_for. Only the week graph and the current level read individual uses, so
+# this must be longer than both.
+KEEP_USES_FOR = 365 * DAY_LENGTH
+
+
+def call_when_done(futures: List[Future], callback: Callable[[], None], clock=Clock):
+    """ Calls back on the main thread (through the clock) once, when every future has finished. """
+    called = False
+
+    def check(dt):
+        nonlocal called
+        if not called and all(future.done() for future in futures):
+            called = True
+            callback()
+
+    for future in futures:
+        future.add_done_callback(lambda _: clock.schedule_once(check))
 
 
 class MenuScreen(Screen):
@@ -25,34 +74,45 @@ class MenuScreen(Screen):
     goal_text = StringProperty("")
     cost_text = StringProperty("")
 
+    @instrumentation.timed()
     def on_pre_enter(self):
         self.update_page()
 
-    def update_page(self):
+    @instrumentation.timed()
+    def update_page(self, snapshot: Optional[Snapshot] = None):
+        """ Shows a random image and the statistics, which are read from the snapshot if one is given. """
         # Get a random image of a random substance
         substances = list(AddictionRecovery.substance_tracking_ids.keys())
         if len(substances):
             substance_name = substances[random.randrange(0, len(substances))]
-            self.image_source = f"motivation/{substance_name}/{str(random.randrange(1, 5))}.jpg"
+            image = AddictionRecovery.images.random_image(substance_name) if AddictionRecovery.images else None
+            self.image_source = image or ""
 
         # Show statistics
-        goal = Repository.instance.get_goal(1)
+        current_time = int(time.time())
+        if snapshot:
+            goal_value = snapshot.goal_value
+            streak = format_streak(snapshot.get_goal_streak_days(current_time))
+            last_week_cost = snapshot.get_last_week_cost(current_time)
+        else:
+            goal = Repository.instance.get_goal(1)
+            goal_value = goal.value if goal else None
+            streak = calculate_goal_streak(goal) if goal else None
+            last_week_cost = 0
+            for tracking_id in AddictionRecovery.substance_tracking_ids.values():
+                weekly_costs = calculate_weekly_costs(tracking_id, current_time)
+                if len(weekly_costs):
+                    last_week_cost += weekly_costs[-1][1]
         self.goal_text = "You haven't logged any substance use"
-        if goal:
-            streak = calculate_goal_streak(goal)
-            if streak:
-                self.goal_text = f"You've met your goal of {goal.value} for {streak}"
-        last_week_cost = 0
-        for tracking_id in AddictionRecovery.substance_tracking_ids.values():
-            weekly_costs = calculate_weekly_costs(tracking_id)
-            if len(weekly_costs):
-                last_week_cost += weekly_costs[-1][1]
+        if goal_value is not None and streak:
+            self.goal_text = f"You've met your goal of {goal_value} for {streak}"
         self.cost_text = f"Last week, you spent £{'{:,.2f}'.format(last_week_cost)} on substances"
 
 
 class ProfileScreen(Screen):
     submit_button_text = StringProperty("Submit")
 
+    @instrumentation.timed()
     def on_pre_enter(self, *args):
         """ When page loads run assign hint text with database values. """
         person = Repository.instance.get_person(1)
@@ -135,9 +195,11 @@ class ProfileScreen(Screen):
 
 class LoggingScreen(Screen):
 
+    @instrumentation.timed()
     def on_pre_enter(self, *args):
         self.update_presets()
 
+    @instrumentation.timed()
     def update_presets(self):
         for widget in self.walk():
             if isinstance(widget, SubstancePresets):
@@ -157,26 +219,20 @@ class LoggingScreen(Screen):
             tracking_id = AddictionRecovery.substance_tracking_ids.get(substance)
             if tracking_id is None:
                 raise ValueError()
-            existing_preset = Repository.instance.get_substance_amount_from_data(
-                float(amount),
-                int(float(cost) * 100),
-                specific_name,
-                tracking_id
-            )
-            if existing_preset:
-                # If the manually entered data is the same as a preset, use that instead
-                use = entities.SubstanceUse(tracking_id, existing_preset.id, int(time.time()))
-                Repository.instance.create_substance_use(use)
-            else:
-                # Else add the substance use by creating a new amount
-                amount = entities.SubstanceAmount(float(amount), int(float(cost) * 100), specific_name)
-                amount_id = Repository.instance.create_substance_amount(amount)
+            # If the manually entered data is the same as a preset, that preset is used instead
+            amount = entities.SubstanceAmount(float(amount), int(float(cost) * 100), specific_name)
+            amount_id = Repository.instance.get_or_create_amount(amount, tracking_id)
+            use_id = -1
+            if amount_id != -1:
                 use = entities.SubstanceUse(tracking_id, amount_id, int(time.time()))
-                Repository.instance.create_substance_use(use)
+                use_id = Repository.instance.create_substance_use(use)
         except ValueError as e:
             # TODO: show error popup
             print(f"\033[91mInvalid substance values \033[0m")
             return
+        if use_id == -1:
+            # The repository has reported why it wasn't stored
+            return
 
         # Update the GUI to display the newly preset
         self.update_presets()
@@ -193,52 +249,85 @@ class LoggingScreen(Screen):
 
 
 class SubstancePresets(GridLayout):
-    """ A row of buttons that allow users to select previously used substance amount presets. """
+    """
+    A row of buttons that allow users to select previously used substance amount presets. The presets
+    are ranked either by how many times they have been used ("common") or with recent uses counting
+    for more ("recent").
+    """
     presets = ListProperty()
+    ranking = StringProperty("common")
 
     def __init__(self, **kwargs):
         super(SubstancePresets, self).__init__(**kwargs)
+        # Buttons are kept and reused when the presets change to avoid recreating widgets
+        self.preset_buttons = []
+        self.no_presets_label = Label(text="Manually enter data to create presets.")
         self.show_no_presets()
 
-    def update_presets(self):
+    @instrumentation.timed()
+    def update_presets(self, ranking: str = None):
         """ Retrieves the substance presets from the data repository. """
+        if ranking:
+            self.ranking = ranking
         cols = super().cols
         rows = super().rows
         if not cols:
             cols = 3
         if not rows:
             rows = 1
-        self.presets = Repository.instance.get_common_substance_amounts(cols * rows)
+        if self.ranking == "recent":
+            self.presets = Repository.instance.get_recent_substance_amounts(cols * rows)
+        else:
+            self.presets = Repository.instance.get_common_substance_amounts(cols * rows)
 
     def on_presets(self, _, presets):
         """ Updates widgets to show the new presets. """
-        self.clear_widgets()
         if len(presets) == 0:
             self.show_no_presets()
             return
-        for preset in presets:
-            self.add_widget(PresetButton(preset))
+        if self.no_presets_label.parent:
+            self.remove_widget(self.no_presets_label)
+
+        for i, preset in enumerate(presets):
+            if i == len(self.preset_buttons):
+                self.preset_buttons.append(PresetButton(preset))
+            button = self.preset_buttons[i]
+            button.set_preset(preset)
+            if button.parent is None:
+                self.add_widget(button)
+
+        # Hide the buttons that aren't needed anymore but keep them for later
+        for button in self.preset_buttons[len(presets):]:
+            if button.parent:
+                self.remove_widget(button)
 
     def show_no_presets(self):
-        self.clear_widgets()
-        self.add_widget(Label(text="Manually enter data to create presets."))
+        for button in self.preset_buttons:
+            if button.parent:
+                self.remove_widget(button)
+        if self.no_presets_label.parent is None:
+            self.add_widget(self.no_presets_label)
 
 
 class PresetButton(Button):
     """ Button that is used to record a substance use in the data repository. """
-    lastDateUsed = datetime.datetime.now()
 
     def __init__(self, preset: entities.SubstanceAmount, **kwargs):
         super(PresetButton, self).__init__(
-            text=f"{preset.name}:\namount: {preset.amount}, cost: £{'{:,.2f}'.format(preset.cost / 100)}",
             halign="center",
             valign="bottom",
             **kwargs
         )
-        self.preset = preset
+        self.preset = None
+        self.set_preset(preset)
+
+    def set_preset(self, preset: entities.SubstanceAmount):
+        """ Changes which preset the button is for, only updating the text if the preset is different. """
+        if preset != self.preset:
+            self.preset = preset
+            self.text = f"{preset.name}:\namount: {preset.amount}, cost: £{'{:,.2f}'.format(preset.cost / 100)}"
 
     def on_press(self):
-        self.lastDateUsed = datetime.datetime.now()
         tracking_id = Repository.instance.get_tracking_id_from_amount(self.preset.id)
         if tracking_id != -1:
             # Display the details of the preset on the logging page
@@ -252,24 +341,158 @@ class PresetButton(Button):
 
 
 class GraphScreen(Screen):
+    # "week" or one of GRAPH_VIEWS
+    view = StringProperty("week")
 
     def __init__(self, **kwargs):
         super(GraphScreen, self).__init__(**kwargs)
         self.tracking_id = -1
-
+        # The calculations of the graphs that were last asked for, until they're shown
+        self.pending_graphs = None
+        # (tracking id, view) -> (data version, time, (current levels, last levels, costs)) of the graphs that
+        # have been calculated, including those of the other substances that were calculated while idle
+        self.calculated_graphs: Dict[Tuple[int, str], Tuple[int, float, tuple]] = {}
+        # The tracking ids of the substances whose graphs are still to be prefetched, one at a time
+        self.prefetch_queue: List[int] = []
+        self.prefetch_event = None
+        self.prefetch_futures: List[Future] = []
+        # What calls back on the main thread and what calculates the graphs, which tests replace
+        self.clock = Clock
+        self.workers = graph_workers
+
+    def on_view(self, _, view):
+        if self.tracking_id != -1:
+            self.update_graphs()
+
+    @instrumentation.timed()
     def on_pre_enter(self):
         self.tracking_id = list(AddictionRecovery.substance_tracking_ids.values())[0]
         self.update_graphs()
 
-    def update_graphs(self):
+    def on_leave(self):
+        # Graphs that are still being calculated won't be shown, so they won't start prefetching either
+        if self.pending_graphs:
+            for future in self.pending_graphs:
+                future.cancel()
+            self.pending_graphs = None
+        self.cancel_prefetch()
+        self.calculated_graphs = {}
+
+    def select_substance(self, tracking_id: int):
+        """ Shows the graphs of another substance, which only swaps the points if they were prefetched. """
+        self.tracking_id = tracking_id
+        self.update_graphs(update_substances=False)
+
+    @instrumentation.timed()
+    def update_graphs(self, update_substances: bool = True):
+        """
+        Shows the graphs of the selected substance if they've been calculated since anything was logged,
+        otherwise reads everything they need, then calculates the levels and costs in the graph workers and
+        shows them together once they're all ready. Only this thread uses the repository. The graphs of the
+        other substances are then prefetched.
+        """
+        requested = time.perf_counter()
+        substance_graph = cost_graph = None
         for widget in self.walk():
             if isinstance(widget, SubstanceGraph):
-                widget.update_graph()
+                substance_graph = widget
             elif isinstance(widget, CostGraph):
-                widget.update_graph()
-            elif isinstance(widget, GraphSubstanceButtons):
+                cost_graph = widget
+            elif isinstance(widget, GraphSubstanceButtons) and update_substances:
                 widget.update_substances()
 
+        view = self.view
+        tracking_id = self.tracking_id
+
+        def show(graphs: tuple):
+            current_levels, last_levels, costs = graphs
+            if substance_graph:
+                substance_graph.show_levels(view, current_levels, last_levels, tracking_id)
+            if cost_graph:
+                cost_graph.show_costs(view, costs)
+            if instrumentation.enabled:
+                instrumentation.record("GraphScreen.graphs_shown", time.perf_counter() - requested)
+            self.prefetch_graphs(view)
+
+        self.pending_graphs = None
+        data_version = Repository.instance.get_data_version()
+        graphs = self.get_calculated_graphs(tracking_id, view, data_version)
+        if graphs:
+            show(graphs)
+            return
+
+        futures = self.submit_graphs(tracking_id, view)
+        self.pending_graphs = futures
+
+        def calculated():
+            # Graphs are only shown if newer ones haven't been asked for since
+            if self.pending_graphs is futures:
+                self.pending_graphs = None
+                graphs = tuple(future.result() for future in futures)
+                self.calculated_graphs[(tracking_id, view)] = (data_version, time.time(), graphs)
+                show(graphs)
+
+        call_when_done(futures, calculated, self.clock)
+
+    def get_calculated_graphs(self, tracking_id: int, view: str, data_version: int) -> Optional[tuple]:
+        """ Gets graphs that were calculated since anything was logged and are still recent enough to show. """
+        version, calculated_time, graphs = self.calculated_graphs.get((tracking_id, view), (None, 0, None))
+        if version != data_version or time.time() - calculated_time > CALCULATED_GRAPHS_MAX_AGE:
+            return None
+        return graphs
+
+    def submit_graphs(self, tracking_id: int, view: str) -> List[Future]:
+        """ Reads what the graphs of a substance need and starts calculating them in the graph workers. """
+        if view == "week":
+            inputs = fetch_graph_inputs(tracking_id, int(time.time()), 7 * DAY_LENGTH)
+        else:
+            period, level_resolution, cost_resolution, _ = GRAPH_VIEWS[view]
+            inputs = fetch_graph_inputs(tracking_id, int(time.time()), period, level_resolution, cost_resolution)
+        return [
+            self.workers.submit(calculate_level_series, inputs),
+            self.workers.submit(calculate_level_series, inputs, True),
+            self.workers.submit(calculate_cost_series, inputs)
+        ]
+
+    def prefetch_graphs(self, view: str):
+        """ Calculates the graphs of the other substances one at a time, starting in the next frame. """
+        self.cancel_prefetch()
+        data_version = Repository.instance.get_data_version()
+        self.prefetch_queue = [
+            tracking_id for tracking_id in AddictionRecovery.substance_tracking_ids.values()
+            if tracking_id != self.tracking_id and not self.get_calculated_graphs(tracking_id, view, data_version)
+        ]
+
+        def prefetch_next(dt):
+            self.prefetch_event = None
+            if not len(self.prefetch_queue):
+                return
+            tracking_id = self.prefetch_queue.pop(0)
+            futures = self.submit_graphs(tracking_id, view)
+            self.prefetch_futures = futures
+
+            def calculated():
+                # Not if the prefetching was cancelled, e.g. by leaving the screen
+                if self.prefetch_futures is futures:
+                    self.prefetch_futures = []
+                    graphs = tuple(future.result() for future in futures)
+                    self.calculated_graphs[(tracking_id, view)] = (data_version, time.time(), graphs)
+                    self.prefetch_event = self.clock.schedule_once(prefetch_next)
+
+            call_when_done(futures, calculated, self.clock)
+
+        self.prefetch_event = self.clock.schedule_once(prefetch_next)
+
+    def cancel_prefetch(self):
+        """ Stops prefetching graphs, cancelling the calculations that haven't started. """
+        self.prefetch_queue = []
+        if self.prefetch_event:
+            self.prefetch_event.cancel()
+            self.prefetch_event = None
+        for future in self.prefetch_futures:
+            future.cancel()
+        self.prefetch_futures = []
+
 
 class GraphSubstanceButtons(GridLayout):
     """ A row of buttons that allow users to select which substance they want to view the graphs for. """
@@ -278,6 +501,8 @@ class GraphSubstanceButtons(GridLayout):
     def __init__(self, **kwargs):
         super(GraphSubstanceButtons, self).__init__(**kwargs)
         self.clear_widgets()
+        # Buttons are kept and reused when the substances change to avoid recreating widgets
+        self.substance_buttons = []
 
     def update_substances(self):
         """ Retrieves the substance presets from the data repository. """
@@ -287,10 +512,17 @@ class GraphSubstanceButtons(GridLayout):
 
     def on_substances(self, _, substances):
         """ Updates widgets to show the substances. """
-        self.clear_widgets()
-        if len(substances) != 0:
-            for substance in substances:
-                self.add_widget(SubstanceGraphButton(*substance))
+        for i, substance in enumerate(substances):
+            if i == len(self.substance_buttons):
+                self.substance_buttons.append(SubstanceGraphButton(*substance))
+            button = self.substance_buttons[i]
+            button.set_substance(*substance)
+            if button.parent is None:
+                self.add_widget(button)
+
+        for button in self.substance_buttons[len(substances):]:
+            if button.parent:
+                self.remove_widget(button)
 
 
 class SubstanceGraphButton(Button):
@@ -298,24 +530,30 @@ class SubstanceGraphButton(Button):
 
     def __init__(self, substance: entities.Substance, tracking: entities.SubstanceTracking, **kwargs):
         super(SubstanceGraphButton, self).__init__(
-            text=substance.name,
             halign="center",
             valign="bottom",
             **kwargs
         )
+        self.tracking_id = -1
+        self.set_substance(substance, tracking)
+
+    def set_substance(self, substance: entities.Substance, tracking: entities.SubstanceTracking):
+        """ Changes which substance the button is for, only updating the text if it is different. """
+        if self.text != substance.name:
+            self.text = substance.name
         self.tracking_id = tracking.id
 
     def on_press(self):
         # notify("heelo")
-        AddictionRecovery.screens.get("graph").tracking_id = self.tracking_id
-        AddictionRecovery.screens.get("graph").update_graphs()
+        AddictionRecovery.screens.get("graph").select_substance(self.tracking_id)
 
 
 class SubstanceGraph(Graph):
+    LABEL = " " * 28 + "Time (days)\nGreen - this {0}, Blue - last {0}, Red - goal"
 
     def __init__(self, **kwargs):
         super(SubstanceGraph, self).__init__(
-            xlabel=" " * 28 + "Time (days)\nGreen - this week, Blue - last week, Red - goal", ylabel="Amount",
+            xlabel=SubstanceGraph.LABEL.format("week"), ylabel="Amount",
             x_ticks_minor=24, x_ticks_major=1,
             y_ticks_major=10,
             y_grid_label=True, x_grid_label=True,
@@ -337,74 +575,26 @@ class SubstanceGraph(Graph):
         self.goal_plot.points = [0]
         self.add_plot(self.goal_plot)
 
-    @staticmethod
-    def calculate_graph(points, tracking_id):
-        # Calculates points on graph according to half-life
-        substance_id = Repository.instance.get_substance_tracking(tracking_id).substance_id
-        substance = Repository.instance.get_substance(substance_id)
-        half_life = substance.half_life
-        half_life /= (24 * 60)  # scale
-
-        p = []
-        acc = 0  # accumulation of drug amount
-
-        for i in range(len(points)):  # Each point is one 'use'
-            t = points[i][0]
-            amount = points[i][1] + acc
-
-            while amount > 0.01:
-                if i < len(points) - 1:
-                    if points[i + 1][0] > t:  # no accumulation
-                        acc = 0
-                    else:
-                        # Accumulate drug
-                        acc = amount
-                        break
-
-                dt = 1 / (24 * 60 / 5)
-                t += dt
-                amount *= 0.5 ** (dt / half_life)
-                p.append((t, amount))
-
-        return p
-
-    def update_graph(self):
-        # Determine when the last two weeks start and end
-        current_time = int(time.time())
-        week_length = 7 * 24 * 60 * 60
-        one_week_time = current_time - week_length
-        two_week_time = one_week_time - week_length
-
-        # Find all the substance uses in those two weeks
-        tracking_id = AddictionRecovery.screens.get("graph").tracking_id
-        one_week_uses = Repository.instance.get_uses_from_time_period(
-            one_week_time,
-            current_time,
-            tracking_id
-        )
-        two_week_uses = Repository.instance.get_uses_from_time_period(
-            two_week_time,
-            one_week_time,
-            tracking_id
-        )
-
-        x_axis_scale = 24 * 60 * 60
-
-        # Plot this week's and last week's substance uses
-        self.current_week_plot.points = \
-            SubstanceGraph.calculate_graph(
-                [((use.time - one_week_time) / x_axis_scale, amount.amount) for use, amount in one_week_uses],
-                tracking_id)
-        self.last_week_plot.points = \
-            SubstanceGraph.calculate_graph(
-                [((use.time - two_week_time) / x_axis_scale, amount.amount) for use, amount in two_week_uses],
-                tracking_id)
-
-        # set the graph to have the right scale
-        self.xmax = week_length / x_axis_scale
+    @instrumentation.timed()
+    def show_levels(self, view: str, current_points, last_points, tracking_id: int):
+        """ Shows the level points of the current and the previous period of a view. """
+        self.xlabel = SubstanceGraph.LABEL.format(view)
+        self.current_week_plot.points = current_points
+        self.last_week_plot.points = last_points
+        if view == "week":
+            self.xmax = 7
+            self.x_ticks_major = 1
+            self.x_ticks_minor = 24
+        else:
+            period, _, _, ticks = GRAPH_VIEWS[view]
+            self.xmax = period / DAY_LENGTH
+            self.x_ticks_major = ticks
+            self.x_ticks_minor = ticks
         self.ymax = max([amount for _, amount in self.current_week_plot.points + self.last_week_plot.points],
                         default=1.59) * 1.25
+        self.update_goal(tracking_id)
 
+    def update_goal(self, tracking_id: int):
         # Display the user's goal
         goal = Repository.instance.get_goal(1)  # Currently, only one goal is used
         if goal:
@@ -417,33 +607,6 @@ class SubstanceGraph(Graph):
             self.goal_plot.points = [0]
 
 
-def calculate_weekly_costs(tracking_id):
-    # Get all substance uses
-    current_time = int(time.time())
-    uses = Repository.instance.get_uses_from_time_period(0, current_time, tracking_id)
-
-    if len(uses):
-        week_length = 7 * 24 * 60 * 60
-
-        # Find from what times the graph should show data from
-        oldest_use, _ = uses[0]
-        start_time = int(oldest_use.time)
-
-        # Calculate the total cost for each week
-        weekly_costs = [((t + week_length / 2 - start_time) / (week_length / 7), 0)
-                        for t in range(start_time, current_time, week_length)]
-        week = 0
-        for use, amount in uses:
-            while week < len(weekly_costs):
-                if use.time < start_time + (week + 1) * week_length:
-                    t, c = weekly_costs[week]
-                    weekly_costs[week] = (t, c + amount.cost / 100)
-                    break
-                week += 1
-        return weekly_costs
-    return []
-
-
 class CostGraph(Graph):
 
     def __init__(self, **kwargs):
@@ -462,41 +625,37 @@ class CostGraph(Graph):
         self.cost_plot.bar_width = -1
         self.add_plot(self.cost_plot)
 
-    def update_graph(self):
-        tracking_id = AddictionRecovery.screens.get("graph").tracking_id
-        weekly_costs = calculate_weekly_costs(tracking_id)
-        if len(weekly_costs):
+    @instrumentation.timed()
+    def show_costs(self, view: str, costs):
+        """ Shows the cost of every week, or of each day or week of the current month or year. """
+        if view != "week":
+            period, _, _, ticks = GRAPH_VIEWS[view]
+            self.xmax = period / DAY_LENGTH
+            self.x_ticks_major = ticks
+            self.ymax = max([cost for _, cost in costs], default=0) * 1.25 or 1
+            self.cost_plot.points = costs
+            self.cost_plot.update_bar_width()
+            return
+
+        self.x_ticks_major = 7
+        if len(costs):
             # set the graph to have the right scale
-            self.xmax = len(weekly_costs) * 7
-            self.ymax = max([cost for _, cost in weekly_costs], default=15.9) * 1.25
-            self.cost_plot.points = weekly_costs
+            self.xmax = len(costs) * 7
+            self.ymax = max([cost for _, cost in costs], default=15.9) * 1.25
+            self.cost_plot.points = costs
             self.cost_plot.update_bar_width()
         else:
             self.cost_plot.points = []
 
 
-def calculate_goal_streak(goal):
-    current_time = int(time.time())
-    uses = Repository.instance.get_uses_from_time_period(0, current_time, goal.substance_tracking_id)
-    amounts = \
-        SubstanceGraph.calculate_graph([(use.time, amount.amount) for use, amount in uses], goal.substance_tracking_id)
-    for i, (t, amount) in enumerate(reversed(amounts)):
-        if amount > goal.value or i == len(uses) - 1:
-            # The user failed their goal here
-            streak_length = int((current_time - t) // (24 * 60 * 60))
-            if streak_length == 1:
-                return str(streak_length) + " day"
-            else:
-                return str(streak_length) + " days"
-    return None
-
-
 class GoalsScreen(Screen):
     target_substance = StringProperty("None")
     weekly_intake = StringProperty("None")
     target_set_on = StringProperty("Not set")
     total_days = StringProperty("N/A")
+    under_goal_at = StringProperty("N/A")
 
+    @instrumentation.timed()
     def on_pre_enter(self, *args):
         goal = Repository.instance.get_goal(1)  # Currently, only one goal is used
         self.set_default_values()
@@ -520,27 +679,80 @@ class GoalsScreen(Screen):
         if streak:
             self.total_days = streak
 
+        # Display when the level will be back down to the target if nothing more is used
+        current_time = int(time.time())
+        under_goal_time = calculate_under_goal_time(goal, current_time)
+        if under_goal_time <= current_time:
+            self.under_goal_at = "Now"
+        elif math.isinf(under_goal_time):
+            self.under_goal_at = "Never"
+        else:
+            self.under_goal_at = datetime.datetime.fromtimestamp(under_goal_time).strftime("%d/%m/%Y %H:%M")
+
     def set_default_values(self):
         self.target_substance = "None"
         self.weekly_intake = "None"
         self.target_set_on = "Not set"
         self.total_days = "N/A"
+        self.under_goal_at = "N/A"
 
 
 class AddictionRecovery(App):
     screens = {}
     current_person_id = -1
     substance_tracking_ids = {}
-
-    def __init__(self, database_filepath="database.db", **kwargs):
+    images = None
+
+    def __init__(
+            self,
+            database_filepath="database.db",
+            repository: Repository = None,
+            keep_uses_for: Optional[int] = None,
+            snapshot_filepath: str = None,
+            **kwargs
+    ):
         super(AddictionRecovery, self).__init__(**kwargs)
-        SqlRepository(database_filepath)
+        # Compacting deletes the uses from the exported history, so by default (None) every use is kept
+        self.keep_uses_for = keep_uses_for
+        # The snapshot is kept next to the database by default, and not used with a given repository
+        self.snapshot_filepath = snapshot_filepath
+        # The database the reminder service reads, which is only the app's own
+        reminders_database = None
+        # Optional tracer of the SQL run by the app's own database
+        self.tracer = None
+        if repository is None:
+            reminders_database = os.path.abspath(database_filepath)
+            if self.snapshot_filepath is None:
+                self.snapshot_filepath = f"{database_filepath}.snapshot.json"
+            if slow_query_ms := os.environ.get("ADDICTION_RECOVERY_SLOW_QUERY_MS"):
+                self.tracer = instrumentation.QueryTracer(float(slow_query_ms) / 1000)
+            repository = SqlRepository(database_filepath, self.tracer)
+        Repository.instance = repository
+
+        # Opt-in timing of the repository and screens
+        self.stats_filepath = os.environ.get("ADDICTION_RECOVERY_STATS")
+        # The traced queries are written next to the stats, or the database if the stats aren't timed
+        self.queries_filepath = f"{self.stats_filepath or database_filepath}.queries.json"
+        if self.stats_filepath:
+            instrumentation.enable()
+            instrumentation.instrument_repository(repository)
+        self.frame_trace_filepath = os.environ.get("ADDICTION_RECOVERY_FRAME_TRACE")
+        self.frame_profiler = frameprofiler.FrameProfiler() if self.frame_trace_filepath else None
         AddictionRecovery.screens = {}
         AddictionRecovery.current_person_id = -1
         AddictionRecovery.substance_tracking_ids = {}
+        self.reminders = ReminderScheduler(notify)
+        if platform == "android" and reminders_database:
+            # Kivy's Clock doesn't tick while the app is paused, so the reminders are sent by the reminder
+            # service, started by an alarm
+            self.reminders.clock = AlarmClock(lambda: self.reminders.get_alarm_argument(reminders_database))
+            self.reminders.sent_until_filepath = f"{reminders_database}.reminders"
 
     def build(self):
-        self.notifsent = False
+        # Index the motivational images
+        AddictionRecovery.images = ImageIndex()
+        AddictionRecovery.images.load()
+
         # Setup data repository
         if Repository.instance:
             if not Repository.instance.start():
@@ -559,6 +771,11 @@ class AddictionRecovery(App):
         AddictionRecovery.screens["goals"] = GoalsScreen(name='goals')
         sm.add_widget(AddictionRecovery.screens["goals"])
 
+        if self.frame_profiler:
+            self.frame_profiler.start()
+            if os.environ.get("ADDICTION_RECOVERY_FRAME_OVERLAY"):
+                frameprofiler.show_overlay(self.frame_profiler)
+
         return sm
 
     def on_start(self):
@@ -566,46 +783,82 @@ class AddictionRecovery(App):
             # TODO: add error popup
             return
 
-        person = Repository.instance.get_person(1)
-        if not person:
-            self.root.current = "profile"
+        snapshot = None
+        if self.snapshot_filepath:
+            snapshot = load_snapshot(
+                self.snapshot_filepath, Repository.instance.get_database_id(), Repository.instance.get_data_version()
+            )
+        if snapshot:
+            # Nothing has changed since the snapshot was taken, so the history doesn't need to be read
+            AddictionRecovery.current_person_id = snapshot.person_id
+            AddictionRecovery.substance_tracking_ids = dict(snapshot.substance_tracking_ids)
         else:
-            AddictionRecovery.current_person_id = person.id
-            substances = Repository.instance.get_substances_and_tracking(person.id)
-            for substance, tracking in substances:
-                AddictionRecovery.substance_tracking_ids[substance.name] = tracking.id
+            person = Repository.instance.get_person(1)
+            if not person:
+                self.root.current = "profile"
+            else:
+                AddictionRecovery.current_person_id = person.id
+                substances = Repository.instance.get_substances_and_tracking(person.id)
+                for substance, tracking in substances:
+                    AddictionRecovery.substance_tracking_ids[substance.name] = tracking.id
 
-        AddictionRecovery.screens["menu"].update_page()
+        AddictionRecovery.screens["menu"].update_page(snapshot)
 
     def on_stop(self):
+        self.reminders.cancel()
+        if self.tracer:
+            self.tracer.dump(self.queries_filepath)
         self.save_and_close()
+        if self.stats_filepath:
+            instrumentation.dump_stats(self.stats_filepath)
+        if self.frame_profiler:
+            self.frame_profiler.stop()
+            self.frame_profiler.export_trace(self.frame_trace_filepath)
+            print(self.frame_profiler.format_report())
 
     def on_pause(self):
-        # Runs every frame while the app is sleeping
-        self.save_and_close()
-        now = datetime.datetime.now()
-        timedifference = (1440 * now.day + 60 * now.hour + now.minute) - (
-                1440 * PresetButton.lastdateused.day + 60 * PresetButton.lastdateused.hour + PresetButton.lastdateused.minute)
-        if (timedifference > 1440):
-            notify("Let us know how you're doing")
-            PresetButton.lastdateused = datetime.datetime.now()
-        elif (timedifference > 60):
-            notify("How are you recovering from your last intake")
-            PresetButton.lastdateused = datetime.datetime.now()
+        # Runs once when the app goes into the background
+        if Repository.instance:
+            # The first compaction takes a full VACUUM, so it's done while nothing is shown instead of on start
+            if AddictionRecovery.current_person_id != -1 and self.keep_uses_for is not None:
+                Repository.instance.compact_uses(int(time.time()) - self.keep_uses_for)
+            self.save_snapshot()
+            # Only the next reminder is scheduled, which schedules the one after it when it's sent
+            self.reminders.schedule(AddictionRecovery.substance_tracking_ids.values())
+            Repository.instance.pause()
         return True
 
     def on_resume(self):
-        # If any data might need replacing (which it probably won't)
-        pass
+        resumed = time.perf_counter()
+        self.reminders.cancel()
+        if Repository.instance and not Repository.instance.resume():
+            Repository.instance = None
+        # Time has passed, so the costs and streak might have changed
+        if Repository.instance and self.root and self.root.current == "menu":
+            AddictionRecovery.screens["menu"].update_page()
+
+        def interactive(dt):
+            # The first frame after resuming has been drawn
+            if instrumentation.enabled:
+                instrumentation.record("AddictionRecovery.resume_to_interactive", time.perf_counter() - resumed)
+
+        Clock.schedule_once(interactive)
+
+    def save_snapshot(self):
+        if self.snapshot_filepath and AddictionRecovery.current_person_id != -1:
+            save_snapshot(
+                take_snapshot(AddictionRecovery.current_person_id, AddictionRecovery.substance_tracking_ids),
+                self.snapshot_filepath
+            )
 
     def save_and_close(self):
         if Repository.instance:
+            self.save_snapshot()
             Repository.instance.close()
 
     @staticmethod
     def create_substance_tracking():
-        for substance_name, half_life in (("Alcohol", 240), ("Coffee", 480), ("Nicotine", 480)):
-            # TODO: use actual half-life
+        for substance_name, (half_life, _, _) in SUBSTANCE_MODELS.items():
             substance = entities.Substance(substance_name, half_life)
             substance_id = Repository.instance.create_substance(substance)
             substance_tracking = entities.SubstanceTracking(AddictionRecovery.current_person_id, substance_id)
@@ -661,22 +914,5 @@ class AddictionRecovery(App):
                 return substance
 
 
-def notify(message):
-    AndroidString = notification.autoclass('java.lang.String')
-    PythonActivity = notification.autoclass('org.kivy.android.PythonActivity')
-    NotificationBuilder = notification.autoclass('android.app.Notification$Builder')
-    Drawable = notification.autoclass('org.test.notify.R$drawable')
-    Context = notification.autoclass('android.content.Context')
-    notification_service = PythonActivity.mActivity.getSystemService(Context.NOTIFICATION_SERVICE)
-    icon = Drawable.icon
-    notification_builder = NotificationBuilder(PythonActivity.mActivity)
-    notification_builder.setContentTitle(AndroidString('Title'.encode('utf-8')))
-    notification_builder.setContentText(AndroidString('Message'.encode('utf-8')))
-    notification_builder.setSmallIcon(icon)
-    notification_builder.setAutoCancel(True)
-    notification_service = PythonActivity.mActivity.getSystemService(PythonActivity.NOTIFICATION_SERVICE)
-    notification_service.notify(0, notification_builder.build())
-
-
 if __name__ == '__main__':
     AddictionRecovery().run()
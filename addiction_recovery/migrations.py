@@ -0,0 +1,527 @@
+"""
+Versioned upgrades of the database schema.
+
+The schema version of a database is stored in its user_version pragma. When a SqlRepository starts,
+every migration newer than the database is applied in order, each in its own transaction that also
+sets the new version, so a database is never left with half of a migration's schema changes.
+
+Migrations that fill in a new table from the SubstanceUse table do so in batches of use ids,
+recording the last id that was filled in within each batch's transaction. This keeps the size of
+each transaction bounded, and a backfill that is interrupted (e.g. by the app being closed) carries
+on from its last batch the next time the app starts instead of starting again.
+"""
+from dataclasses import dataclass
+import sqlite3
+from typing import Callable, List, Optional
+
+BACKFILL_BATCH_SIZE = 100_000
+
+
+@dataclass
+class Migration:
+    """
+    Properties:
+        version, description,
+        upgrade (applies the schema changes to a SqlRepository without committing),
+        backfill (fills in data for the uses with after_id < id <= last_id without committing),
+        finish (completes the schema changes after the backfill without committing)
+    """
+    version: int
+    description: str
+    upgrade: Callable
+    backfill: Optional[Callable] = None
+    finish: Optional[Callable] = None
+
+
+MIGRATIONS: List[Migration] = []
+
+
+def migration(version: int, description: str, backfill: Callable = None, finish: Callable = None):
+    """ Decorator that registers an upgrade function as the migration to a version. """
+
+    def decorator(upgrade: Callable) -> Callable:
+        if version != len(MIGRATIONS) + 1:
+            raise ValueError(f"Migration to version {version} is out of order")
+        MIGRATIONS.append(Migration(version, description, upgrade, backfill, finish))
+        return upgrade
+
+    return decorator
+
+
+def latest_version() -> int:
+    return len(MIGRATIONS)
+
+
+def get_version(cursor) -> int:
+    return cursor.execute("PRAGMA user_version;").fetchone()[0]
+
+
+def migrate(repository, target_version: int = None, batch_size=BACKFILL_BATCH_SIZE) -> int:
+    """
+    Applies the migrations that are newer than a SqlRepository's database.
+
+    :param target_version: the version to stop at (default: the latest version)
+    :return: the number of migrations that were applied
+    :raises sqlite3.Error: if a migration fails, after rolling back its current transaction
+    """
+    if target_version is None:
+        target_version = latest_version()
+    cursor = repository.cursor
+    version = get_version(cursor)
+    applied = 0
+    for step in MIGRATIONS[version:target_version]:
+        try:
+            if step.backfill:
+                after_id = get_backfill_progress(cursor, step.version)
+                if after_id is None:
+                    # The schema changes are committed before the backfill starts so they're only made once
+                    cursor.execute("BEGIN;")
+                    step.upgrade(repository)
+                    after_id = cursor.execute("SELECT COALESCE(MIN(id) - 1, 0) FROM SubstanceUse;").fetchone()[0]
+                    cursor.execute(
+                        "INSERT INTO MigrationProgress(version, last_id) VALUES (?, ?);",
+                        (step.version, after_id)
+                    )
+                    repository.connection.commit()
+                run_backfill(repository, step, after_id, batch_size)
+
+            cursor.execute("BEGIN;")
+            if step.backfill:
+                cursor.execute("DELETE FROM MigrationProgress WHERE version = ?;", (step.version,))
+                if step.finish:
+                    step.finish(repository)
+            else:
+                step.upgrade(repository)
+            # Pragmas can't take parameters, but the version is always an int
+            cursor.execute(f"PRAGMA user_version = {int(step.version)};")
+            repository.connection.commit()
+        except sqlite3.Error:
+            repository.connection.rollback()
+            raise
+        applied += 1
+    return applied
+
+
+def get_backfill_progress(cursor, version: int) -> Optional[int]:
+    """ Gets the last use id that an unfinished backfill filled in, or None if it hasn't started. """
+    row = cursor.execute("SELECT last_id FROM MigrationProgress WHERE version = ?;", (version,)).fetchone()
+    return row[0] if row else None
+
+
+def run_backfill(repository, step: Migration, after_id: int, batch_size: int):
+    """ Runs a migration's backfill over the uses after after_id, committing after each batch. """
+    cursor = repository.cursor
+    max_id = cursor.execute("SELECT MAX(id) FROM SubstanceUse;").fetchone()[0]
+    while max_id is not None and after_id < max_id:
+        last_id = after_id + batch_size
+        cursor.execute("BEGIN;")
+        step.backfill(repository, after_id, last_id)
+        cursor.execute("UPDATE MigrationProgress SET last_id = ? WHERE version = ?;", (last_id, step.version))
+        repository.connection.commit()
+        after_id = last_id
+
+
+def backfill_substance_presets(repository, after_id: int, last_id: int):
+    repository.fill_substance_presets(after_id, last_id)
+
+
+def backfill_substance_amount_usage(repository, after_id: int, last_id: int):
+    repository.fill_substance_amount_usage(after_id, last_id)
+
+
+""" Migrations """
+
+
+@migration(1, "Create the original tables")
+def create_tables(repository):
+    # Databases created before migrations were added already have these tables, hence IF NOT EXISTS
+    cursor = repository.cursor
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS Person (
+            id INTEGER PRIMARY KEY,
+            name TEXT,
+            weight INTEGER,
+            height INTEGER,
+            dob INTEGER
+        );
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS SubstanceTracking (
+            id INTEGER PRIMARY KEY,
+            person_id INTEGER,
+            substance_id INTEGER,
+            FOREIGN KEY(person_id) REFERENCES Person(id),
+            FOREIGN KEY(substance_id) REFERENCES Substance(id)
+        );
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS Substance (
+            id INTEGER PRIMARY KEY,
+            name TEXT,
+            half_life REAL
+        );
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS SubstanceUse (
+            id INTEGER PRIMARY KEY,
+            substance_tracking_id INTEGER,
+            amount_id INTEGER,
+            time INTEGER,
+            FOREIGN KEY(substance_tracking_id) REFERENCES SubstanceTracking(id),
+            FOREIGN KEY(amount_id) REFERENCES SubstanceAmount(id)
+        );
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS SubstanceAmount (
+            id INTEGER PRIMARY KEY,
+            amount REAL,
+            cost INTEGER,
+            name TEXT
+        );
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS Goal (
+            id INTEGER PRIMARY KEY,
+            substance_tracking_id INTEGER,
+            goal_type_id INTEGER,
+            value INTEGER,
+            time_set INTEGER,
+            FOREIGN KEY(substance_tracking_id) REFERENCES SubstanceTracking(id),
+            FOREIGN KEY(goal_type_id) REFERENCES GoalType(id)
+        );
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS GoalType (
+            id INTEGER PRIMARY KEY,
+            name TEXT,
+            description TEXT
+        );
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS MigrationProgress (
+            version INTEGER PRIMARY KEY,
+            last_id INTEGER
+        );
+    """)
+
+
+@migration(2, "Add the SubstancePreset lookup table", backfill_substance_presets)
+def create_substance_presets(repository):
+    # Lookup table of the amounts used for each substance tracking, so that logging a use can find an
+    # existing amount with one indexed query
+    cursor = repository.cursor
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS SubstancePreset (
+            substance_tracking_id INTEGER,
+            amount_id INTEGER,
+            amount REAL,
+            cost INTEGER,
+            name TEXT,
+            FOREIGN KEY(substance_tracking_id) REFERENCES SubstanceTracking(id),
+            FOREIGN KEY(amount_id) REFERENCES SubstanceAmount(id)
+        );
+    """)
+    cursor.execute("""
+        CREATE UNIQUE INDEX IF NOT EXISTS SubstancePresetData
+        ON SubstancePreset(substance_tracking_id, amount, cost, name);
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS SubstancePresetAmount
+        ON SubstancePreset(amount_id);
+    """)
+    # Tables that existed before migrations were added are filled in again from scratch
+    cursor.execute("DELETE FROM SubstancePreset;")
+
+
+@migration(3, "Add the SubstanceAmountUsage counters", backfill_substance_amount_usage)
+def create_substance_amount_usage(repository):
+    # Running count of how many times each amount has been used, so that the most common amounts can
+    # be read from an index instead of counting every use
+    cursor = repository.cursor
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS SubstanceAmountUsage (
+            amount_id INTEGER PRIMARY KEY,
+            substance_tracking_id INTEGER,
+            uses INTEGER,
+            last_used INTEGER,
+            recency REAL,
+            FOREIGN KEY(amount_id) REFERENCES SubstanceAmount(id),
+            FOREIGN KEY(substance_tracking_id) REFERENCES SubstanceTracking(id)
+        );
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS SubstanceAmountUsageCount
+        ON SubstanceAmountUsage(uses DESC, last_used DESC);
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS SubstanceAmountUsageTrackingCount
+        ON SubstanceAmountUsage(substance_tracking_id, uses DESC, last_used DESC);
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS SubstanceAmountUsageRecency
+        ON SubstanceAmountUsage(recency DESC);
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS SubstanceAmountUsageTrackingRecency
+        ON SubstanceAmountUsage(substance_tracking_id, recency DESC);
+    """)
+    # Tables that existed before migrations were added are filled in again from scratch
+    cursor.execute("DELETE FROM SubstanceAmountUsage;")
+
+
+def backfill_compact_substance_uses(repository, after_id: int, last_id: int):
+    repository.cursor.execute("""
+        INSERT INTO SubstanceUseCompact(id, substance_tracking_id, amount_id, time)
+        SELECT SubstanceUse.id, SubstanceUse.substance_tracking_id,
+            COALESCE(AmountMerge.preset_amount_id, SubstanceUse.amount_id), SubstanceUse.time
+        FROM SubstanceUse
+            LEFT JOIN AmountMerge ON AmountMerge.substance_tracking_id = SubstanceUse.substance_tracking_id
+                AND AmountMerge.amount_id = SubstanceUse.amount_id
+        WHERE SubstanceUse.id > ? AND SubstanceUse.id <= ?;
+    """, (after_id, last_id))
+
+
+def finish_compact_storage(repository):
+    cursor = repository.cursor
+    cursor.execute("""
+        INSERT INTO SubstanceUseSequence(next_id)
+        SELECT COALESCE(MAX(id), 0) + 1 FROM SubstanceUse;
+    """)
+    cursor.execute("DROP TABLE SubstanceUse;")
+    cursor.execute("ALTER TABLE SubstanceUseCompact RENAME TO SubstanceUse;")
+
+    # Amounts are stored as whole thousandths, which SQLite stores in 1 to 3 bytes instead of 8
+    cursor.execute("""
+        CREATE TABLE SubstanceAmountCompact (
+            id INTEGER PRIMARY KEY,
+            amount INTEGER,
+            cost INTEGER,
+            name TEXT
+        );
+    """)
+    cursor.execute("""
+        INSERT INTO SubstanceAmountCompact(id, amount, cost, name)
+        SELECT id, CAST(ROUND(amount * ?) AS INTEGER), cost, name
+        FROM SubstanceAmount
+        WHERE id NOT IN (
+            SELECT amount_id FROM AmountMerge
+            EXCEPT
+            SELECT amount_id FROM SubstancePreset
+        );
+    """, (repository.AMOUNT_SCALE,))
+    cursor.execute("DROP TABLE SubstanceAmount;")
+    cursor.execute("ALTER TABLE SubstanceAmountCompact RENAME TO SubstanceAmount;")
+
+    cursor.execute("""
+        CREATE TABLE SubstancePresetCompact (
+            substance_tracking_id INTEGER,
+            amount_id INTEGER,
+            amount INTEGER,
+            cost INTEGER,
+            name TEXT,
+            FOREIGN KEY(substance_tracking_id) REFERENCES SubstanceTracking(id),
+            FOREIGN KEY(amount_id) REFERENCES SubstanceAmount(id)
+        );
+    """)
+    cursor.execute("""
+        INSERT INTO SubstancePresetCompact(substance_tracking_id, amount_id, amount, cost, name)
+        SELECT substance_tracking_id, amount_id, CAST(ROUND(amount * ?) AS INTEGER), cost, name
+        FROM SubstancePreset
+        ORDER BY rowid ASC;
+    """, (repository.AMOUNT_SCALE,))
+    cursor.execute("DROP TABLE SubstancePreset;")
+    cursor.execute("ALTER TABLE SubstancePresetCompact RENAME TO SubstancePreset;")
+    cursor.execute("""
+        CREATE UNIQUE INDEX SubstancePresetData
+        ON SubstancePreset(substance_tracking_id, amount, cost, name);
+    """)
+    cursor.execute("""
+        CREATE INDEX SubstancePresetAmount
+        ON SubstancePreset(amount_id);
+    """)
+
+    # The uses of merged amounts now count towards the amount they were merged into
+    if cursor.execute("SELECT COUNT(*) FROM AmountMerge;").fetchone()[0]:
+        cursor.execute("DELETE FROM SubstanceAmountUsage;")
+        repository.fill_substance_amount_usage()
+    cursor.execute("DROP TABLE AmountMerge;")
+
+
+@migration(
+    4, "Store uses clustered by tracking and time, and amounts as deduplicated fixed-point integers",
+    backfill_compact_substance_uses, finish_compact_storage
+)
+def create_compact_storage(repository):
+    cursor = repository.cursor
+    # Amounts that were logged before presets existed could be duplicated for every use, so each use
+    # is moved to the preset with the same data (the first amount that was used with that data). Names
+    # are compared as in migration 9, as presets without a name could be duplicated too.
+    cursor.execute("""
+        CREATE TABLE AmountMerge (
+            substance_tracking_id INTEGER,
+            amount_id INTEGER,
+            preset_amount_id INTEGER,
+            PRIMARY KEY(substance_tracking_id, amount_id)
+        );
+    """)
+    cursor.execute("""
+        INSERT INTO AmountMerge(substance_tracking_id, amount_id, preset_amount_id)
+        SELECT Uses.substance_tracking_id, Uses.amount_id, MIN(SubstancePreset.amount_id)
+        FROM (SELECT DISTINCT substance_tracking_id, amount_id FROM SubstanceUse) AS Uses
+            JOIN SubstanceAmount ON SubstanceAmount.id = Uses.amount_id
+            JOIN SubstancePreset ON SubstancePreset.substance_tracking_id = Uses.substance_tracking_id
+                AND SubstancePreset.amount = SubstanceAmount.amount
+                AND SubstancePreset.cost = SubstanceAmount.cost
+                AND COALESCE(SubstancePreset.name, '') = COALESCE(SubstanceAmount.name, '')
+        GROUP BY Uses.substance_tracking_id, Uses.amount_id
+        HAVING MIN(SubstancePreset.amount_id) != Uses.amount_id;
+    """)
+    # The duplicated presets of the merged amounts aren't used any more
+    cursor.execute("""
+        DELETE FROM SubstancePreset
+        WHERE (substance_tracking_id, amount_id) IN (SELECT substance_tracking_id, amount_id FROM AmountMerge);
+    """)
+
+    # Uses are only ever queried by substance tracking and time, so they are stored in that order
+    # without a separate rowid. The ids are assigned from SubstanceUseSequence instead.
+    cursor.execute("""
+        CREATE TABLE SubstanceUseCompact (
+            id INTEGER,
+            substance_tracking_id INTEGER,
+            amount_id INTEGER,
+            time INTEGER,
+            PRIMARY KEY(substance_tracking_id, time, id),
+            FOREIGN KEY(substance_tracking_id) REFERENCES SubstanceTracking(id),
+            FOREIGN KEY(amount_id) REFERENCES SubstanceAmount(id)
+        ) WITHOUT ROWID;
+    """)
+    cursor.execute("""
+        CREATE TABLE SubstanceUseSequence (
+            next_id INTEGER
+        );
+    """)
+
+
+@migration(5, "Add use buckets for long-range graphs")
+def create_use_buckets(repository):
+    cursor = repository.cursor
+    # Totals of the uses in each hour, day and week, kept up to date as uses are added
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS SubstanceUseBucket (
+            substance_tracking_id INTEGER,
+            resolution INTEGER,
+            start INTEGER,
+            uses INTEGER,
+            amount INTEGER,
+            cost INTEGER,
+            peak_level REAL,
+            PRIMARY KEY(substance_tracking_id, resolution, start),
+            FOREIGN KEY(substance_tracking_id) REFERENCES SubstanceTracking(id)
+        ) WITHOUT ROWID;
+    """)
+    # The level of each substance straight after its latest use, so the level after a new use can be
+    # calculated without reading the earlier uses
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS SubstanceLevel (
+            substance_tracking_id INTEGER PRIMARY KEY,
+            time INTEGER,
+            level REAL,
+            FOREIGN KEY(substance_tracking_id) REFERENCES SubstanceTracking(id)
+        );
+    """)
+    # The buckets are filled in by the next migration, which also needs its tables to fill them in
+
+
+@migration(6, "Add use compaction and level peaks")
+def create_use_compaction(repository):
+    cursor = repository.cursor
+    # The (time, level) after each use that no later use has reached or exceeded, so the last time the
+    # level was above any goal is the peak with the lowest level above it
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS SubstanceLevelPeak (
+            substance_tracking_id INTEGER,
+            time INTEGER,
+            level REAL,
+            PRIMARY KEY(substance_tracking_id, time),
+            FOREIGN KEY(substance_tracking_id) REFERENCES SubstanceTracking(id)
+        ) WITHOUT ROWID;
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS SubstanceLevelPeakLevel
+        ON SubstanceLevelPeak(substance_tracking_id, level);
+    """)
+    # How far each substance tracking's uses have been compacted, and its level straight after the last
+    # compacted use, so the buckets after the horizon can be recalculated without the deleted uses
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS SubstanceCompaction (
+            substance_tracking_id INTEGER PRIMARY KEY,
+            before_time INTEGER,
+            time INTEGER,
+            level REAL,
+            FOREIGN KEY(substance_tracking_id) REFERENCES SubstanceTracking(id)
+        );
+    """)
+    # The usage counts of the compacted uses, which rebuilding the aggregates starts from
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS CompactedAmountUsage (
+            amount_id INTEGER PRIMARY KEY,
+            substance_tracking_id INTEGER,
+            uses INTEGER,
+            last_used INTEGER,
+            recency REAL,
+            FOREIGN KEY(amount_id) REFERENCES SubstanceAmount(id),
+            FOREIGN KEY(substance_tracking_id) REFERENCES SubstanceTracking(id)
+        );
+    """)
+    repository.fill_all_use_buckets()
+
+
+@migration(7, "Add the data version counter")
+def create_data_version(repository):
+    # Counts the changes to the data that the start-up snapshot is derived from, so a snapshot can tell
+    # whether it is still up to date. Every use changes its buckets, including uses in log files.
+    cursor = repository.cursor
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS DataVersion (
+            version INTEGER
+        );
+    """)
+    cursor.execute("INSERT INTO DataVersion(version) SELECT 0 WHERE NOT EXISTS (SELECT * FROM DataVersion);")
+    for table in ("Person", "Substance", "SubstanceTracking", "Goal", "SubstanceUseBucket"):
+        for event in ("INSERT", "UPDATE", "DELETE"):
+            cursor.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS {table}{event.title()}Version
+                AFTER {event} ON {table}
+                BEGIN
+                    UPDATE DataVersion SET version = version + 1;
+                END;
+            """)
+
+
+@migration(8, "Add a random id to the data version")
+def add_database_id(repository):
+    # The version restarts at 0 when the database is reset, so a snapshot also checks that it was taken
+    # of the same database, which gets a new id whenever it's created
+    cursor = repository.cursor
+    cursor.execute("ALTER TABLE DataVersion ADD COLUMN database_id INTEGER;")
+    cursor.execute("UPDATE DataVersion SET database_id = random();")
+
+
+@migration(9, "Make presets without a name unique")
+def make_unnamed_presets_unique(repository):
+    # NULLs are never equal in a unique index, so presets without a name could be added more than once.
+    # The first of each is kept and the index treats a missing name as an empty one.
+    cursor = repository.cursor
+    cursor.execute("""
+        DELETE FROM SubstancePreset
+        WHERE rowid NOT IN (
+            SELECT MIN(rowid)
+            FROM SubstancePreset
+            GROUP BY substance_tracking_id, amount, cost, COALESCE(name, '')
+        );
+    """)
+    cursor.execute("DROP INDEX IF EXISTS SubstancePresetData;")
+    cursor.execute("""
+        CREATE UNIQUE INDEX SubstancePresetData
+        ON SubstancePreset(substance_tracking_id, amount, cost, COALESCE(name, ''));
+    """)
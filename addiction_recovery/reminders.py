@@ -0,0 +1,211 @@
+"""
+Reminders that are sent while the app is in the background. When each one is due is worked out from
+the level of each substance after its last use and how quickly it decays, so a single timer can be set
+for the next reminder when the app is paused instead of checking the time while it is paused.
+
+On Android, Kivy's Clock doesn't tick while the app is paused, so the timer is an alarm (AlarmClock)
+that starts the reminder service in reminderservice.py, which sends the reminder and sets the alarm
+for the next one.
+"""
+import json
+import time
+from typing import Callable, Iterable, List, Optional, Tuple
+
+from calculations import calculate_decay_time, get_half_life
+from repository import Repository
+
+CHECK_IN_AFTER = 24 * 60 * 60
+# The fraction of the level after the last use that counts as recovered if there isn't a goal for the substance
+RECOVERED_FRACTION = 0.5
+
+RECOVERY_MESSAGE = "How are you recovering from your last intake"
+CHECK_IN_MESSAGE = "Let us know how you're doing"
+
+# The Android package of the app, and the name the reminder service is declared with in the build
+# (services = Reminders:reminderservice.py)
+ANDROID_PACKAGE = "org.test.notify"
+REMINDER_SERVICE = "Reminders"
+
+
+def calculate_recovery_time(tracking_id: int, peak_time: int, level: float) -> float:
+    """
+    Calculates when the level of the substance will have decayed down to the goal, or to a fraction of
+    the level after the last use if there isn't a goal.
+
+    :param peak_time: the time of the last use, with level being the level straight after it
+    """
+    recovered_level = level * RECOVERED_FRACTION
+    goal = Repository.instance.get_goal(1)  # Currently, only one goal is used
+    if goal and goal.substance_tracking_id == tracking_id and 0 < goal.value < level:
+        recovered_level = goal.value
+    return calculate_decay_time(peak_time, level, recovered_level, get_half_life(tracking_id) * 60)
+
+
+class ReminderScheduler:
+    """
+    Schedules the next reminder with a clock that has Kivy's Clock.schedule_once (the default), and
+    sends it with the notifier. Each reminder is only sent once: a recovery reminder after the last use
+    of each substance, and a check-in a day after the last use or the last reminder, whichever is later.
+    """
+
+    def __init__(
+            self,
+            notifier: Callable[[str], None],
+            clock=None,
+            get_time: Callable[[], float] = time.time,
+            check_in_after: int = CHECK_IN_AFTER,
+            sent_until_filepath: str = None
+    ):
+        if clock is None:
+            from kivy.clock import Clock
+            clock = Clock
+        self.notifier = notifier
+        self.clock = clock
+        self.get_time = get_time
+        self.check_in_after = check_in_after
+        self.tracking_ids: List[int] = []
+        # The reminders that were due before this have been sent, or were due before the scheduler started
+        self.sent_until = get_time()
+        # Where sent_until is shared with the reminder service, which sends reminders from another process
+        self.sent_until_filepath = sent_until_filepath
+        self.event = None
+        self.next_reminder: Optional[Tuple[float, str]] = None
+
+    def get_next_reminder(self, tracking_ids: Iterable[int]) -> Optional[Tuple[float, str]]:
+        """ Gets the (due time, message) of the earliest reminder that hasn't been sent. """
+        reminders = []
+        last_use_time = None
+        for tracking_id in tracking_ids:
+            peak = Repository.instance.get_last_level_peak(tracking_id, 0)
+            if peak is None:
+                continue
+            # The latest peak is straight after the last use
+            peak_time, level = peak
+            last_use_time = peak_time if last_use_time is None else max(last_use_time, peak_time)
+            reminders.append((calculate_recovery_time(tracking_id, peak_time, level), RECOVERY_MESSAGE))
+        check_in_from = self.sent_until if last_use_time is None else max(self.sent_until, last_use_time)
+        reminders.append((check_in_from + self.check_in_after, CHECK_IN_MESSAGE))
+        reminders = [reminder for reminder in reminders if reminder[0] > self.sent_until]
+        if not len(reminders):
+            return None
+        return min(reminders)
+
+    def schedule(self, tracking_ids: Iterable[int]):
+        """ Sets the timer for the next reminder, replacing the one that was set. """
+        self.cancel()
+        self.load_sent_until()
+        self.tracking_ids = list(tracking_ids)
+        self.next_reminder = self.get_next_reminder(self.tracking_ids)
+        if self.next_reminder:
+            self.event = self.clock.schedule_once(self.send, max(0.0, self.next_reminder[0] - self.get_time()))
+
+    def cancel(self):
+        if self.event:
+            self.event.cancel()
+            self.event = None
+        self.next_reminder = None
+
+    def send(self, dt=None):
+        """ Sends the reminder that is due and sets the timer for the one after it. """
+        self.event = None
+        if self.next_reminder:
+            due, message = self.next_reminder
+            self.sent_until = max(due, self.get_time())
+            self.save_sent_until()
+            self.notifier(message)
+        self.schedule(self.tracking_ids)
+
+    def load_sent_until(self):
+        if self.sent_until_filepath:
+            try:
+                with open(self.sent_until_filepath, "r") as file:
+                    self.sent_until = max(self.sent_until, float(file.read()))
+            except (OSError, ValueError):
+                pass
+
+    def save_sent_until(self):
+        if self.sent_until_filepath:
+            try:
+                with open(self.sent_until_filepath, "w") as file:
+                    file.write(str(self.sent_until))
+            except OSError as e:
+                print(f"Error in saving when reminders were sent: {e.args}")
+
+    def get_alarm_argument(self, database_filepath: str) -> str:
+        """ Gets what the reminder service needs to send the next reminder, as JSON. """
+        return json.dumps({
+            "database": database_filepath,
+            "tracking_ids": self.tracking_ids,
+            "sent_until": self.sent_until,
+            "sent_until_filepath": self.sent_until_filepath,
+            "next_reminder": self.next_reminder
+        })
+
+    def restore(self, argument: dict):
+        """ Carries on from the scheduler that gave the alarm argument, in the reminder service. """
+        self.tracking_ids = argument["tracking_ids"]
+        self.sent_until = argument["sent_until"]
+        self.sent_until_filepath = argument["sent_until_filepath"]
+        self.next_reminder = tuple(argument["next_reminder"]) if argument["next_reminder"] else None
+
+
+def get_android_context():
+    """ Gets the app's activity, or the service if running in the reminder service. """
+    from jnius import autoclass
+    activity = autoclass("org.kivy.android.PythonActivity").mActivity
+    return activity if activity else autoclass("org.kivy.android.PythonService").mService
+
+
+class AlarmClock:
+    """
+    A clock for the scheduler on Android, whose events are alarms that start the reminder service even
+    if the app is paused or has been stopped. The callback isn't called in the app: the service is
+    given get_argument() and sends the reminder itself. Only one alarm is set at a time, so
+    cancelling any event cancels the alarm, including one that the service has set since.
+    """
+
+    class Event:
+        def __init__(self, alarm_manager, pending_intent):
+            self.alarm_manager = alarm_manager
+            self.pending_intent = pending_intent
+
+        def cancel(self):
+            self.alarm_manager.cancel(self.pending_intent)
+
+    def __init__(self, get_argument: Callable[[], str]):
+        self.get_argument = get_argument
+
+    def schedule_once(self, callback, timeout: float = 0) -> "AlarmClock.Event":
+        from jnius import autoclass
+        AlarmManager = autoclass("android.app.AlarmManager")
+        Context = autoclass("android.content.Context")
+        PendingIntent = autoclass("android.app.PendingIntent")
+        Service = autoclass(f"{ANDROID_PACKAGE}.Service{REMINDER_SERVICE}")
+        context = get_android_context()
+        intent = Service.getDefaultIntent(context, "", "Addiction Recovery", "Sending a reminder", self.get_argument())
+        pending_intent = PendingIntent.getService(
+            context, 0, intent, PendingIntent.FLAG_UPDATE_CURRENT | PendingIntent.FLAG_IMMUTABLE
+        )
+        alarm_manager = context.getSystemService(Context.ALARM_SERVICE)
+        # An inexact alarm is close enough for a reminder and doesn't need the exact alarm permission
+        alarm_manager.setAndAllowWhileIdle(
+            AlarmManager.RTC_WAKEUP, int((time.time() + timeout) * 1000), pending_intent
+        )
+        return AlarmClock.Event(alarm_manager, pending_intent)
+
+
+def notify(message):
+    from jnius import autoclass
+    AndroidString = autoclass('java.lang.String')
+    NotificationBuilder = autoclass('android.app.Notification$Builder')
+    Drawable = autoclass(f'{ANDROID_PACKAGE}.R$drawable')
+    Context = autoclass('android.content.Context')
+    context = get_android_context()
+    icon = Drawable.icon
+    notification_builder = NotificationBuilder(context)
+    notification_builder.setContentTitle(AndroidString('Title'.encode('utf-8')))
+    notification_builder.setContentText(AndroidString(message.encode('utf-8')))
+    notification_builder.setSmallIcon(icon)
+    notification_builder.setAutoCancel(True)
+    notification_service = context.getSystemService(Context.NOTIFICATION_SERVICE)
+    notification_service.notify(0, notification_builder.build())
@@ -0,0 +1,31 @@
+"""
+The reminder service, which is started by an AlarmClock alarm while the app is paused or stopped. It
+sends the reminder that is due and sets the alarm for the next one. It's declared in the Android
+build as the Reminders service (services = Reminders:reminderservice.py).
+"""
+import json
+import os
+
+from reminders import AlarmClock, ReminderScheduler, notify
+from repository import SqlRepository
+
+
+def main():
+    argument = json.loads(os.environ.get("PYTHON_SERVICE_ARGUMENT", "{}"))
+    if not argument.get("database"):
+        return
+    repository = SqlRepository(argument["database"])
+    try:
+        if not repository.start():
+            return
+        reminders = ReminderScheduler(
+            notify, AlarmClock(lambda: reminders.get_alarm_argument(argument["database"]))
+        )
+        reminders.restore(argument)
+        reminders.send()
+    finally:
+        repository.close()
+
+
+if __name__ == '__main__':
+    main()
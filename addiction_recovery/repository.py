@@ -1,8 +1,120 @@
 from abc import ABC, abstractmethod
+from bisect import bisect_left, bisect_right
+from dataclasses import replace
+import heapq
+import math
+import pathlib
+import random
 import sqlite3
-from typing import Iterable, List, Tuple, Optional
+import time
+from typing import Dict, Iterable, Iterator, List, Tuple, Optional
 
 from entities import *
+import migrations
+
+# The columns of the rows returned by Repository.get_use_history()
+USE_HISTORY_COLUMNS = (
+    "use_id", "time", "substance_tracking_id", "person_id", "substance", "amount_id", "amount", "cost", "name"
+)
+
+# How long it takes for a use to count half as much towards an amount's recency score
+RECENCY_HALF_LIFE = 7 * 24 * 60 * 60
+
+
+def log_add_exp2(a: Optional[float], b: Optional[float]) -> Optional[float]:
+    """
+    Calculates log2(2 ** a + 2 ** b) without overflowing, where None represents log2(0).
+
+    Recency scores are stored as log2(sum(2 ** (time / RECENCY_HALF_LIFE))) over an amount's uses. This
+    gives the same order as the decayed score at any later time, so the order can be indexed and each
+    use only has to add its own term. The decayed score is 2 ** (recency - now / RECENCY_HALF_LIFE).
+    """
+    if a is None:
+        return b
+    if b is None:
+        return a
+    if a < b:
+        a, b = b, a
+    return a + math.log2(1 + 2 ** (b - a))
+
+
+class LogSumExp2:
+    """ SQL aggregate version of log_add_exp2. """
+
+    def __init__(self):
+        self.value = None
+
+    def step(self, value):
+        self.value = log_add_exp2(self.value, value)
+
+    def finalize(self):
+        return self.value
+
+
+# Uses older than this many half-lives are ignored when calculating the level of a substance
+LEVEL_HORIZON_HALF_LIVES = 20
+
+# The most free pages of the database file that each compaction of the uses returns to the file system
+COMPACTION_VACUUM_PAGES = 1024
+
+# The lengths (in seconds) of the buckets that uses are summed up into for long-range graphs. Buckets
+# start at whole multiples of their length since the Unix epoch, so weeks start on Thursdays (UTC).
+HOUR_BUCKET = 60 * 60
+DAY_BUCKET = 24 * HOUR_BUCKET
+WEEK_BUCKET = 7 * DAY_BUCKET
+BUCKET_RESOLUTIONS = (HOUR_BUCKET, DAY_BUCKET, WEEK_BUCKET)
+
+
+def decay_level(level: float, elapsed: float, half_life: float) -> float:
+    """ Calculates how much of a substance level is left after some seconds, given its half-life in minutes. """
+    if half_life <= 0:
+        return 0
+    return level * 0.5 ** (elapsed / (half_life * 60))
+
+
+def bucket_uses(
+        uses: Iterable[Tuple[int, float, int]],
+        half_life: float,
+        substance_tracking_id: int,
+        since: int = None,
+        resolutions: Iterable[int] = BUCKET_RESOLUTIONS,
+        checkpoint: Tuple[int, float] = None
+) -> Tuple[List[UseBucket], Optional[Tuple[int, float]], List[Tuple[int, float]]]:
+    """
+    Sums up (time, amount, cost) uses, sorted by time, into buckets of each resolution while keeping
+    track of the level of the substance, starting from the (time, level) checkpoint if one is given.
+    Uses before since only count towards the level.
+
+    :return: the buckets, the (time, level) straight after the last use (or None if there were no uses
+        or checkpoint) and the level peaks of the uses from since onwards, sorted by time
+    """
+    buckets: Dict[Tuple[int, int], UseBucket] = {}
+    last_time, level = checkpoint or (None, 0)
+    peaks: List[Tuple[int, float]] = []
+    for use_time, amount, cost in uses:
+        if last_time is not None:
+            level = decay_level(level, use_time - last_time, half_life)
+        level += amount
+        last_time = use_time
+        if since is not None and use_time < since:
+            continue
+        # A peak stops being one when a later use reaches its level
+        while len(peaks) and peaks[-1][1] <= level:
+            peaks.pop()
+        peaks.append((use_time, level))
+        for resolution in resolutions:
+            start = use_time - use_time % resolution
+            bucket = buckets.get((resolution, start))
+            if bucket is None:
+                buckets[(resolution, start)] = UseBucket(
+                    substance_tracking_id, resolution, start, 1, amount, cost, level
+                )
+            else:
+                bucket.uses += 1
+                bucket.amount += amount
+                bucket.cost += cost
+                bucket.peak_level = max(bucket.peak_level, level)
+    return list(buckets.values()), (last_time, level) if last_time is not None else None, peaks
 
 
 class Repository(ABC):
@@ -30,9 +142,35 @@ class Repository(ABC):
         if Repository.instance == self:
             Repository.instance = None
 
+    @abstractmethod
+    def pause(self):
+        """ Saves everything so the app can be stopped while it's in the background, without closing. """
+
+    @abstractmethod
+    def resume(self) -> bool:
+        """
+        Makes the repository the active one again after it was paused or closed, reopening it if needed.
+        :return: a bool of whether the repository can be used
+        """
+
     @abstractmethod
     def reset(self): pass
 
+    @abstractmethod
+    def rebuild_aggregates(self):
+        """ Recalculates all the data that is derived from the substance uses. """
+
+    @abstractmethod
+    def compact_uses(self, before_time: int) -> int:
+        """
+        Deletes the substance uses before the start of the week containing before_time, keeping what is
+        derived from them: their use buckets, level peaks, presets and usage counts. Uses in that period
+        can then only be read through the buckets, so before_time must be older than anything that reads
+        individual uses, i.e. the week graph and the level horizon.
+
+        :return: the number of uses that were deleted
+        """
+
     """
     Create entities:
         These methods create an entity and return their id
@@ -48,7 +186,17 @@ class Repository(ABC):
     def create_substance(self, substance: Substance) -> int: pass
 
     @abstractmethod
-    def create_substance_use(self, use: SubstanceUse) -> int: pass
+    def create_substance_use(self, use: SubstanceUse) -> int:
+        """ :return: the id of the new use, or -1 if it couldn't be stored """
+
+    @abstractmethod
+    def create_substance_uses(self, uses: Iterable[SubstanceUse]) -> int:
+        """
+        Creates many substance uses at once without assigning their ids. Derived data (presets and usage
+        counts) is not updated, so rebuild_aggregates() must be called once all the uses have been added.
+
+        :return: the number of uses that were created
+        """
 
     @abstractmethod
     def create_substance_amount(self, amount: SubstanceAmount) -> int: pass
@@ -76,6 +224,20 @@ class Repository(ABC):
         or None if data matching the query cannot be found.
     """
 
+    @abstractmethod
+    def get_data_version(self) -> int:
+        """
+        Gets a number that changes whenever a person, substance, substance tracking or goal changes or
+        a use is added, so data derived from them can be cached until it changes.
+        """
+
+    @abstractmethod
+    def get_database_id(self) -> int:
+        """
+        Gets a random number that identifies the data, which changes when it's reset. Data versions are
+        only comparable between the same database id.
+        """
+
     @abstractmethod
     def get_person(self, person_id: int) -> Optional[Person]: pass
 
@@ -101,11 +263,23 @@ class Repository(ABC):
     def get_substances_and_tracking(self, person_id: int) -> List[Tuple[Substance, SubstanceTracking]]: pass
 
     @abstractmethod
-    def get_common_substance_amounts(self, count: int) -> List[SubstanceAmount]:
+    def get_common_substance_amounts(self, count: int, substance_tracking_id: int = None) -> List[SubstanceAmount]:
         """
         Gets the most commonly used substance amounts for quick access.
 
         :param count: the maximum number of substance amounts to be returned.
+        :param substance_tracking_id: if given, only amounts used for this substance tracking are returned.
+        :return: A list of SubstanceAmount objects
+        """
+
+    @abstractmethod
+    def get_recent_substance_amounts(self, count: int, substance_tracking_id: int = None) -> List[SubstanceAmount]:
+        """
+        Gets the substance amounts with the highest recency score, where each use counts half as much
+        for every RECENCY_HALF_LIFE seconds that have passed since it was used.
+
+        :param count: the maximum number of substance amounts to be returned.
+        :param substance_tracking_id: if given, only amounts used for this substance tracking are returned.
         :return: A list of SubstanceAmount objects
         """
 
@@ -126,6 +300,49 @@ class Repository(ABC):
     def get_tracking_id_from_amount(self, preset_id: int) -> int:
         pass
 
+    @abstractmethod
+    def get_or_create_amount(self, amount: SubstanceAmount, substance_tracking_id: int) -> int:
+        """
+        Gets the id of the substance amount with the same amount, cost and name that has been used for the
+        given substance tracking, creating a new substance amount if there isn't one.
+
+        :return: the id of the substance amount, or -1 if a new one couldn't be stored
+        """
+
+    @abstractmethod
+    def get_use_history(self, chunk_size: int) -> Iterator[List[Tuple]]:
+        """
+        Gets every substance use joined with its amount, tracking and substance. The rows are returned
+        in chunks so that the whole history doesn't need to be held in memory.
+
+        :param chunk_size: the maximum number of rows in each chunk
+        :return: an iterator of lists of rows, with the values in the order of USE_HISTORY_COLUMNS
+        """
+
+    @abstractmethod
+    def get_use_buckets(
+            self,
+            substance_tracking_id: int,
+            resolution: int,
+            time_start: int,
+            time_end: int
+    ) -> List[UseBucket]:
+        """
+        Gets the totals of a substance tracking's uses in buckets of one of the BUCKET_RESOLUTIONS, so
+        long time periods can be graphed without reading every use.
+
+        :return: the buckets with time_start <= start < time_end that have uses, sorted by start
+        """
+
+    @abstractmethod
+    def get_last_level_peak(self, substance_tracking_id: int, level: float) -> Optional[Tuple[int, float]]:
+        """
+        Gets the (time, level) straight after the latest use that took the substance above the given
+        level. The level has been at or below it since the level decayed back down from there.
+
+        :return: the time and level, or None if the level has never been above the given level
+        """
+
     @abstractmethod
     def get_uses_from_time_period(
             self,
@@ -138,18 +355,39 @@ class Repository(ABC):
         period of time.
         """
 
+    @abstractmethod
+    def get_use_amounts(self, substance_tracking_id: int, time_start: int, time_end: int) -> List[Tuple[int, float]]:
+        """
+        Gets the (time, amount) of the same uses as get_uses_from_time_period, without reading anything
+        else about them, e.g. for the level graphs.
+        """
+
 
 class SqlRepository(Repository):
     """
     A repository that provides an interface for the rest of the program to interact with a
     database.
+
+    Substance uses are stored clustered by substance tracking and time, so finding a use by its id has
+    to scan the table. Amounts are stored as whole multiples of 1 / AMOUNT_SCALE.
     """
+    AMOUNT_SCALE = 1000
+    # More than the number of different statements the repository runs, so while the connection is
+    # kept open none of them has to be prepared twice
+    CACHED_STATEMENTS = 256
 
-    def __init__(self, filepath="database.db"):
+    def __init__(self, filepath="database.db", tracer=None, read_only: bool = False):
         super().__init__()
         self.connection = None
         self.cursor = None
         self.filepath = filepath
+        # A read-only repository never creates or upgrades the database, so it can only start if the
+        # database exists and is already at the latest version
+        self.read_only = read_only
+        # Whether the tables have been created or upgraded since the repository was created
+        self.migrated = False
+        # Optional instrumentation.QueryTracer that records every command and query
+        self.tracer = tracer
 
     def __enter__(self):
         self.start()
@@ -160,86 +398,45 @@ class SqlRepository(Repository):
 
     def start(self) -> bool:
         """
-        Initialises the connection to the database and creates tables if needed.
+        Initialises the connection to the database and creates or upgrades the tables if needed.
         :return: a bool of whether the database was created successfully.
         """
 
         try:
-            # Setup database connection
-            self.connection = sqlite3.connect(self.filepath)
-            self.cursor = self.connection.cursor()
-
-            # Create the tables for the first start-up
-            # Doesn't use self.try_execute_command() as this commits after every command.
-            # This will leave the database in an invalid state if there is an error after one of
-            # the commands.
-            self.cursor.execute("""
-                CREATE TABLE IF NOT EXISTS Person (
-                    id INTEGER PRIMARY KEY,
-                    name TEXT,
-                    weight INTEGER,
-                    height INTEGER,
-                    dob INTEGER
-                );
-            """)
-            self.cursor.execute("""
-                CREATE TABLE IF NOT EXISTS SubstanceTracking (
-                    id INTEGER PRIMARY KEY,
-                    person_id INTEGER,
-                    substance_id INTEGER,
-                    FOREIGN KEY(person_id) REFERENCES Person(id),
-                    FOREIGN KEY(substance_id) REFERENCES Substance(id)
-                );
-            """)
-            self.cursor.execute("""
-                CREATE TABLE IF NOT EXISTS Substance (
-                    id INTEGER PRIMARY KEY,
-                    name TEXT,
-                    half_life REAL
-                );
-            """)
-            self.cursor.execute("""
-                CREATE TABLE IF NOT EXISTS SubstanceUse (
-                    id INTEGER PRIMARY KEY,
-                    substance_tracking_id INTEGER,
-                    amount_id INTEGER,
-                    time INTEGER,
-                    FOREIGN KEY(substance_tracking_id) REFERENCES SubstanceTracking(id),
-                    FOREIGN KEY(amount_id) REFERENCES SubstanceAmount(id)
-                );
-            """)
-            self.cursor.execute("""
-                CREATE TABLE IF NOT EXISTS SubstanceAmount (
-                    id INTEGER PRIMARY KEY,
-                    amount REAL,
-                    cost INTEGER,
-                    name TEXT
-                );
-            """)
-            self.cursor.execute("""
-                CREATE TABLE IF NOT EXISTS Goal (
-                    id INTEGER PRIMARY KEY,
-                    substance_tracking_id INTEGER,
-                    goal_type_id INTEGER,
-                    value INTEGER,
-                    time_set INTEGER,
-                    FOREIGN KEY(substance_tracking_id) REFERENCES SubstanceTracking(id),
-                    FOREIGN KEY(goal_type_id) REFERENCES GoalType(id)
-                );
-            """)
-            self.cursor.execute("""
-                CREATE TABLE IF NOT EXISTS GoalType (
-                    id INTEGER PRIMARY KEY,
-                    name TEXT,
-                    description TEXT
-                );
-            """)
-            self.connection.commit()
+            self.connect()
+            if self.read_only:
+                version = migrations.get_version(self.cursor)
+                if version != migrations.latest_version():
+                    print(f"Database '{self.filepath}' is at version {version}, not {migrations.latest_version()}")
+                    return False
+            # An established database only needs its version checked
+            elif migrations.get_version(self.cursor) < migrations.latest_version():
+                # The journal mode is stored in the database, so it only has to be set when it's created or upgraded
+                self.cursor.execute("PRAGMA journal_mode = WAL;")
+                # Create or upgrade the tables
+                migrations.migrate(self)
         except sqlite3.Error as e:
             print(f"Error in setting up database: {e.args}")
             return False
+        self.migrated = True
         return True
 
+    def connect(self):
+        """
+        Opens the connection to the database without creating or upgrading any tables. The database is
+        written through a write-ahead log (see start), which only has to be synced to disk when it is
+        checkpointed.
+        """
+        if self.read_only:
+            uri = f"{pathlib.Path(self.filepath).absolute().as_uri()}?mode=ro"
+            self.connection = sqlite3.connect(uri, uri=True, cached_statements=self.CACHED_STATEMENTS)
+        else:
+            self.connection = sqlite3.connect(self.filepath, cached_statements=self.CACHED_STATEMENTS)
+        self.connection.execute("PRAGMA synchronous = NORMAL;")
+        self.connection.create_function("log_add_exp2", 2, log_add_exp2, deterministic=True)
+        self.connection.create_aggregate("log_sum_exp2", 1, LogSumExp2)
+        self.cursor = self.connection.cursor()
+
     def close(self):
         super().close()
         if self.connection:
@@ -247,6 +444,29 @@ class SqlRepository(Repository):
             self.connection = None
             self.cursor = None
 
+    def pause(self):
+        # Copy the write-ahead log into the database, so it's fully synced if the app is killed
+        if self.connection:
+            try:
+                self.connection.commit()
+                self.cursor.execute("PRAGMA wal_checkpoint(TRUNCATE);").fetchall()
+            except sqlite3.Error as e:
+                print(f"\033[91m Error in checkpointing database : {e.args} \033[0m")
+
+    def resume(self) -> bool:
+        Repository.instance = self
+        if self.connection:
+            return True
+        if not self.migrated:
+            return self.start()
+        # The tables were already brought up to date when the repository started
+        try:
+            self.connect()
+        except sqlite3.Error as e:
+            print(f"Error in reconnecting to database: {e.args}")
+            return False
+        return True
+
     def reset(self):
         if self.cursor:
             self.cursor.execute("DROP TABLE IF EXISTS Person;")
@@ -256,11 +476,357 @@ class SqlRepository(Repository):
             self.cursor.execute("DROP TABLE IF EXISTS SubstanceAmount;")
             self.cursor.execute("DROP TABLE IF EXISTS Goal;")
             self.cursor.execute("DROP TABLE IF EXISTS GoalType;")
+            self.cursor.execute("DROP TABLE IF EXISTS SubstancePreset;")
+            self.cursor.execute("DROP TABLE IF EXISTS SubstanceAmountUsage;")
+            self.cursor.execute("DROP TABLE IF EXISTS SubstanceUseSequence;")
+            self.cursor.execute("DROP TABLE IF EXISTS SubstanceUseBucket;")
+            self.cursor.execute("DROP TABLE IF EXISTS SubstanceLevel;")
+            self.cursor.execute("DROP TABLE IF EXISTS SubstanceLevelPeak;")
+            self.cursor.execute("DROP TABLE IF EXISTS SubstanceCompaction;")
+            self.cursor.execute("DROP TABLE IF EXISTS CompactedAmountUsage;")
+            self.cursor.execute("DROP TABLE IF EXISTS DataVersion;")
+            self.cursor.execute("DROP TABLE IF EXISTS MigrationProgress;")
+            self.cursor.execute("PRAGMA user_version = 0;")
             self.connection.close()
             self.connection = None
             self.cursor = None
         self.start()
 
+    def rebuild_aggregates(self):
+        try:
+            self.cursor.execute("DELETE FROM SubstancePreset;")
+            self.cursor.execute("DELETE FROM SubstanceAmountUsage;")
+            self.fill_compacted_aggregates()
+            self.fill_substance_presets()
+            self.fill_substance_amount_usage()
+            self.fill_all_use_buckets()
+            self.connection.commit()
+        except sqlite3.Error as e:
+            self.connection.rollback()
+            print(f"\033[91m Error in rebuilding aggregates : {e.args} \033[0m")
+
+    def compact_uses(self, before_time: int, vacuum_pages: int = COMPACTION_VACUUM_PAGES) -> int:
+        """
+        Compacts the uses as described in Repository.compact_uses(), then vacuums up to vacuum_pages of
+        the database file. The first compaction that deletes any uses switches the database to
+        incremental vacuuming, which takes a full VACUUM.
+        """
+        before_time -= before_time % WEEK_BUCKET
+        deleted = 0
+        compacted = []
+        try:
+            self.cursor.execute("BEGIN;")
+            trackings = self.cursor.execute("""
+                SELECT SubstanceTracking.id, Substance.half_life, SubstanceCompaction.before_time,
+                    SubstanceCompaction.time, SubstanceCompaction.level
+                FROM SubstanceTracking
+                    JOIN Substance ON Substance.id = SubstanceTracking.substance_id
+                    LEFT JOIN SubstanceCompaction ON SubstanceCompaction.substance_tracking_id = SubstanceTracking.id;
+            """).fetchall()
+            for tracking_id, half_life, compacted_before, level_time, level in trackings:
+                if compacted_before is not None and before_time <= compacted_before:
+                    continue
+                counts: Dict[int, List] = {}
+                for use, amount in self.get_uses_from_time_period(-2 ** 63, before_time, tracking_id):
+                    # Uses added from before the last horizon have already been left out of the level
+                    if compacted_before is None or use.time >= compacted_before:
+                        if level_time is not None:
+                            level = amount.amount + decay_level(level, use.time - level_time, half_life)
+                        else:
+                            level = amount.amount
+                        level_time = use.time
+                    count = counts.get(use.amount_id)
+                    if count is None:
+                        count = counts[use.amount_id] = [0, use.time, None]
+                    count[0] += 1
+                    count[1] = max(count[1], use.time)
+                    count[2] = log_add_exp2(count[2], use.time / RECENCY_HALF_LIFE)
+                self.cursor.executemany(
+                    """
+                    INSERT INTO CompactedAmountUsage(amount_id, substance_tracking_id, uses, last_used, recency)
+                    VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT(amount_id) DO UPDATE SET
+                        uses = uses + excluded.uses,
+                        last_used = MAX(last_used, excluded.last_used),
+                        recency = log_add_exp2(recency, excluded.recency);
+                    """,
+                    ((amount_id, tracking_id, *count) for amount_id, count in counts.items())
+                )
+                self.cursor.execute(
+                    """
+                    INSERT OR REPLACE INTO SubstanceCompaction(substance_tracking_id, before_time, time, level)
+                    VALUES (?, ?, ?, ?);
+                    """,
+                    (tracking_id, before_time, level_time, level)
+                )
+                deleted += self.delete_uses_before(tracking_id, before_time)
+                compacted.append(tracking_id)
+            self.connection.commit()
+        except sqlite3.Error as e:
+            self.connection.rollback()
+            print(f"\033[91m Error in compacting substance uses : {e.args} \033[0m")
+            return 0
+        self.remove_compacted_uses(compacted, before_time)
+        if deleted:
+            self.vacuum(vacuum_pages)
+        return deleted
+
+    def delete_uses_before(self, tracking_id: int, before_time: int) -> int:
+        """ Deletes a substance tracking's uses before a time without committing, returning how many were deleted. """
+        self.cursor.execute(
+            "DELETE FROM SubstanceUse WHERE substance_tracking_id = ? AND time < ?;",
+            (tracking_id, before_time)
+        )
+        return self.cursor.rowcount
+
+    def remove_compacted_uses(self, tracking_ids: List[int], before_time: int):
+        """
+        Removes the compacted uses that are stored outside the database, once the compaction has been
+        committed. The uses in the database were deleted as part of it.
+        """
+
+    def vacuum(self, pages: int):
+        """ Returns up to the given number of free pages of the database file to the file system. """
+        try:
+            if self.cursor.execute("PRAGMA auto_vacuum;").fetchone()[0] != 2:
+                # Incremental vacuuming only takes effect after a full vacuum
+                self.cursor.execute("PRAGMA auto_vacuum = INCREMENTAL;")
+                self.cursor.execute("VACUUM;")
+            else:
+                # Pragmas can't take parameters, but the page count is always an int
+                self.cursor.execute(f"PRAGMA incremental_vacuum({int(pages)});").fetchall()
+        except sqlite3.Error as e:
+            print(f"\033[91m Error in vacuuming database : {e.args} \033[0m")
+
+    def fill_substance_presets(self, after_id: int = -2 ** 63, last_id: int = 2 ** 63 - 1):
+        """
+        Adds the presets of the substance uses with after_id < id <= last_id to the SubstancePreset
+        table without committing.
+        """
+        self.cursor.execute("""
+            INSERT OR IGNORE INTO SubstancePreset(substance_tracking_id, amount_id, amount, cost, name)
+            SELECT SubstanceUse.substance_tracking_id, SubstanceAmount.id,
+                SubstanceAmount.amount, SubstanceAmount.cost, SubstanceAmount.name
+            FROM SubstanceUse, SubstanceAmount
+            WHERE SubstanceUse.amount_id = SubstanceAmount.id AND SubstanceUse.id > ? AND SubstanceUse.id <= ?
+            ORDER BY SubstanceUse.id ASC;
+        """, (after_id, last_id))
+
+    def fill_substance_amount_usage(self, after_id: int = -2 ** 63, last_id: int = 2 ** 63 - 1):
+        """
+        Counts the substance uses with after_id < id <= last_id into the SubstanceAmountUsage table
+        without committing, adding to any counts that are already there.
+        """
+        self.cursor.execute("""
+            INSERT INTO SubstanceAmountUsage(amount_id, substance_tracking_id, uses, last_used, recency)
+            SELECT amount_id, MIN(substance_tracking_id), COUNT(*), MAX(time), log_sum_exp2(time / ?)
+            FROM SubstanceUse
+            WHERE id > ? AND id <= ?
+            GROUP BY amount_id
+            ON CONFLICT(amount_id) DO UPDATE SET
+                uses = uses + excluded.uses,
+                last_used = MAX(last_used, excluded.last_used),
+                recency = log_add_exp2(recency, excluded.recency);
+        """, (float(RECENCY_HALF_LIFE), after_id, last_id))
+
+    def fill_compacted_aggregates(self):
+        """ Adds the presets and usage counts of the compacted uses without committing. """
+        self.cursor.execute("""
+            INSERT OR IGNORE INTO SubstancePreset(substance_tracking_id, amount_id, amount, cost, name)
+            SELECT CompactedAmountUsage.substance_tracking_id, SubstanceAmount.id,
+                SubstanceAmount.amount, SubstanceAmount.cost, SubstanceAmount.name
+            FROM CompactedAmountUsage, SubstanceAmount
+            WHERE SubstanceAmount.id = CompactedAmountUsage.amount_id
+            ORDER BY CompactedAmountUsage.amount_id ASC;
+        """)
+        self.cursor.execute("""
+            INSERT INTO SubstanceAmountUsage(amount_id, substance_tracking_id, uses, last_used, recency)
+            SELECT amount_id, substance_tracking_id, uses, last_used, recency
+            FROM CompactedAmountUsage;
+        """)
+
+    def fill_all_use_buckets(self):
+        """ Recalculates the use buckets of every substance tracking without committing. """
+        for (tracking_id,) in self.cursor.execute("SELECT id FROM SubstanceTracking;").fetchall():
+            self.fill_use_buckets(tracking_id)
+
+    def fill_use_buckets(self, tracking_id: int, since: int = None):
+        """
+        Recalculates a substance tracking's use buckets and level peaks without committing, either from
+        the start of the week containing since or from its first use. Buckets before the compaction
+        horizon are kept, as their uses have been deleted.
+        """
+        row = self.cursor.execute(
+            """
+            SELECT Substance.half_life, SubstanceCompaction.before_time,
+                SubstanceCompaction.time, SubstanceCompaction.level
+            FROM SubstanceTracking
+                JOIN Substance ON Substance.id = SubstanceTracking.substance_id
+                LEFT JOIN SubstanceCompaction ON SubstanceCompaction.substance_tracking_id = SubstanceTracking.id
+            WHERE SubstanceTracking.id = ?;
+            """,
+            (tracking_id,)
+        ).fetchone()
+        if row is None:
+            return
+        half_life, compacted_before, checkpoint_time, checkpoint_level = row
+        if since is not None:
+            since -= since % WEEK_BUCKET
+        if compacted_before is not None and (since is None or since < compacted_before):
+            since = compacted_before
+        time_start = -2 ** 63
+        checkpoint = None
+        if since is not None:
+            time_start = int(since - LEVEL_HORIZON_HALF_LIVES * half_life * 60)
+            if compacted_before is not None and time_start < compacted_before:
+                # The level carries on from the last compacted use instead of the deleted uses
+                time_start = compacted_before
+                if checkpoint_time is not None:
+                    checkpoint = (checkpoint_time, checkpoint_level)
+        buckets, last_level, peaks = bucket_uses(
+            self.get_use_amount_rows(tracking_id, time_start), half_life, tracking_id, since, checkpoint=checkpoint
+        )
+
+        since = -2 ** 63 if since is None else since
+        self.cursor.execute(
+            "DELETE FROM SubstanceUseBucket WHERE substance_tracking_id = ? AND start >= ?;",
+            (tracking_id, since)
+        )
+        self.cursor.executemany(
+            """
+            INSERT INTO SubstanceUseBucket(substance_tracking_id, resolution, start, uses, amount, cost, peak_level)
+            VALUES (?, ?, ?, ?, ?, ?, ?);
+            """,
+            (
+                (tracking_id, b.resolution, b.start, b.uses, self.to_fixed_point(b.amount), b.cost, b.peak_level)
+                for b in buckets
+            )
+        )
+        self.cursor.execute(
+            "DELETE FROM SubstanceLevelPeak WHERE substance_tracking_id = ? AND time >= ?;",
+            (tracking_id, since)
+        )
+        if len(peaks):
+            # The earlier peaks that the highest new peak reaches aren't peaks any more
+            self.cursor.execute(
+                "DELETE FROM SubstanceLevelPeak WHERE substance_tracking_id = ? AND level <= ?;",
+                (tracking_id, peaks[0][1])
+            )
+            self.cursor.executemany(
+                "INSERT INTO SubstanceLevelPeak(substance_tracking_id, time, level) VALUES (?, ?, ?);",
+                ((tracking_id, *peak) for peak in peaks)
+            )
+        if last_level:
+            self.cursor.execute(
+                "INSERT OR REPLACE INTO SubstanceLevel(substance_tracking_id, time, level) VALUES (?, ?, ?);",
+                (tracking_id, *last_level)
+            )
+        else:
+            self.cursor.execute("DELETE FROM SubstanceLevel WHERE substance_tracking_id = ?;", (tracking_id,))
+
+    def get_use_amount_rows(self, tracking_id: int, time_start: int) -> Iterator[Tuple[int, float, int]]:
+        """ Gets the (time, amount, cost) of a substance tracking's uses from time_start onwards, sorted by time. """
+        return self.connection.execute(
+            """
+            SELECT SubstanceUse.time, SubstanceAmount.amount / ?, SubstanceAmount.cost
+            FROM SubstanceUse, SubstanceAmount
+            WHERE SubstanceUse.substance_tracking_id = ?
+                AND SubstanceUse.time >= ?
+                AND SubstanceAmount.id = SubstanceUse.amount_id
+            ORDER BY SubstanceUse.time ASC;
+            """,
+            (float(self.AMOUNT_SCALE), tracking_id, time_start)
+        )
+
+    def get_use_bucket_commands(self, use: SubstanceUse) -> Optional[List[Tuple[str, Tuple]]]:
+        """
+        Gets the commands that add a new use to its tracking's use buckets and level peaks. The level of
+        the substance is only known when the use is newer than every other use of the tracking, so if it
+        isn't, None is returned and fill_use_buckets() has to be called once the use has been added.
+
+        A use from before the compaction horizon is added to its buckets with its own amount as its
+        level, as the uses around it have been deleted.
+        """
+        row = self.cursor.execute(
+            """
+            SELECT SubstanceAmount.amount / ?, SubstanceAmount.cost, Substance.half_life,
+                SubstanceLevel.time, SubstanceLevel.level, SubstanceCompaction.before_time
+            FROM SubstanceAmount, SubstanceTracking
+                JOIN Substance ON Substance.id = SubstanceTracking.substance_id
+                LEFT JOIN SubstanceLevel ON SubstanceLevel.substance_tracking_id = SubstanceTracking.id
+                LEFT JOIN SubstanceCompaction ON SubstanceCompaction.substance_tracking_id = SubstanceTracking.id
+            WHERE SubstanceAmount.id = ? AND SubstanceTracking.id = ?;
+            """,
+            (float(self.AMOUNT_SCALE), use.amount_id, use.substance_tracking_id)
+        ).fetchone()
+        if row is None:
+            return []
+        amount, cost, half_life, last_time, level, compacted_before = row
+        compacted = compacted_before is not None and use.time < compacted_before
+        if last_time is None or compacted:
+            level = amount
+        elif use.time >= last_time:
+            level = decay_level(level, use.time - last_time, half_life) + amount
+        else:
+            return None
+
+        commands = [(
+            """
+            INSERT INTO SubstanceUseBucket(substance_tracking_id, resolution, start, uses, amount, cost, peak_level)
+            VALUES (?, ?, ?, 1, ?, ?, ?)
+            ON CONFLICT(substance_tracking_id, resolution, start) DO UPDATE
+            SET uses = uses + 1,
+                amount = amount + excluded.amount,
+                cost = cost + excluded.cost,
+                peak_level = MAX(peak_level, excluded.peak_level);
+            """,
+            (
+                use.substance_tracking_id, resolution, use.time - use.time % resolution,
+                self.to_fixed_point(amount), cost, level
+            )
+        ) for resolution in BUCKET_RESOLUTIONS]
+        commands.extend(self.level_peak_commands(use.substance_tracking_id, use.time, level))
+        if not compacted:
+            commands.append((
+                "INSERT OR REPLACE INTO SubstanceLevel(substance_tracking_id, time, level) VALUES (?, ?, ?);",
+                (use.substance_tracking_id, use.time, level)
+            ))
+        return commands
+
+    @staticmethod
+    def level_peak_commands(tracking_id: int, peak_time: int, level: float) -> List[Tuple[str, Tuple]]:
+        """ Gets the commands that add a level peak unless a later peak reaches it, removing the peaks it reaches. """
+        return [
+            (
+                "DELETE FROM SubstanceLevelPeak WHERE substance_tracking_id = ? AND time <= ? AND level <= ?;",
+                (tracking_id, peak_time, level)
+            ),
+            (
+                """
+                INSERT INTO SubstanceLevelPeak(substance_tracking_id, time, level)
+                SELECT ?, ?, ?
+                WHERE NOT EXISTS (
+                    SELECT * FROM SubstanceLevelPeak
+                    WHERE substance_tracking_id = ? AND time >= ? AND level >= ?
+                );
+                """,
+                (tracking_id, peak_time, level, tracking_id, peak_time, level)
+            ),
+        ]
+
+    def to_fixed_point(self, amount: float) -> int:
+        return round(amount * self.AMOUNT_SCALE)
+
+    def amount_from_row(self, row: Tuple) -> SubstanceAmount:
+        """ Converts an (id, amount, cost, name) row to a SubstanceAmount. """
+        return SubstanceAmount(row[1] / self.AMOUNT_SCALE, row[2], row[3], row[0])
+
+    def table_exists(self, table: str) -> bool:
+        return len(self.cursor.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name = ?;",
+            (table,)
+        ).fetchall()) > 0
+
     def try_execute_command(self, command: str, parameters: Iterable = ...) -> bool:
         """
         Attempts to execute an SQL command without throwing an exception if there is an error.
@@ -270,8 +836,11 @@ class SqlRepository(Repository):
         :return: a bool of whether the command was executed without errors
         """
         try:
+            start = time.perf_counter()
             self.cursor.execute(command, parameters)
             self.connection.commit()
+            if self.tracer:
+                self.tracer.trace(self.connection, command, parameters, time.perf_counter() - start, self.cursor.rowcount)
             return True
         except sqlite3.Error as e:
             if parameters is ...:
@@ -283,6 +852,35 @@ class SqlRepository(Repository):
                 )
             return False
 
+    def try_execute_commands(self, commands: Iterable[Tuple[str, Iterable]]) -> bool:
+        """
+        Attempts to execute several SQL commands in a single transaction, so either all or none of them
+        are applied. The cursor's lastrowid is that of the last command.
+
+        :param commands: (command, parameters) pairs that are to be executed in order
+        :return: a bool of whether the commands were executed without errors
+        """
+        command, parameters = None, None
+        try:
+            for command, parameters in commands:
+                self.execute_command(command, parameters)
+            self.connection.commit()
+            return True
+        except sqlite3.Error as e:
+            self.connection.rollback()
+            print(
+                f"\033[91m Error in executing command '{command}'\
+                with parameters '{parameters}' : {e.args} \033[0m"
+            )
+            return False
+
+    def execute_command(self, command: str, parameters: Iterable):
+        """ Executes an SQL command without committing, tracing it if there is a tracer. """
+        start = time.perf_counter()
+        self.cursor.execute(command, parameters)
+        if self.tracer:
+            self.tracer.trace(self.connection, command, parameters, time.perf_counter() - start, self.cursor.rowcount)
+
     def try_execute_query(self, query: str, parameters: Iterable = ...) -> List[Tuple]:
         """
         Attempts to execute an SQL query without throwing an exception if there is an error.
@@ -292,8 +890,12 @@ class SqlRepository(Repository):
         :return: a list of tuples that represent the rows that matched the query
         """
         try:
+            start = time.perf_counter()
             self.cursor.execute(query, parameters)
-            return self.cursor.fetchall()
+            rows = self.cursor.fetchall()
+            if self.tracer:
+                self.tracer.trace(self.connection, query, parameters, time.perf_counter() - start, len(rows))
+            return rows
         except sqlite3.Error as e:
             if parameters is ...:
                 print(f"\033[91m Error in executing query '{query}' : {e.args} \033[0m")
@@ -328,16 +930,83 @@ class SqlRepository(Repository):
         return self.cursor.lastrowid
 
     def create_substance_use(self, use: SubstanceUse) -> int:
-        self.try_execute_command(
-            "INSERT INTO SubstanceUse(substance_tracking_id, amount_id, time) VALUES (?, ?, ?);",
-            (use.substance_tracking_id, use.amount_id, use.time)
-        )
-        return self.cursor.lastrowid
+        try:
+            use_id = self.begin_use_insert()
+            bucket_commands = self.get_use_bucket_commands(use)
+            for command, parameters in self.substance_use_aggregate_commands(use) + (bucket_commands or []) + [
+                (
+                    "INSERT INTO SubstanceUse(id, substance_tracking_id, amount_id, time) VALUES (?, ?, ?, ?);",
+                    (use_id, use.substance_tracking_id, use.amount_id, use.time)
+                ),
+                ("UPDATE SubstanceUseSequence SET next_id = ?;", (use_id + 1,)),
+            ]:
+                self.execute_command(command, parameters)
+            if bucket_commands is None:
+                # The use is older than the tracking's latest use, so the levels after it have changed
+                self.fill_use_buckets(use.substance_tracking_id, use.time)
+            self.connection.commit()
+        except sqlite3.Error as e:
+            self.connection.rollback()
+            print(f"\033[91m Error in creating substance use : {e.args} \033[0m")
+            return -1
+        return use_id
+
+    def begin_use_insert(self) -> int:
+        """
+        Starts a transaction for adding substance uses and gets the first unused id. SubstanceUse is a
+        WITHOUT ROWID table, so ids come from SubstanceUseSequence, which must be updated in the same
+        transaction.
+        """
+        self.cursor.execute("BEGIN IMMEDIATE;")
+        return self.cursor.execute("SELECT next_id FROM SubstanceUseSequence;").fetchone()[0]
+
+    @staticmethod
+    def substance_use_aggregate_commands(use: SubstanceUse) -> List[Tuple[str, Tuple]]:
+        """ Gets the commands that update the data derived from the substance uses to include a new use. """
+        return [
+            (
+                """
+                INSERT OR IGNORE INTO SubstancePreset(substance_tracking_id, amount_id, amount, cost, name)
+                SELECT ?, id, amount, cost, name
+                FROM SubstanceAmount
+                WHERE id = ?;
+                """,
+                (use.substance_tracking_id, use.amount_id)
+            ),
+            (
+                """
+                INSERT INTO SubstanceAmountUsage(amount_id, substance_tracking_id, uses, last_used, recency)
+                VALUES (?, ?, 1, ?, ?)
+                ON CONFLICT(amount_id) DO UPDATE
+                SET uses = uses + 1,
+                    last_used = MAX(last_used, excluded.last_used),
+                    recency = log_add_exp2(recency, excluded.recency);
+                """,
+                (use.amount_id, use.substance_tracking_id, use.time, use.time / RECENCY_HALF_LIFE)
+            ),
+        ]
+
+    def create_substance_uses(self, uses: Iterable[SubstanceUse]) -> int:
+        rows_before = self.connection.total_changes
+        try:
+            first_id = self.begin_use_insert()
+            self.cursor.executemany(
+                "INSERT INTO SubstanceUse(id, substance_tracking_id, amount_id, time) VALUES (?, ?, ?, ?);",
+                ((use_id, use.substance_tracking_id, use.amount_id, use.time) for use_id, use in enumerate(uses, first_id))
+            )
+            created = self.connection.total_changes - rows_before
+            self.cursor.execute("UPDATE SubstanceUseSequence SET next_id = ?;", (first_id + created,))
+            self.connection.commit()
+        except sqlite3.Error as e:
+            self.connection.rollback()
+            print(f"\033[91m Error in creating substance uses : {e.args} \033[0m")
+            return 0
+        return created
 
     def create_substance_amount(self, amount: SubstanceAmount) -> int:
         self.try_execute_command(
             "INSERT INTO SubstanceAmount(amount, cost, name) VALUES (?, ?, ?);",
-            (amount.amount, amount.cost, amount.name)
+            (self.to_fixed_point(amount.amount), amount.cost, amount.name)
         )
         return self.cursor.lastrowid
 
@@ -396,6 +1065,18 @@ class SqlRepository(Repository):
             return *entities[0][1:], entities[0][0]
         return None
 
+    def get_data_version(self) -> int:
+        versions = self.try_execute_query("SELECT version FROM DataVersion;", ())
+        if len(versions):
+            return versions[0][0]
+        return -1
+
+    def get_database_id(self) -> int:
+        database_ids = self.try_execute_query("SELECT database_id FROM DataVersion;", ())
+        if len(database_ids):
+            return database_ids[0][0]
+        return -1
+
     def get_person(self, person_id: int) -> Optional[Person]:
         if data := self.get_entity("Person", person_id):
             return Person(*data)
@@ -418,7 +1099,7 @@ class SqlRepository(Repository):
 
     def get_substance_amount(self, amount_id: int) -> Optional[SubstanceAmount]:
         if data := self.get_entity("SubstanceAmount", amount_id):
-            return SubstanceAmount(*data)
+            return SubstanceAmount(data[0] / self.AMOUNT_SCALE, *data[1:])
         return None
 
     def get_goal(self, goal_id: int) -> Optional[Goal]:
@@ -447,23 +1128,57 @@ class SqlRepository(Repository):
             SubstanceTracking(s[4], s[5], s[3])
         ) for s in substances]
 
-    def get_common_substance_amounts(self, count: int) -> List[SubstanceAmount]:
-        substance_amounts = self.try_execute_query(
-            """
-            SELECT SubstanceAmount.*
-            FROM SubstanceAmount, (
-                SELECT SubstanceUse.amount_id, COUNT(*) AS uses
-                FROM SubstanceUse
-                GROUP BY SubstanceUse.amount_id
-                ORDER BY uses DESC
-                LIMIT ?
-            ) AS CommonAmounts
-            WHERE CommonAmounts.amount_id = SubstanceAmount.id
-            ORDER BY CommonAmounts.uses DESC;
-            """,
-            (count,)
-        )
-        return [SubstanceAmount(*s[1:], s[0]) for s in substance_amounts]
+    def get_common_substance_amounts(self, count: int, substance_tracking_id: int = None) -> List[SubstanceAmount]:
+        if substance_tracking_id is None:
+            substance_amounts = self.try_execute_query(
+                """
+                SELECT SubstanceAmount.*
+                FROM SubstanceAmountUsage, SubstanceAmount
+                WHERE SubstanceAmount.id = SubstanceAmountUsage.amount_id
+                ORDER BY SubstanceAmountUsage.uses DESC, SubstanceAmountUsage.last_used DESC
+                LIMIT ?;
+                """,
+                (count,)
+            )
+        else:
+            substance_amounts = self.try_execute_query(
+                """
+                SELECT SubstanceAmount.*
+                FROM SubstanceAmountUsage, SubstanceAmount
+                WHERE SubstanceAmountUsage.substance_tracking_id = ?
+                    AND SubstanceAmount.id = SubstanceAmountUsage.amount_id
+                ORDER BY SubstanceAmountUsage.uses DESC, SubstanceAmountUsage.last_used DESC
+                LIMIT ?;
+                """,
+                (substance_tracking_id, count)
+            )
+        return [self.amount_from_row(s) for s in substance_amounts]
+
+    def get_recent_substance_amounts(self, count: int, substance_tracking_id: int = None) -> List[SubstanceAmount]:
+        if substance_tracking_id is None:
+            substance_amounts = self.try_execute_query(
+                """
+                SELECT SubstanceAmount.*
+                FROM SubstanceAmountUsage, SubstanceAmount
+                WHERE SubstanceAmount.id = SubstanceAmountUsage.amount_id
+                ORDER BY SubstanceAmountUsage.recency DESC
+                LIMIT ?;
+                """,
+                (count,)
+            )
+        else:
+            substance_amounts = self.try_execute_query(
+                """
+                SELECT SubstanceAmount.*
+                FROM SubstanceAmountUsage, SubstanceAmount
+                WHERE SubstanceAmountUsage.substance_tracking_id = ?
+                    AND SubstanceAmount.id = SubstanceAmountUsage.amount_id
+                ORDER BY SubstanceAmountUsage.recency DESC
+                LIMIT ?;
+                """,
+                (substance_tracking_id, count)
+            )
+        return [self.amount_from_row(s) for s in substance_amounts]
 
     def get_substance_amount_from_data(
             self,
@@ -474,27 +1189,27 @@ class SqlRepository(Repository):
     ) -> Optional[SubstanceAmount]:
         substance_amounts = self.try_execute_query(
             """
-            SELECT SubstanceAmount.*
-            FROM SubstanceAmount, SubstanceUse
-            WHERE amount = ?
+            SELECT amount_id, amount, cost, name
+            FROM SubstancePreset
+            WHERE substance_tracking_id = ?
+                AND amount = ?
                 AND cost = ?
-                AND name = ?
-                AND SubstanceUse.amount_id = SubstanceAmount.id
-                AND SubstanceUse.substance_tracking_id = ?;
+                AND COALESCE(name, '') = COALESCE(?, '');
             """,
-            (amount, cost, name, substance_tracking_id)
+            (substance_tracking_id, self.to_fixed_point(amount), cost, name)
         )
         if len(substance_amounts):
-            # Unpack and reorder tuple to put id last
-            return SubstanceAmount(*substance_amounts[0][1:], substance_amounts[0][0])
+            return self.amount_from_row(substance_amounts[0])
         return None
 
     def get_tracking_id_from_amount(self, preset_id: int) -> int:
         tracking_ids = self.try_execute_query(
             """
             SELECT substance_tracking_id
-            FROM SubstanceUse
-            WHERE amount_id = ?;
+            FROM SubstancePreset
+            WHERE amount_id = ?
+            ORDER BY rowid ASC
+            LIMIT 1;
             """,
             (preset_id,)
         )
@@ -502,6 +1217,106 @@ class SqlRepository(Repository):
             return tracking_ids[0][0]
         return -1
 
+    def get_or_create_amount(self, amount: SubstanceAmount, substance_tracking_id: int) -> int:
+        existing_amount = self.get_substance_amount_from_data(
+            amount.amount,
+            amount.cost,
+            amount.name,
+            substance_tracking_id
+        )
+        if existing_amount:
+            return existing_amount.id
+
+        # The amount and its preset are added together, so an amount is never left without its preset
+        try:
+            self.cursor.execute("BEGIN IMMEDIATE;")
+            self.execute_command(
+                "INSERT INTO SubstanceAmount(amount, cost, name) VALUES (?, ?, ?);",
+                (self.to_fixed_point(amount.amount), amount.cost, amount.name)
+            )
+            amount_id = self.cursor.lastrowid
+            self.execute_command(
+                """
+                INSERT INTO SubstancePreset(substance_tracking_id, amount_id, amount, cost, name)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT DO NOTHING;
+                """,
+                (substance_tracking_id, amount_id, self.to_fixed_point(amount.amount), amount.cost, amount.name)
+            )
+            if self.cursor.rowcount == 0:
+                # Another connection added the same preset since it was looked up
+                self.connection.rollback()
+                existing_amount = self.get_substance_amount_from_data(
+                    amount.amount, amount.cost, amount.name, substance_tracking_id
+                )
+                return existing_amount.id if existing_amount else -1
+            self.connection.commit()
+        except sqlite3.Error as e:
+            self.connection.rollback()
+            print(f"\033[91m Error in creating substance amount : {e.args} \033[0m")
+            return -1
+        return amount_id
+
+    def get_use_history(self, chunk_size: int) -> Iterator[List[Tuple]]:
+        # Use a separate cursor so that other queries can be made between chunks
+        cursor = self.connection.cursor()
+        try:
+            # Reads the uses in the order they are stored in
+            cursor.execute("""
+                SELECT SubstanceUse.id, SubstanceUse.time, SubstanceUse.substance_tracking_id,
+                    SubstanceTracking.person_id, Substance.name, SubstanceAmount.id,
+                    SubstanceAmount.amount / ?, SubstanceAmount.cost, SubstanceAmount.name
+                FROM SubstanceUse
+                    JOIN SubstanceAmount ON SubstanceAmount.id = SubstanceUse.amount_id
+                    LEFT JOIN SubstanceTracking ON SubstanceTracking.id = SubstanceUse.substance_tracking_id
+                    LEFT JOIN Substance ON Substance.id = SubstanceTracking.substance_id
+                ORDER BY SubstanceUse.substance_tracking_id ASC, SubstanceUse.time ASC;
+            """, (float(self.AMOUNT_SCALE),))
+            while rows := cursor.fetchmany(chunk_size):
+                yield rows
+        except sqlite3.Error as e:
+            print(f"\033[91m Error in reading use history : {e.args} \033[0m")
+        finally:
+            cursor.close()
+
+    def get_use_buckets(
+            self,
+            substance_tracking_id: int,
+            resolution: int,
+            time_start: int,
+            time_end: int
+    ) -> List[UseBucket]:
+        buckets = self.try_execute_query(
+            """
+            SELECT *
+            FROM SubstanceUseBucket
+            WHERE substance_tracking_id = ?
+                AND resolution = ?
+                AND start >= ?
+                AND start < ?
+            ORDER BY start ASC;
+            """,
+            (substance_tracking_id, resolution, time_start, time_end)
+        )
+        return [UseBucket(*b[:4], b[4] / self.AMOUNT_SCALE, *b[5:]) for b in buckets]
+
+    def get_last_level_peak(self, substance_tracking_id: int, level: float) -> Optional[Tuple[int, float]]:
+        # The later a peak is, the lower its level, so the latest peak above a level is the lowest one
+        peaks = self.try_execute_query(
+            """
+            SELECT time, level
+            FROM SubstanceLevelPeak
+            WHERE substance_tracking_id = ?
+                AND level > ?
+            ORDER BY level ASC
+            LIMIT 1;
+            """,
+            (substance_tracking_id, level)
+        )
+        if len(peaks):
+            return peaks[0]
+        return None
+
     def get_uses_from_time_period(
             self,
             time_start: int,
@@ -522,5 +1337,330 @@ class SqlRepository(Repository):
         )
         return [(
             SubstanceUse(s[1], s[2], s[3], s[0]),
-            SubstanceAmount(s[5], s[6], s[7], s[4])
+            self.amount_from_row(s[4:])
         ) for s in use_amounts]
+
+    def get_use_amounts(self, substance_tracking_id: int, time_start: int, time_end: int) -> List[Tuple[int, float]]:
+        return self.try_execute_query(
+            """
+            SELECT SubstanceUse.time, SubstanceAmount.amount / ?
+            FROM SubstanceUse, SubstanceAmount
+            WHERE SubstanceUse.time > ?
+                AND SubstanceUse.time < ?
+                AND SubstanceUse.substance_tracking_id = ?
+                AND SubstanceAmount.id = SubstanceUse.amount_id
+            ORDER BY SubstanceUse.time ASC;
+            """,
+            (float(self.AMOUNT_SCALE), time_start, time_end, substance_tracking_id)
+        )
+
+
+class MemoryRepository(Repository):
+    """
+    A repository that keeps all the data in memory, for tests and sessions that don't need to be saved.
+    Uses are kept sorted by time for each substance tracking, so time periods are found with a binary
+    search, and the presets and usage counts are kept up to date as uses are added.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.started = False
+        self.reset_data()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, typ, value, traceback):
+        self.close()
+
+    def start(self) -> bool:
+        self.started = True
+        return True
+
+    def close(self):
+        super().close()
+        self.started = False
+
+    def pause(self):
+        pass
+
+    def resume(self) -> bool:
+        Repository.instance = self
+        self.started = True
+        return True
+
+    def reset(self):
+        self.reset_data()
+        self.start()
+
+    def reset_data(self):
+        self.entities: Dict[type, Dict[int, object]] = {
+            entity_type: {} for entity_type in
+            (Person, SubstanceTracking, Substance, SubstanceUse, SubstanceAmount, Goal, GoalType)
+        }
+        # substance tracking id -> sorted times and the uses at those times
+        self.use_times: Dict[int, List[int]] = {}
+        self.uses: Dict[int, List[SubstanceUse]] = {}
+        # (substance tracking id, amount, cost, name) -> amount id
+        self.presets: Dict[Tuple[int, float, int, str], int] = {}
+        self.amount_trackings: Dict[int, int] = {}
+        # amount id -> [substance tracking id, uses, last used, recency]
+        self.usage: Dict[int, List] = {}
+        self.data_version = 0
+        self.database_id = random.getrandbits(63)
+
+    def rebuild_aggregates(self):
+        self.presets = {}
+        self.amount_trackings = {}
+        self.usage = {}
+        for use in sorted(self.entities[SubstanceUse].values(), key=lambda u: u.id):
+            self.add_use_to_aggregates(use)
+
+    def compact_uses(self, before_time: int) -> int:
+        # The uses are only kept for the session, so there's nothing to save by compacting them
+        return 0
+
+    def add_use_to_aggregates(self, use: SubstanceUse):
+        amount = self.entities[SubstanceAmount].get(use.amount_id)
+        if amount:
+            self.add_preset(amount, use.substance_tracking_id)
+        usage = self.usage.get(use.amount_id)
+        if usage is None:
+            self.usage[use.amount_id] = [use.substance_tracking_id, 1, use.time, use.time / RECENCY_HALF_LIFE]
+        else:
+            usage[1] += 1
+            usage[2] = max(usage[2], use.time)
+            usage[3] = log_add_exp2(usage[3], use.time / RECENCY_HALF_LIFE)
+
+    def add_preset(self, amount: SubstanceAmount, substance_tracking_id: int):
+        key = (substance_tracking_id, amount.amount, amount.cost, amount.name)
+        if key not in self.presets:
+            self.presets[key] = amount.id
+            self.amount_trackings.setdefault(amount.id, substance_tracking_id)
+
+    def add_entity(self, entity) -> int:
+        self.data_version += 1
+        table = self.entities[type(entity)]
+        entity_id = len(table) + 1
+        table[entity_id] = replace(entity, id=entity_id)
+        return entity_id
+
+    def get_entity(self, entity_type: type, entity_id: int):
+        entity = self.entities[entity_type].get(entity_id)
+        if entity is None:
+            return None
+        return replace(entity)
+
+    """ Create entities """
+
+    def create_person(self, person: Person) -> int:
+        return self.add_entity(person)
+
+    def create_substance_tracking(self, tracking: SubstanceTracking) -> int:
+        return self.add_entity(tracking)
+
+    def create_substance(self, substance: Substance) -> int:
+        return self.add_entity(substance)
+
+    def create_substance_use(self, use: SubstanceUse) -> int:
+        use_id = self.add_use(use)
+        self.add_use_to_aggregates(self.entities[SubstanceUse][use_id])
+        return use_id
+
+    def create_substance_uses(self, uses: Iterable[SubstanceUse]) -> int:
+        return sum(1 for use in uses if self.add_use(use))
+
+    def add_use(self, use: SubstanceUse) -> int:
+        use_id = self.add_entity(use)
+        times = self.use_times.setdefault(use.substance_tracking_id, [])
+        index = bisect_right(times, use.time)
+        times.insert(index, use.time)
+        self.uses.setdefault(use.substance_tracking_id, []).insert(index, self.entities[SubstanceUse][use_id])
+        return use_id
+
+    def create_substance_amount(self, amount: SubstanceAmount) -> int:
+        return self.add_entity(amount)
+
+    def create_goal(self, goal: Goal) -> int:
+        return self.add_entity(goal)
+
+    def create_goal_type(self, goal_type: GoalType) -> int:
+        return self.add_entity(goal_type)
+
+    """ Update data """
+
+    def update_person(self, person: Person):
+        if person.id in self.entities[Person]:
+            self.entities[Person][person.id] = replace(person)
+            self.data_version += 1
+
+    def update_goal(self, goal: Goal):
+        if goal.id in self.entities[Goal]:
+            self.entities[Goal][goal.id] = replace(goal)
+            self.data_version += 1
+
+    """ Retrieve data """
+
+    def get_data_version(self) -> int:
+        return self.data_version
+
+    def get_database_id(self) -> int:
+        return self.database_id
+
+    def get_person(self, person_id: int) -> Optional[Person]:
+        return self.get_entity(Person, person_id)
+
+    def get_substance_tracking(self, tracking_id: int) -> Optional[SubstanceTracking]:
+        return self.get_entity(SubstanceTracking, tracking_id)
+
+    def get_substance(self, substance_id: int) -> Optional[Substance]:
+        return self.get_entity(Substance, substance_id)
+
+    def get_substance_use(self, use_id: int) -> Optional[SubstanceUse]:
+        return self.get_entity(SubstanceUse, use_id)
+
+    def get_substance_amount(self, amount_id: int) -> Optional[SubstanceAmount]:
+        return self.get_entity(SubstanceAmount, amount_id)
+
+    def get_goal(self, goal_id: int) -> Optional[Goal]:
+        return self.get_entity(Goal, goal_id)
+
+    def get_goal_type(self, goal_type_id: int) -> Optional[GoalType]:
+        return self.get_entity(GoalType, goal_type_id)
+
+    def get_substances_and_tracking(self, person_id: int) -> List[Tuple[Substance, SubstanceTracking]]:
+        substances = []
+        for tracking in self.entities[SubstanceTracking].values():
+            substance = self.entities[Substance].get(tracking.substance_id)
+            if tracking.person_id == person_id and substance:
+                substances.append((replace(substance), replace(tracking)))
+        return sorted(substances, key=lambda s: s[0].id)
+
+    def get_top_substance_amounts(self, count: int, substance_tracking_id: Optional[int], key) -> List[SubstanceAmount]:
+        usage = [
+            (amount_id, u) for amount_id, u in self.usage.items()
+            if (substance_tracking_id is None or u[0] == substance_tracking_id)
+            and amount_id in self.entities[SubstanceAmount]
+        ]
+        return [self.get_substance_amount(amount_id) for amount_id, _ in heapq.nlargest(count, usage, key=key)]
+
+    def get_common_substance_amounts(self, count: int, substance_tracking_id: int = None) -> List[SubstanceAmount]:
+        return self.get_top_substance_amounts(count, substance_tracking_id, lambda u: (u[1][1], u[1][2]))
+
+    def get_recent_substance_amounts(self, count: int, substance_tracking_id: int = None) -> List[SubstanceAmount]:
+        return self.get_top_substance_amounts(count, substance_tracking_id, lambda u: u[1][3])
+
+    def get_substance_amount_from_data(
+            self,
+            amount: int,
+            cost: int,
+            name: str,
+            substance_tracking_id: int
+    ) -> Optional[SubstanceAmount]:
+        amount_id = self.presets.get((substance_tracking_id, amount, cost, name))
+        if amount_id is None:
+            return None
+        return self.get_substance_amount(amount_id)
+
+    def get_tracking_id_from_amount(self, preset_id: int) -> int:
+        return self.amount_trackings.get(preset_id, -1)
+
+    def get_or_create_amount(self, amount: SubstanceAmount, substance_tracking_id: int) -> int:
+        existing_amount = self.get_substance_amount_from_data(
+            amount.amount,
+            amount.cost,
+            amount.name,
+            substance_tracking_id
+        )
+        if existing_amount:
+            return existing_amount.id
+        amount_id = self.create_substance_amount(amount)
+        self.add_preset(self.entities[SubstanceAmount][amount_id], substance_tracking_id)
+        return amount_id
+
+    def get_use_history(self, chunk_size: int) -> Iterator[List[Tuple]]:
+        rows = []
+        for use in self.entities[SubstanceUse].values():
+            amount = self.entities[SubstanceAmount].get(use.amount_id)
+            if amount is None:
+                continue
+            tracking = self.entities[SubstanceTracking].get(use.substance_tracking_id)
+            substance = self.entities[Substance].get(tracking.substance_id) if tracking else None
+            rows.append((
+                use.id, use.time, use.substance_tracking_id,
+                tracking.person_id if tracking else None,
+                substance.name if substance else None,
+                amount.id, amount.amount, amount.cost, amount.name
+            ))
+            if len(rows) == chunk_size:
+                yield rows
+                rows = []
+        if len(rows):
+            yield rows
+
+    def get_use_buckets(
+            self,
+            substance_tracking_id: int,
+            resolution: int,
+            time_start: int,
+            time_end: int
+    ) -> List[UseBucket]:
+        # Buckets are calculated when they're needed, as reading the uses from memory is already fast
+        tracking = self.entities[SubstanceTracking].get(substance_tracking_id)
+        substance = self.entities[Substance].get(tracking.substance_id) if tracking else None
+        if substance is None:
+            return []
+        first_start = time_start + -time_start % resolution
+        last_end = time_end - 1 - (time_end - 1) % resolution + resolution
+        times = self.use_times.get(substance_tracking_id, [])
+        start = bisect_left(times, first_start - LEVEL_HORIZON_HALF_LIVES * substance.half_life * 60)
+        end = bisect_left(times, last_end)
+        uses = []
+        for use in self.uses[substance_tracking_id][start:end] if end > start else []:
+            amount = self.entities[SubstanceAmount].get(use.amount_id)
+            if amount:
+                uses.append((use.time, amount.amount, amount.cost))
+        buckets, _, _ = bucket_uses(uses, substance.half_life, substance_tracking_id, first_start, (resolution,))
+        return buckets
+
+    def get_last_level_peak(self, substance_tracking_id: int, level: float) -> Optional[Tuple[int, float]]:
+        tracking = self.entities[SubstanceTracking].get(substance_tracking_id)
+        substance = self.entities[Substance].get(tracking.substance_id) if tracking else None
+        if substance is None:
+            return None
+        peak = None
+        use_level = 0
+        last_time = None
+        for use in self.uses.get(substance_tracking_id, []):
+            amount = self.entities[SubstanceAmount].get(use.amount_id)
+            if amount is None:
+                continue
+            if last_time is not None:
+                use_level = decay_level(use_level, use.time - last_time, substance.half_life)
+            use_level += amount.amount
+            last_time = use.time
+            if use_level > level:
+                peak = (use.time, use_level)
+        return peak
+
+    def get_uses_from_time_period(
+            self,
+            time_start: int,
+            time_end: int,
+            substance_tracking_id: int
+    ) -> List[Tuple[SubstanceUse, SubstanceAmount]]:
+        times = self.use_times.get(substance_tracking_id, [])
+        start = bisect_right(times, time_start)
+        end = bisect_left(times, time_end)
+        uses = []
+        for use in self.uses[substance_tracking_id][start:end] if end > start else []:
+            amount = self.entities[SubstanceAmount].get(use.amount_id)
+            if amount:
+                uses.append((replace(use), replace(amount)))
+        return uses
+
+    def get_use_amounts(self, substance_tracking_id: int, time_start: int, time_end: int) -> List[Tuple[int, float]]:
+        return [(use.time, amount.amount) for use, amount in self.get_uses_from_time_period(
+            time_start, time_end, substance_tracking_id
+        )]
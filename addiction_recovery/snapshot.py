@@ -0,0 +1,99 @@
+"""
+A small snapshot of the state derived from the substance uses that the app shows as soon as it starts:
+the substance trackings, last week's cost and the goal streak. It is saved when the
+app stops or pauses and only used at start-up while the repository's data version is the one it was
+saved at, so the first screen doesn't have to wait for anything to be calculated from the history.
+
+Everything that only changes with time is saved as of a point in time and brought up to date when
+it's read, e.g. the streak grows.
+"""
+from dataclasses import dataclass, asdict, fields
+import json
+import os
+import time
+from typing import Dict, Optional
+
+from calculations import calculate_goal_streak_start, calculate_weekly_costs, get_streak_days
+from repository import Repository, WEEK_BUCKET
+
+
+@dataclass
+class Snapshot:
+    """
+    Properties:
+        database_id and data_version (of the repository when the snapshot was taken), time (when it was
+        taken), person_id, substance_tracking_ids (substance name -> tracking id), goal_value (None if
+        there isn't a goal), goal_streak_start (see calculate_goal_streak_start), last_week_cost (in
+        pounds, of the week starting at week_start), week_start
+    """
+    database_id: int
+    data_version: int
+    time: int
+    person_id: int
+    substance_tracking_ids: Dict[str, int]
+    goal_value: Optional[int]
+    goal_streak_start: Optional[float]
+    last_week_cost: float
+    week_start: int
+
+    def get_goal_streak_days(self, current_time: int) -> Optional[int]:
+        if self.goal_streak_start is None:
+            return None
+        return get_streak_days(self.goal_streak_start, current_time)
+
+    def get_last_week_cost(self, current_time: int) -> float:
+        # Nothing has been used since the snapshot, so a new week hasn't cost anything yet
+        if current_time - current_time % WEEK_BUCKET != self.week_start:
+            return 0
+        return self.last_week_cost
+
+
+def take_snapshot(person_id: int, substance_tracking_ids: Dict[str, int], current_time: int = None) -> Snapshot:
+    """ Calculates a snapshot of the active repository's derived state. """
+    if current_time is None:
+        current_time = int(time.time())
+    repository = Repository.instance
+    goal = repository.get_goal(1)  # Currently, only one goal is used
+    last_week_cost = 0
+    for tracking_id in substance_tracking_ids.values():
+        weekly_costs = calculate_weekly_costs(tracking_id, current_time)
+        if len(weekly_costs):
+            last_week_cost += weekly_costs[-1][1]
+    return Snapshot(
+        repository.get_database_id(),
+        repository.get_data_version(),
+        current_time,
+        person_id,
+        dict(substance_tracking_ids),
+        goal.value if goal else None,
+        calculate_goal_streak_start(goal, current_time) if goal else None,
+        last_week_cost,
+        current_time - current_time % WEEK_BUCKET
+    )
+
+
+def save_snapshot(snapshot: Snapshot, filepath: str):
+    """ Writes a snapshot to a file, replacing the previous one in one step so it's never half written. """
+    try:
+        with open(f"{filepath}.tmp", "w") as file:
+            json.dump(asdict(snapshot), file)
+        os.replace(f"{filepath}.tmp", filepath)
+    except OSError as e:
+        print(f"\033[91m Error in writing snapshot '{filepath}' : {e.args} \033[0m")
+
+
+def load_snapshot(filepath: str, database_id: int, data_version: int) -> Optional[Snapshot]:
+    """
+    Reads a snapshot from a file.
+
+    :return: the snapshot, or None if there isn't a valid one that was taken of the given database at
+        the given data version
+    """
+    try:
+        with open(filepath) as file:
+            data = json.load(file)
+        if data["database_id"] != database_id or data["data_version"] != data_version:
+            return None
+        return Snapshot(**{field.name: data[field.name] for field in fields(Snapshot)})
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
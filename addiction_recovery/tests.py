@@ -1,44 +1,45 @@
 import unittest
+from abc import ABC, abstractmethod
 import io
+import json
+import math
+import os
+import sqlite3
 import sys
+import tempfile
+import time
+from concurrent.futures import Future
 
 from kivy.clock import Clock
 from kivy.tests.common import GraphicUnitTest
 
 from repository import *
 from entities import *
+from images import *
+from importer import *
+from exporter import *
+from analytics import *
+from snapshot import *
+from reminders import *
+from pharmacokinetics import *
+from calculations import *
+from eventlog import *
+from frameprofiler import *
+import instrumentation
+import migrations
 from main import *
 
 
-class TestSqlRepository(unittest.TestCase):
+class RepositoryTests(ABC):
+    """ Tests that every Repository implementation must pass. """
 
-    def test_repository_start_and_close(self):
-        """
-        Tests whether the repository can be started, closed and whether this sets the Repository
-        singleton's instance.
-        """
-
-        # Test constructor
-        self.assertIsNone(Repository.instance)
-        repository = SqlRepository(filepath=":memory:")
-        self.assertIsNone(repository.cursor)
-        self.assertIsNone(repository.connection)
-        self.assertEqual(Repository.instance, repository)
-
-        # Test start
-        self.assertTrue(repository.start())
-        self.assertIsNotNone(repository.cursor)
-        self.assertIsNotNone(repository.connection)
-
-        # Test close
-        repository.close()
-        self.assertIsNone(repository.cursor)
-        self.assertIsNone(repository.connection)
-        self.assertIsNone(Repository.instance)
+    @abstractmethod
+    def create_repository(self) -> Repository:
+        """ Creates an empty repository of the implementation being tested. """
 
     def test_person(self):
         """ Tests adding and retrieving a person to and from the database. """
-        with SqlRepository(":memory:") as r:
+        with self.create_repository() as r:
             person = Person("name", 1, 10, 100)
             self.assertIsNone(person.id)
             person.id = r.create_person(person)
@@ -48,7 +49,7 @@ class TestSqlRepository(unittest.TestCase):
 
     def test_substance_tracking(self):
         """ Tests adding and retrieving a substance tracking instance to and from the database. """
-        with SqlRepository(":memory:") as r:
+        with self.create_repository() as r:
             substance_tracking = SubstanceTracking(1, 1)
             self.assertIsNone(substance_tracking.id)
             substance_tracking.id = r.create_substance_tracking(substance_tracking)
@@ -58,7 +59,7 @@ class TestSqlRepository(unittest.TestCase):
 
     def test_substance(self):
         """ Tests adding and retrieving a substance to and from the database. """
-        with SqlRepository(":memory:") as r:
+        with self.create_repository() as r:
             substance = Substance("Coffee", 1)
             self.assertIsNone(substance.id)
             substance.id = r.create_substance(substance)
@@ -68,7 +69,7 @@ class TestSqlRepository(unittest.TestCase):
 
     def test_substance_use(self):
         """ Tests adding and retrieving a substance use to and from the database. """
-        with SqlRepository(":memory:") as r:
+        with self.create_repository() as r:
             substance_use = SubstanceUse(1, 1, 0)
             self.assertIsNone(substance_use.id)
             substance_use.id = r.create_substance_use(substance_use)
@@ -78,7 +79,7 @@ class TestSqlRepository(unittest.TestCase):
 
     def test_substance_amount(self):
         """ Tests adding and retrieving a substance amount to and from the database. """
-        with SqlRepository(":memory:") as r:
+        with self.create_repository() as r:
             substance_amount = SubstanceAmount(1, 100, "Small coffee")
             self.assertIsNone(substance_amount.id)
             substance_amount.id = r.create_substance_amount(substance_amount)
@@ -88,7 +89,7 @@ class TestSqlRepository(unittest.TestCase):
 
     def test_goal(self):
         """ Tests adding and retrieving a goal to and from the database. """
-        with SqlRepository(":memory:") as r:
+        with self.create_repository() as r:
             goal = Goal(1, 1, 10, 0)
             self.assertIsNone(goal.id)
             goal.id = r.create_goal(goal)
@@ -98,7 +99,7 @@ class TestSqlRepository(unittest.TestCase):
 
     def test_goal_type(self):
         """ Tests adding and retrieving a goal type to and from the database. """
-        with SqlRepository(":memory:") as r:
+        with self.create_repository() as r:
             goal_type = GoalType("Use limit", "Stay under this amount at all times.")
             self.assertIsNone(goal_type.id)
             goal_type.id = r.create_goal_type(goal_type)
@@ -111,7 +112,7 @@ class TestSqlRepository(unittest.TestCase):
         Tests updating a person's details in the database. This also makes sure that other
         records are unaffected.
         """
-        with SqlRepository(":memory:") as r:
+        with self.create_repository() as r:
             person = Person("name", 1, 10, 100)
             person2 = Person("name 2", 2, 20, 200)
             person.id = r.create_person(person)
@@ -129,7 +130,7 @@ class TestSqlRepository(unittest.TestCase):
         Tests updating a goal's details in the database. This also makes sure that other
         records are unaffected.
         """
-        with SqlRepository(":memory:") as r:
+        with self.create_repository() as r:
             goal = Goal(1, 1, 10, 0)
             goal2 = Goal(2, 1, 20, 20)
             goal.id = r.create_goal(goal)
@@ -147,7 +148,7 @@ class TestSqlRepository(unittest.TestCase):
         Tests that the database can store and retrieve substances tracking instances that are
         linked to their substance through the foreign key.
         """
-        with SqlRepository(":memory:") as r:
+        with self.create_repository() as r:
             actual = []
             person_id = 1
             for substance_name in ("Alcohol", "Coffee", "Nicotine"):
@@ -163,7 +164,7 @@ class TestSqlRepository(unittest.TestCase):
         Tests that the SQL query that retrieves substance amount in the order of how many times
         they have been used (needed to get presets).
         """
-        with SqlRepository(":memory:") as r:
+        with self.create_repository() as r:
             substance_amounts = [
                 SubstanceAmount(1, 100, "small (used least)"),
                 SubstanceAmount(2, 200, "medium (used in the middle)"),
@@ -182,9 +183,44 @@ class TestSqlRepository(unittest.TestCase):
             self.assertEqual([substance_amounts[-1]], r.get_common_substance_amounts(1))
             self.assertEqual([], r.get_common_substance_amounts(0))
 
+    def test_get_common_substance_amounts_for_tracking(self):
+        """ Tests that the most common amounts can be limited to a single substance tracking. """
+        with self.create_repository() as r:
+            coffee = r.get_or_create_amount(SubstanceAmount(1, 100, "coffee"), 1)
+            beer = r.get_or_create_amount(SubstanceAmount(1, 300, "beer"), 2)
+            for i in range(3):
+                r.create_substance_use(SubstanceUse(2, beer, i))
+            r.create_substance_use(SubstanceUse(1, coffee, 0))
+
+            self.assertEqual([coffee], [amount.id for amount in r.get_common_substance_amounts(3, 1)])
+            self.assertEqual([beer], [amount.id for amount in r.get_common_substance_amounts(3, 2)])
+            self.assertEqual([beer, coffee], [amount.id for amount in r.get_common_substance_amounts(3)])
+
+    def test_get_recent_substance_amounts(self):
+        """ Tests that recent uses count for more than old uses when ranking by recency. """
+        with self.create_repository() as r:
+            old = r.get_or_create_amount(SubstanceAmount(1, 100, "old favourite"), 1)
+            new = r.get_or_create_amount(SubstanceAmount(2, 200, "new favourite"), 1)
+            for i in range(5):
+                r.create_substance_use(SubstanceUse(1, old, i))
+            # Two uses a few half-lives later outweigh the five older ones
+            for i in range(2):
+                r.create_substance_use(SubstanceUse(1, new, 4 * RECENCY_HALF_LIFE + i))
+
+            self.assertEqual([old, new], [amount.id for amount in r.get_common_substance_amounts(2)])
+            self.assertEqual([new, old], [amount.id for amount in r.get_recent_substance_amounts(2)])
+            self.assertEqual([new], [amount.id for amount in r.get_recent_substance_amounts(1, 1)])
+            self.assertEqual([], r.get_recent_substance_amounts(2, 2))
+
+    def test_log_add_exp2(self):
+        self.assertAlmostEqual(math.log2(2 ** 3 + 2 ** 5), log_add_exp2(3, 5))
+        self.assertEqual(3, log_add_exp2(None, 3))
+        # Large exponents (e.g. unix timestamps divided by the half-life) don't overflow
+        self.assertAlmostEqual(10001, log_add_exp2(10000, 10000))
+
     def test_get_substance_amount_from_data(self):
         """ Test retrieving a substance amount using what data it contains (used to avoid duplicate presets). """
-        with SqlRepository(":memory:") as r:
+        with self.create_repository() as r:
             tracking_id = 1
             amount = 1
             cost = 1
@@ -199,7 +235,7 @@ class TestSqlRepository(unittest.TestCase):
 
     def test_get_tracking_id_from_amount(self):
         """ Test retrieving the tracking id from a substance amount. """
-        with SqlRepository(":memory:") as r:
+        with self.create_repository() as r:
             tracking_id = 1
             substance_amount = SubstanceAmount(1, 1, "name")
             substance_amount.id = r.create_substance_amount(substance_amount)
@@ -207,9 +243,27 @@ class TestSqlRepository(unittest.TestCase):
             use.id = r.create_substance_use(use)
             self.assertEqual(tracking_id, r.get_tracking_id_from_amount(substance_amount.id))
 
+    def test_get_or_create_amount(self):
+        """ Tests that amounts are only created when the tracking doesn't already have a matching one. """
+        with self.create_repository() as r:
+            amount_id = r.get_or_create_amount(SubstanceAmount(1.0, 100, "small"), 1)
+            self.assertEqual(SubstanceAmount(1.0, 100, "small", amount_id), r.get_substance_amount(amount_id))
+            self.assertEqual(1, r.get_tracking_id_from_amount(amount_id))
+            self.assertEqual(amount_id, r.get_or_create_amount(SubstanceAmount(1.0, 100, "small"), 1))
+
+            # Different data or a different tracking should create a new amount
+            self.assertNotEqual(amount_id, r.get_or_create_amount(SubstanceAmount(1.0, 150, "small"), 1))
+            other_amount_id = r.get_or_create_amount(SubstanceAmount(1.0, 100, "small"), 2)
+            self.assertNotEqual(amount_id, other_amount_id)
+            self.assertEqual(2, r.get_tracking_id_from_amount(other_amount_id))
+
+            # Amounts without a name are matched too
+            unnamed_id = r.get_or_create_amount(SubstanceAmount(3.0, 100, None), 1)
+            self.assertEqual(unnamed_id, r.get_or_create_amount(SubstanceAmount(3.0, 100, None), 1))
+
     def test_get_uses_from_time_period(self):
         """ Tests retrieving substance uses from a given time period. """
-        with SqlRepository(":memory:") as r:
+        with self.create_repository() as r:
             amount = SubstanceAmount(1.0, 1, "name")
             amount.id = r.create_substance_amount(amount)
 
@@ -227,12 +281,1006 @@ class TestSqlRepository(unittest.TestCase):
             self.assertEqual(uses_and_amounts[11:-10], r.get_uses_from_time_period(10, 40, tracking_id))
             self.assertEqual([uses_and_amounts[-1]], r.get_uses_from_time_period(48, 50, tracking_id))
             self.assertEqual([], r.get_uses_from_time_period(49, 100, tracking_id))
+            self.assertEqual([(use.time, 1.0) for use in uses[11:-10]], r.get_use_amounts(tracking_id, 10, 40))
+
+    def test_get_use_buckets(self):
+        """ Tests that uses are summed into buckets with the peak level, including a use added out of order. """
+        with self.create_repository() as r:
+            person_id = r.create_person(Person("name", 1, 10, 100))
+            substance_id = r.create_substance(Substance("a", 60))
+            tracking_id = r.create_substance_tracking(SubstanceTracking(person_id, substance_id))
+            small = r.get_or_create_amount(SubstanceAmount(1.0, 100, "small"), tracking_id)
+            large = r.get_or_create_amount(SubstanceAmount(2.0, 300, "large"), tracking_id)
+            start = 10 * WEEK_BUCKET
+            for use_time, amount_id in ((0, small), (HOUR_BUCKET, small), (2 * DAY_BUCKET, large), (1800, large)):
+                r.create_substance_use(SubstanceUse(tracking_id, amount_id, start + use_time))
+
+            peak = 1 * 0.5 ** 0.5 + 2
+            hours = r.get_use_buckets(tracking_id, HOUR_BUCKET, start, start + DAY_BUCKET)
+            self.assertEqual([(start, 2, 3.0, 400), (start + HOUR_BUCKET, 1, 1.0, 100)],
+                             [(b.start, b.uses, b.amount, b.cost) for b in hours])
+            self.assertAlmostEqual(peak, hours[0].peak_level)
+            self.assertAlmostEqual(peak * 0.5 ** 0.5 + 1, hours[1].peak_level)
+
+            days = r.get_use_buckets(tracking_id, DAY_BUCKET, start + 1, start + WEEK_BUCKET)
+            self.assertEqual([(start + 2 * DAY_BUCKET, 1, 2.0, 300)],
+                             [(b.start, b.uses, b.amount, b.cost) for b in days])
+            self.assertAlmostEqual(2, days[0].peak_level)
+            weeks = r.get_use_buckets(tracking_id, WEEK_BUCKET, 0, start + WEEK_BUCKET)
+            self.assertEqual([(start, 4, 6.0, 800)], [(b.start, b.uses, b.amount, b.cost) for b in weeks])
+
+    def test_get_last_level_peak(self):
+        """ Tests finding the latest use above a level, including after a use is added out of order. """
+        with self.create_repository() as r:
+            person_id = r.create_person(Person("name", 1, 10, 100))
+            substance_id = r.create_substance(Substance("a", 60))
+            tracking_id = r.create_substance_tracking(SubstanceTracking(person_id, substance_id))
+            amount_ids = {
+                a: r.get_or_create_amount(SubstanceAmount(a, 0, str(a)), tracking_id) for a in (1.0, 2.0, 4.0)
+            }
+            for use_time, amount in ((0, 4.0), (HOUR_BUCKET, 1.0), (2 * HOUR_BUCKET, 2.0)):
+                r.create_substance_use(SubstanceUse(tracking_id, amount_ids[amount], use_time))
+
+            self.assertEqual((0, 4.0), r.get_last_level_peak(tracking_id, 3.6))
+            peak_time, level = r.get_last_level_peak(tracking_id, 3.2)
+            self.assertEqual(2 * HOUR_BUCKET, peak_time)
+            self.assertAlmostEqual(3.5, level)
+            self.assertIsNone(r.get_last_level_peak(tracking_id, 4.0))
+
+            r.create_substance_use(SubstanceUse(tracking_id, amount_ids[2.0], HOUR_BUCKET * 3 // 2))
+            peak_time, level = r.get_last_level_peak(tracking_id, 4.5)
+            self.assertEqual(2 * HOUR_BUCKET, peak_time)
+            self.assertAlmostEqual((3 * 0.5 ** 0.5 + 2) * 0.5 ** 0.5 + 2, level)
+
+    def test_calculate_under_goal_time(self):
+        """ Tests predicting when the level will be down to the goal against stepping the level forward. """
+        with self.create_repository() as r:
+            person_id = r.create_person(Person("name", 1, 10, 100))
+            substance_id = r.create_substance(Substance("a", 60))
+            tracking_id = r.create_substance_tracking(SubstanceTracking(person_id, substance_id))
+            amount_id = r.get_or_create_amount(SubstanceAmount(3.0, 100, "small"), tracking_id)
+            goal = Goal(tracking_id, 1, 2, 0)
+            self.assertEqual(100, calculate_under_goal_time(goal, 100))
+
+            for use_time in (0, HOUR_BUCKET // 2, HOUR_BUCKET):
+                r.create_substance_use(SubstanceUse(tracking_id, amount_id, use_time))
+            now = HOUR_BUCKET + 60
+            under_goal_time = calculate_under_goal_time(goal, now)
+            self.assertAlmostEqual(goal.value, calculate_current_level(tracking_id, int(under_goal_time)), delta=0.01)
+            self.assertLess(goal.value, calculate_current_level(tracking_id, int(under_goal_time) - 60))
+            self.assertEqual(under_goal_time + 1, calculate_under_goal_time(goal, under_goal_time + 1))
+
+            goal.value = 0
+            self.assertEqual(math.inf, calculate_under_goal_time(goal, now))
+
+    def test_compact_uses(self):
+        """ Tests that costs, streaks and usage counts are the same after compacting and rebuilding the aggregates. """
+        with self.create_repository() as r:
+            person_id = r.create_person(Person("name", 1, 10, 100))
+            substance_id = r.create_substance(Substance("a", 60))
+            tracking_id = r.create_substance_tracking(SubstanceTracking(person_id, substance_id))
+            small = r.get_or_create_amount(SubstanceAmount(1.0, 100, "small"), tracking_id)
+            large = r.get_or_create_amount(SubstanceAmount(3.0, 300, "large"), tracking_id)
+            start = 10 * WEEK_BUCKET
+            for i in range(50):
+                amount_id = large if i % 10 == 0 else small
+                r.create_substance_use(SubstanceUse(tracking_id, amount_id, start + i * DAY_BUCKET // 2))
+            now = start + 30 * DAY_BUCKET
+            goal = Goal(tracking_id, 1, 2.5, 0)
+            weekly_costs = calculate_weekly_costs(tracking_id, now)
+            self.assertEqual(9, calculate_goal_streak_days(goal, now))
+
+            # MemoryRepository doesn't compact anything
+            deleted = r.compact_uses(start + 3 * WEEK_BUCKET + DAY_BUCKET)
+            self.assertIn(deleted, (0, 42))
+            self.assertEqual(50 - deleted, len(r.get_uses_from_time_period(0, now, tracking_id)))
+            self.assertEqual(weekly_costs, calculate_weekly_costs(tracking_id, now))
+            self.assertEqual(9, calculate_goal_streak_days(goal, now))
+
+            # A use from before the horizon still counts towards the costs
+            r.create_substance_use(SubstanceUse(tracking_id, small, start + DAY_BUCKET))
+            r.rebuild_aggregates()
+            self.assertEqual(weekly_costs[0][1] + 1, calculate_weekly_costs(tracking_id, now)[0][1])
+            self.assertEqual([small, large], [a.id for a in r.get_common_substance_amounts(2)])
+            self.assertEqual(9, calculate_goal_streak_days(goal, now))
+
+    def test_data_version(self):
+        """ Tests that the data version changes when data is added or updated but not when it's read. """
+        with self.create_repository() as r:
+            versions = [r.get_data_version()]
+            person_id = r.create_person(Person("name", 1, 10, 100))
+            versions.append(r.get_data_version())
+            substance_id = r.create_substance(Substance("a", 60))
+            tracking_id = r.create_substance_tracking(SubstanceTracking(person_id, substance_id))
+            amount_id = r.get_or_create_amount(SubstanceAmount(1.0, 100, "small"), tracking_id)
+            goal = Goal(tracking_id, 1, 2, 0)
+            goal.id = r.create_goal(goal)
+            versions.append(r.get_data_version())
+            r.create_substance_use(SubstanceUse(tracking_id, amount_id, 10))
+            versions.append(r.get_data_version())
+            r.get_uses_from_time_period(0, 100, tracking_id)
+            r.get_goal(goal.id)
+            self.assertEqual(versions[-1], r.get_data_version())
+            goal.value = 3
+            r.update_goal(goal)
+            versions.append(r.get_data_version())
+            self.assertEqual(len(versions), len(set(versions)))
+
+
+class TestSqlRepository(RepositoryTests, unittest.TestCase):
+
+    def create_repository(self) -> Repository:
+        return SqlRepository(":memory:")
+
+    def test_repository_start_and_close(self):
+        """
+        Tests whether the repository can be started, closed and whether this sets the Repository
+        singleton's instance.
+        """
+
+        # Test constructor
+        self.assertIsNone(Repository.instance)
+        repository = SqlRepository(filepath=":memory:")
+        self.assertIsNone(repository.cursor)
+        self.assertIsNone(repository.connection)
+        self.assertEqual(Repository.instance, repository)
+
+        # Test start
+        self.assertTrue(repository.start())
+        self.assertIsNotNone(repository.cursor)
+        self.assertIsNotNone(repository.connection)
+
+        # Test close
+        repository.close()
+        self.assertIsNone(repository.cursor)
+        self.assertIsNone(repository.connection)
+        self.assertIsNone(Repository.instance)
+
+    def test_start_established_database(self):
+        """ Tests that starting a database that's already up to date only checks its version. """
+        statements = []
+
+        class TracedSqlRepository(SqlRepository):
+            def connect(self):
+                super().connect()
+                self.connection.set_trace_callback(statements.append)
+
+        with tempfile.TemporaryDirectory() as directory:
+            filepath = os.path.join(directory, "database.db")
+            with TracedSqlRepository(filepath):
+                self.assertIn("PRAGMA journal_mode = WAL;", statements)
+                self.assertTrue(any(statement.strip().startswith("CREATE") for statement in statements))
+            statements.clear()
+            with TracedSqlRepository(filepath) as repository:
+                self.assertEqual(["PRAGMA user_version;"], statements)
+                self.assertEqual("wal", repository.cursor.execute("PRAGMA journal_mode;").fetchone()[0])
+                self.assertEqual(migrations.latest_version(), migrations.get_version(repository.cursor))
+
+    def test_pause_and_resume(self):
+        """ Tests that pausing checkpoints the write-ahead log and resuming reopens a closed repository. """
+        with tempfile.TemporaryDirectory() as directory:
+            filepath = os.path.join(directory, "database.db")
+            repository = SqlRepository(filepath)
+            self.assertTrue(repository.resume())
+            person_id = repository.create_person(Person("name", 1, 10, 100))
+            self.assertLess(0, os.path.getsize(f"{filepath}-wal"))
+
+            repository.pause()
+            self.assertEqual(0, os.path.getsize(f"{filepath}-wal"))
+            connection = repository.connection
+            self.assertTrue(repository.resume())
+            self.assertIs(connection, repository.connection)
+
+            repository.close()
+            self.assertIsNone(Repository.instance)
+            self.assertTrue(repository.resume())
+            self.assertEqual(repository, Repository.instance)
+            self.assertEqual("name", repository.get_person(person_id).name)
+            repository.close()
+
+    def test_out_of_order_use_rolled_back(self):
+        """ Tests that an out of order use isn't added if its use buckets can't be recalculated. """
+
+        class FailingRepository(SqlRepository):
+            def fill_use_buckets(self, tracking_id, since=None):
+                raise sqlite3.OperationalError("disk I/O error")
+
+        with FailingRepository(":memory:") as r:
+            person_id = r.create_person(Person("name", 1, 10, 100))
+            substance_id = r.create_substance(Substance("a", 60))
+            tracking_id = r.create_substance_tracking(SubstanceTracking(person_id, substance_id))
+            amount_id = r.get_or_create_amount(SubstanceAmount(1.0, 100, "small"), tracking_id)
+            r.create_substance_use(SubstanceUse(tracking_id, amount_id, 2 * DAY_BUCKET))
+            buckets = r.get_use_buckets(tracking_id, DAY_BUCKET, 0, 3 * DAY_BUCKET)
+            output = io.StringIO()
+            sys.stdout = output
+            self.assertEqual(-1, r.create_substance_use(SubstanceUse(tracking_id, amount_id, DAY_BUCKET)))
+            sys.stdout = sys.__stdout__
+            self.assertIn("disk I/O error", output.getvalue())
+            self.assertEqual(1, len(r.get_uses_from_time_period(0, 3 * DAY_BUCKET, tracking_id)))
+            self.assertEqual(buckets, r.get_use_buckets(tracking_id, DAY_BUCKET, 0, 3 * DAY_BUCKET))
+
+    def test_migrate_interrupted_backfill(self):
+        """ Tests that an interrupted batched backfill carries on to the same result as a full rebuild. """
+        with SqlRepository(":memory:") as r:
+            person_id = r.create_person(Person("name", 1, 10, 100))
+            substance_id = r.create_substance(Substance("a", 1))
+            tracking_id = r.create_substance_tracking(SubstanceTracking(person_id, substance_id))
+            amount_ids = [r.create_substance_amount(SubstanceAmount(i, 10, str(i))) for i in range(3)]
+            r.create_substance_uses(SubstanceUse(tracking_id, amount_ids[i % 3], i) for i in range(10))
+            r.rebuild_aggregates()
+            query = "SELECT * FROM SubstanceAmountUsage ORDER BY amount_id;"
+            expected = r.try_execute_query(query, ())
+
+            # Downgrade to a database from before the usage counts existed
+            r.cursor.execute("DROP TABLE SubstanceAmountUsage;")
+            r.cursor.execute("PRAGMA user_version = 2;")
+            step = migrations.MIGRATIONS[2]
+            backfill = step.backfill
+            batches = []
+
+            def fail_on_second_batch(repository, after_id, last_id):
+                batches.append(after_id)
+                if len(batches) == 2:
+                    raise sqlite3.OperationalError("interrupted")
+                backfill(repository, after_id, last_id)
+
+            step.backfill = fail_on_second_batch
+            try:
+                with self.assertRaises(sqlite3.Error):
+                    migrations.migrate(r, target_version=3, batch_size=4)
+            finally:
+                step.backfill = backfill
+            self.assertEqual(2, migrations.get_version(r.cursor))
+            self.assertEqual(1, migrations.migrate(r, target_version=3, batch_size=4))
+            self.assertEqual(3, migrations.get_version(r.cursor))
+            self.assertEqual(expected, r.try_execute_query(query, ()))
+            self.assertEqual([], r.try_execute_query("SELECT * FROM MigrationProgress;", ()))
+
+    def test_migrate_compact_storage(self):
+        """ Tests that uses keep their ids and duplicated amounts are merged when moving to compact storage. """
+        r = SqlRepository(":memory:")
+        r.connect()
+        migrations.migrate(r, target_version=3)
+        r.cursor.executemany(
+            "INSERT INTO SubstanceAmount(amount, cost, name) VALUES (?, ?, ?);",
+            [(1.5, 100, "small"), (1.5, 100, "small"), (2.25, 200, None), (2.25, 200, None), (2.25, 200, None)]
+        )
+        r.cursor.executemany(
+            "INSERT INTO SubstanceUse(substance_tracking_id, amount_id, time) VALUES (?, ?, ?);",
+            [(1, 1, 10), (1, 2, 5), (1, 3, 20), (1, 2, 30), (1, 4, 40), (1, 5, 50)]
+        )
+        # The aggregates as they were at version 3
+        r.fill_substance_presets()
+        r.fill_substance_amount_usage()
+        r.connection.commit()
+
+        migrations.migrate(r, batch_size=2)
+        self.assertEqual(migrations.latest_version(), migrations.get_version(r.cursor))
+        uses = r.get_uses_from_time_period(0, 100, 1)
+        self.assertEqual(
+            [(2, 1), (1, 1), (3, 3), (4, 1), (5, 3), (6, 3)], [(use.id, use.amount_id) for use, _ in uses]
+        )
+        self.assertIsNone(r.get_substance_amount(2))
+        self.assertEqual(SubstanceAmount(2.25, 200, None, 3), r.get_substance_amount(3))
+        self.assertIsNone(r.get_substance_amount(4))
+        self.assertIsNone(r.get_substance_amount(5))
+        self.assertEqual([("integer",)] * 2, r.try_execute_query("SELECT typeof(amount) FROM SubstanceAmount;", ()))
+        self.assertEqual([3, 1], [amount.id for amount in r.get_common_substance_amounts(4)])
+        self.assertEqual(7, r.create_substance_use(SubstanceUse(1, 1, 60)))
+        r.close()
+
+    def test_migrate_unnamed_presets(self):
+        """ Tests that duplicated presets without a name are merged and can't be added again. """
+        r = SqlRepository(":memory:")
+        r.connect()
+        migrations.migrate(r, target_version=8)
+        r.cursor.executemany(
+            "INSERT INTO SubstancePreset(substance_tracking_id, amount_id, amount, cost, name) VALUES (?, ?, ?, ?, ?);",
+            [(1, 1, 1000, 100, None), (1, 2, 1000, 100, None), (1, 3, 1000, 100, "named")]
+        )
+        r.connection.commit()
+
+        migrations.migrate(r)
+        self.assertEqual([(1,), (3,)], r.try_execute_query("SELECT amount_id FROM SubstancePreset ORDER BY rowid;", ()))
+        self.assertEqual(1, r.get_or_create_amount(SubstanceAmount(1.0, 100, None), 1))
+        r.close()
+
+    def test_get_or_create_amount_atomic(self):
+        """ Tests that an amount isn't created if its preset can't be. """
+
+        class FailingRepository(SqlRepository):
+            def execute_command(self, command, parameters):
+                if "SubstancePreset" in command:
+                    raise sqlite3.OperationalError("disk I/O error")
+                super().execute_command(command, parameters)
+
+        with FailingRepository(":memory:") as r:
+            output = io.StringIO()
+            sys.stdout = output
+            self.assertEqual(-1, r.get_or_create_amount(SubstanceAmount(1.0, 100, "small"), 1))
+            sys.stdout = sys.__stdout__
+            self.assertIn("disk I/O error", output.getvalue())
+            self.assertEqual([], r.try_execute_query("SELECT * FROM SubstanceAmount;", ()))
+
+
+class TestMemoryRepository(RepositoryTests, unittest.TestCase):
+
+    def create_repository(self) -> Repository:
+        return MemoryRepository()
+
+
+class TestEventLogRepository(RepositoryTests, unittest.TestCase):
+
+    def setUp(self):
+        self.log_directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.log_directory.cleanup()
+
+    def create_repository(self) -> Repository:
+        return EventLogRepository(":memory:", self.log_directory.name)
+
+    def test_out_of_order_uses(self):
+        """ Tests that uses logged out of order are kept sorted by time. """
+        with self.create_repository() as r:
+            amount_id = r.create_substance_amount(SubstanceAmount(1.0, 1, "name"))
+            use_ids = [r.create_substance_use(SubstanceUse(1, amount_id, t)) for t in (10, 30, 20, 5, 30)]
+            r.create_substance_uses([SubstanceUse(1, amount_id, t) for t in (25, 1)])
+            times = [use.time for use, _ in r.get_uses_from_time_period(0, 100, 1)]
+            self.assertEqual([1, 5, 10, 20, 25, 30, 30], times)
+            self.assertEqual(SubstanceUse(1, amount_id, 20, use_ids[2]), r.get_substance_use(use_ids[2]))
+
+    def test_reopen(self):
+        """ Tests that uses are kept in the log files when the repository is closed and new ids follow on. """
+        database = os.path.join(self.log_directory.name, "database.db")
+        with EventLogRepository(database, self.log_directory.name) as r:
+            amount_id = r.create_substance_amount(SubstanceAmount(1.0, 1, "name"))
+            first_id = r.create_substance_use(SubstanceUse(1, amount_id, 10))
+        with EventLogRepository(database, self.log_directory.name) as r:
+            self.assertEqual(1, len(r.get_uses_from_time_period(0, 100, 1)))
+            self.assertEqual(first_id + 1, r.create_substance_use(SubstanceUse(1, amount_id, 20)))
+
+    def test_interrupted_compaction(self):
+        """ Tests that uses left in a log after their compaction was committed are ignored, then removed. """
+
+        class InterruptedRepository(EventLogRepository):
+            def remove_compacted_uses(self, tracking_ids, before_time):
+                pass
+
+        database = os.path.join(self.log_directory.name, "database.db")
+        with InterruptedRepository(database, self.log_directory.name) as r:
+            person_id = r.create_person(Person("name", 1, 10, 100))
+            substance_id = r.create_substance(Substance("a", 60))
+            tracking_id = r.create_substance_tracking(SubstanceTracking(person_id, substance_id))
+            amount_id = r.get_or_create_amount(SubstanceAmount(1.0, 100, "small"), tracking_id)
+            for i in range(10):
+                r.create_substance_use(SubstanceUse(tracking_id, amount_id, i * DAY_BUCKET))
+            self.assertEqual(7, r.compact_uses(WEEK_BUCKET))
+            self.assertEqual(10, len(r.get_log(tracking_id)))
+            r.rebuild_aggregates()
+            usage = r.cursor.execute("SELECT uses FROM SubstanceAmountUsage WHERE amount_id = ?;", (amount_id,))
+            self.assertEqual((10,), usage.fetchone())
+        with EventLogRepository(database, self.log_directory.name) as r:
+            self.assertEqual(3, len(r.get_log(tracking_id)))
+
+
+class TestImporter(unittest.TestCase):
+
+    def create_tracking(self, r):
+        person_id = r.create_person(Person("name", 1, 10, 100))
+        substance_id = r.create_substance(Substance("Coffee", 1))
+        return person_id, r.create_substance_tracking(SubstanceTracking(person_id, substance_id))
+
+    def test_import_csv(self):
+        """ Tests importing a CSV file, including reusing amounts and skipping invalid rows. """
+        with tempfile.TemporaryDirectory() as directory, SqlRepository(":memory:") as r:
+            person_id, tracking_id = self.create_tracking(r)
+            filepath = os.path.join(directory, "history.csv")
+            with open(filepath, "w") as file:
+                file.write("substance,time,amount,cost,name\n")
+                file.write("Coffee,10,1,2.50,small\n")
+                file.write("Coffee,20,1,2.50,small\n")
+                file.write("Coffee,1970-01-01T00:00:30+00:00,2,3.00,large\n")
+                file.write("Cauliflower,40,1,1.00,\n")
+                file.write("Coffee,50,text,1.00,\n")
+
+            self.assertEqual(ImportResult(3, 2), import_file(r, filepath, person_id, batch_size=2))
+            uses = r.get_uses_from_time_period(0, 100, tracking_id)
+            self.assertEqual([10, 20, 30], [use.time for use, _ in uses])
+            self.assertEqual(uses[0][1], uses[1][1])
+            self.assertEqual(
+                [SubstanceAmount(1.0, 250, "small"), SubstanceAmount(2.0, 300, "large")],
+                [SubstanceAmount(a.amount, a.cost, a.name) for a in r.get_common_substance_amounts(2)]
+            )
+
+    def test_import_json(self):
+        """ Tests that JSON arrays and JSON Lines are both read incrementally. """
+        records = [{"substance": "Coffee", "time": i, "amount": 1, "cost": 1} for i in range(1, 100)]
+        self.assertEqual(records, list(read_json(io.StringIO(json.dumps(records)), chunk_size=7)))
+        lines = "\n".join(json.dumps(record) for record in records)
+        self.assertEqual(records, list(read_json(io.StringIO(lines), chunk_size=7)))
+
+
+class TestExporter(unittest.TestCase):
+
+    def test_export_columns(self):
+        """ Tests exporting the use history in several chunks and reading it back. """
+        with tempfile.TemporaryDirectory() as directory, SqlRepository(":memory:") as r:
+            person_id = r.create_person(Person("name", 1, 10, 100))
+            tracking_id = r.create_substance_tracking(
+                SubstanceTracking(person_id, r.create_substance(Substance("Coffee", 1)))
+            )
+            small = r.get_or_create_amount(SubstanceAmount(1.5, 100, "small"), tracking_id)
+            large = r.get_or_create_amount(SubstanceAmount(3.0, 200, "large"), tracking_id)
+            for i in range(10):
+                r.create_substance_use(SubstanceUse(tracking_id, small if i % 3 else large, i))
+
+            filepath = os.path.join(directory, "uses.bin")
+            self.assertEqual(10, export_history(r, filepath, chunk_size=4))
+            columns = read_columns(filepath)
+            self.assertEqual(list(range(10)), columns["time"])
+            self.assertEqual(["Coffee"] * 10, columns["substance"])
+            self.assertEqual([3.0, 1.5, 1.5, 3.0], columns["amount"][:4])
+            self.assertEqual(["large", "small", "small", "large"], columns["name"][:4])
+            self.assertEqual([person_id] * 10, columns["person_id"])
+
+
+class TestAnalytics(unittest.TestCase):
+
+    def test_summarise_databases(self):
+        """ Tests summarising a database with a goal and one without a person in a process pool. """
+        with tempfile.TemporaryDirectory() as directory:
+            filepath = os.path.join(directory, "user.db")
+            with SqlRepository(filepath) as r:
+                person_id = r.create_person(Person("name", 1, 10, 100))
+                tracking_id = r.create_substance_tracking(
+                    SubstanceTracking(person_id, r.create_substance(Substance("Coffee", 60)))
+                )
+                amount_id = r.get_or_create_amount(SubstanceAmount(2, 150, "mug"), tracking_id)
+                r.create_substance_use(SubstanceUse(tracking_id, amount_id, 1_000_000 - 60 * 60))
+                r.create_goal(Goal(tracking_id, 1, 10, 0))
+            empty_filepath = os.path.join(directory, "empty.db")
+            SqlRepository(empty_filepath).close()
+
+            summary, = summarise_database(filepath, 1_000_000)
+            self.assertEqual(("Coffee", 1.5, 10), (summary.substance, summary.last_week_cost, summary.goal))
+            self.assertAlmostEqual(1, summary.current_level)
+            # Already under the goal
+            self.assertEqual(1_000_000, summary.under_goal_time)
+            self.assertEqual([], summarise_database(empty_filepath, 1_000_000))
+
+            # Databases are only read, so missing and out of date ones are skipped instead of created or upgraded
+            missing_filepath = os.path.join(directory, "missing.db")
+            self.assertEqual([], summarise_database(missing_filepath, 1_000_000))
+            self.assertFalse(os.path.exists(missing_filepath))
+            old_filepath = os.path.join(directory, "old.db")
+            with SqlRepository(old_filepath) as r:
+                r.create_person(Person("name", 1, 10, 100))
+                r.cursor.execute("PRAGMA user_version = 1;")
+            self.assertEqual([], summarise_database(old_filepath, 1_000_000))
+            with SqlRepository(old_filepath, read_only=True) as r:
+                self.assertFalse(r.migrated)
+                self.assertEqual(1, migrations.get_version(r.cursor))
+
+            output_filepath = os.path.join(directory, "summary.db")
+            self.assertEqual(1, run(output_filepath, [filepath, empty_filepath], processes=1))
+            with SqlRepository(output_filepath) as r:
+                rows = r.try_execute_query("SELECT database, substance FROM SubstanceSummary;", ())
+            self.assertEqual([(filepath, "Coffee")], rows)
+
+
+class TestSnapshot(unittest.TestCase):
+
+    def test_snapshot(self):
+        """ Tests that a snapshot is only loaded at the same data version and is brought up to date with time. """
+        with tempfile.TemporaryDirectory() as directory, SqlRepository(":memory:") as r:
+            person_id = r.create_person(Person("name", 1, 10, 100))
+            substance_id = r.create_substance(Substance("a", 60))
+            tracking_id = r.create_substance_tracking(SubstanceTracking(person_id, substance_id))
+            amount_id = r.get_or_create_amount(SubstanceAmount(4.0, 250, "large"), tracking_id)
+            start = 10 * WEEK_BUCKET
+            r.create_substance_use(SubstanceUse(tracking_id, amount_id, start))
+            goal = Goal(tracking_id, 1, 1, 0)
+            r.create_goal(goal)
+            now = start + DAY_BUCKET
+
+            snapshot = take_snapshot(person_id, {"a": tracking_id}, now)
+            filepath = os.path.join(directory, "snapshot.json")
+            save_snapshot(snapshot, filepath)
+            self.assertEqual(snapshot, load_snapshot(filepath, r.get_database_id(), r.get_data_version()))
+            self.assertEqual(2.5, snapshot.get_last_week_cost(now))
+            self.assertEqual(0, snapshot.get_last_week_cost(start + WEEK_BUCKET))
+            later = now + 3 * DAY_BUCKET
+            self.assertEqual(calculate_goal_streak_days(goal, later), snapshot.get_goal_streak_days(later))
+
+            r.create_substance_use(SubstanceUse(tracking_id, amount_id, now))
+            self.assertIsNone(load_snapshot(filepath, r.get_database_id(), r.get_data_version()))
+
+    def test_snapshot_after_reset(self):
+        """ Tests that a snapshot isn't loaded after the database is reset, even when it's at the same data version. """
+        with tempfile.TemporaryDirectory() as directory, SqlRepository(":memory:") as r:
+            filepath = os.path.join(directory, "snapshot.json")
+            save_snapshot(take_snapshot(-1, {}), filepath)
+            database_id = r.get_database_id()
+            r.reset()
+            self.assertNotEqual(database_id, r.get_database_id())
+            self.assertEqual(0, r.get_data_version())
+            self.assertIsNone(load_snapshot(filepath, r.get_database_id(), r.get_data_version()))
+
+
+class TestGraphSeries(unittest.TestCase):
+
+    def test_graph_series(self):
+        """ Tests that the graphs calculated from one fetch match those read separately for each graph. """
+        with SqlRepository(":memory:") as r:
+            person_id = r.create_person(Person("name", 1, 10, 100))
+            substance_id = r.create_substance(Substance("Coffee", 300))
+            tracking_id = r.create_substance_tracking(SubstanceTracking(person_id, substance_id))
+            amount_id = r.get_or_create_amount(SubstanceAmount(2.0, 150, "mug"), tracking_id)
+            now = 100 * WEEK_BUCKET + 12345
+            for i in range(60):
+                r.create_substance_use(SubstanceUse(tracking_id, amount_id, now - i * 7 * HOUR_BUCKET))
+
+            week = 7 * DAY_BUCKET
+            inputs = fetch_graph_inputs(tracking_id, now, week)
+            for previous, time_start in ((False, now - week), (True, now - 2 * week)):
+                uses = r.get_uses_from_time_period(time_start, time_start + week, tracking_id)
+                points = [((use.time - time_start) / DAY_BUCKET, amount.amount) for use, amount in uses]
+                self.assertEqual(calculate_graph(points, tracking_id), calculate_level_series(inputs, previous))
+            self.assertEqual(calculate_weekly_costs(tracking_id, now), calculate_cost_series(inputs))
+
+            month = 30 * DAY_BUCKET
+            inputs = fetch_graph_inputs(tracking_id, now, month, HOUR_BUCKET, DAY_BUCKET)
+            for previous, time_start in ((False, now - month), (True, now - 2 * month)):
+                levels = calculate_bucket_series(
+                    tracking_id, HOUR_BUCKET, time_start, time_start + month, lambda b: b.peak_level
+                )
+                self.assertEqual(levels, calculate_level_series(inputs, previous))
+            self.assertEqual(
+                calculate_bucket_series(tracking_id, DAY_BUCKET, now - month, now, lambda b: b.cost / 100),
+                calculate_cost_series(inputs)
+            )
+
+
+class TestPharmacokinetics(unittest.TestCase):
+
+    def test_models(self):
+        """ Tests each model's level against its formula and that its curve agrees with the levels. """
+        doses = [(0, 4.0), (30, 2.0), (300, 1.0)]
+        first_order = FirstOrderElimination(60)
+        self.assertAlmostEqual(4 * 0.5 ** 2 + 2 * 0.5 ** 1.5, first_order.level_at(doses, 120))
+
+        # The Bateman function, D ka / (ka - ke) (exp(-ke t) - exp(-ka t)), peaks at ln(ka / ke) / (ka - ke)
+        bateman = BatemanAbsorption(60, 10)
+        ka, ke = math.log(2) / 10, math.log(2) / 60
+        peak_time = math.log(ka / ke) / (ka - ke)
+        self.assertEqual(0, bateman.level_at(doses[:1], 0))
+        self.assertAlmostEqual(
+            4 * ka / (ka - ke) * (math.exp(-ke * peak_time) - math.exp(-ka * peak_time)),
+            bateman.level_at(doses[:1], peak_time)
+        )
+        self.assertLess(bateman.level_at(doses[:1], peak_time - 1), bateman.level_at(doses[:1], peak_time))
+        self.assertLess(bateman.level_at(doses[:1], peak_time + 1), bateman.level_at(doses[:1], peak_time))
+        # With equal half-lives it's D k t exp(-k t)
+        self.assertAlmostEqual(math.log(2) / 2, BatemanAbsorption(60, 60).level_at([(0, 1)], 60))
+
+        # One unit an hour
+        widmark = WidmarkElimination(240, 1)
+        self.assertAlmostEqual(4.5, widmark.level_at(doses, 90))
+        self.assertAlmostEqual(2, widmark.level_at(doses, 300))
+        self.assertEqual(0, widmark.level_at(doses, 420))
+
+        for model in (first_order, bateman, widmark):
+            points = model.curve(doses, 5)
+            self.assertTrue(all(level > CURVE_THRESHOLD for _, level in points), model.name)
+            for t, level in points[::10]:
+                self.assertAlmostEqual(model.level_at(doses, t), level, msg=model.name)
+            self.assertLess(model.level_at(doses, points[-1][0] + 5), CURVE_THRESHOLD)
+        self.assertEqual([], first_order.curve([], 5))
+
+    def test_substance_models(self):
+        """ Tests that the app's substances use their registered models and that others decay exponentially. """
+        self.assertEqual({"first_order", "bateman", "widmark"}, set(MODELS))
+        for name, (half_life, model_name, _) in SUBSTANCE_MODELS.items():
+            model = get_substance_model(Substance(name, half_life))
+            self.assertEqual(model_name, model.name)
+            self.assertEqual(half_life, model.half_life)
+        self.assertIsInstance(get_substance_model(Substance("other", 60)), FirstOrderElimination)
+        self.assertIsInstance(get_substance_model(Substance("Coffee", 0)), FirstOrderElimination)
+        # The elimination rate of Widmark's model depends on the amounts' unit, which presets don't have
+        self.assertIsInstance(get_substance_model(Substance("Alcohol", 240)), FirstOrderElimination)
+
+
+class FakeClock:
+    """ Stands in for Kivy's Clock and time.time, only moving forward when advanced. """
+
+    class Event:
+        def __init__(self, clock, callback, due: float):
+            self.clock = clock
+            self.callback = callback
+            self.due = due
+
+        def cancel(self):
+            if self in self.clock.events:
+                self.clock.events.remove(self)
+
+    def __init__(self, now: float = 0):
+        self.now = now
+        self.events = []
+
+    def time(self) -> float:
+        return self.now
+
+    def schedule_once(self, callback, timeout: float = 0):
+        event = FakeClock.Event(self, callback, self.now + timeout)
+        self.events.append(event)
+        return event
+
+    def advance(self, seconds: float):
+        """ Moves the time forward, calling the callbacks that become due in order. """
+        end = self.now + seconds
+        while len(self.events) and min(event.due for event in self.events) <= end:
+            event = min(self.events, key=lambda e: e.due)
+            self.events.remove(event)
+            self.now = event.due
+            event.callback(0)
+        self.now = end
+
+
+class TestReminderScheduler(unittest.TestCase):
+
+    def test_reminders(self):
+        """ Tests that one timer is set for the next reminder and that each reminder is only sent once. """
+        with SqlRepository(":memory:") as r:
+            person_id = r.create_person(Person("name", 1, 10, 100))
+            substance_id = r.create_substance(Substance("a", 60))
+            tracking_id = r.create_substance_tracking(SubstanceTracking(person_id, substance_id))
+            amount_id = r.get_or_create_amount(SubstanceAmount(8.0, 250, "large"), tracking_id)
+            clock = FakeClock(1000)
+            sent = []
+            reminders = ReminderScheduler(sent.append, clock, clock.time, check_in_after=DAY_BUCKET)
+
+            # Nothing has been used, so the only reminder is to check in
+            reminders.schedule([tracking_id])
+            self.assertEqual((1000 + DAY_BUCKET, CHECK_IN_MESSAGE), reminders.next_reminder)
+            self.assertEqual(1, len(clock.events))
+
+            # Recovered when half of the level has decayed, which takes one half-life
+            r.create_substance_use(SubstanceUse(tracking_id, amount_id, 2000))
+            reminders.schedule([tracking_id])
+            self.assertEqual((2000 + 3600, RECOVERY_MESSAGE), reminders.next_reminder)
+            self.assertEqual(1, len(clock.events))
+
+            # Or when the level has decayed down to the goal, from 8 to 1 in three half-lives
+            r.create_goal(Goal(tracking_id, 1, 1, 0))
+            reminders.schedule([tracking_id])
+            self.assertAlmostEqual(2000 + 3 * 3600, reminders.next_reminder[0])
+
+            clock.advance(DAY_BUCKET)
+            self.assertEqual([RECOVERY_MESSAGE], sent)
+            # A day after the last reminder, which was later than the last use
+            self.assertAlmostEqual(2000 + 3 * 3600 + DAY_BUCKET, reminders.next_reminder[0])
+            clock.advance(2 * DAY_BUCKET)
+            self.assertEqual([RECOVERY_MESSAGE, CHECK_IN_MESSAGE, CHECK_IN_MESSAGE], sent)
+
+            reminders.cancel()
+            self.assertEqual([], clock.events)
+            clock.advance(DAY_BUCKET)
+            self.assertEqual(3, len(sent))
+
+    def test_reminder_service(self):
+        """ Tests that the reminder service carries on from the app and that the app doesn't resend its reminders. """
+        with tempfile.TemporaryDirectory() as directory, SqlRepository(":memory:") as r:
+            person_id = r.create_person(Person("name", 1, 10, 100))
+            substance_id = r.create_substance(Substance("a", 60))
+            tracking_id = r.create_substance_tracking(SubstanceTracking(person_id, substance_id))
+            amount_id = r.get_or_create_amount(SubstanceAmount(8.0, 250, "large"), tracking_id)
+            r.create_substance_use(SubstanceUse(tracking_id, amount_id, 2000))
+            sent_until_filepath = os.path.join(directory, "database.db.reminders")
+            clock = FakeClock(1000)
+            app_sent = []
+            app = ReminderScheduler(app_sent.append, clock, clock.time, DAY_BUCKET, sent_until_filepath)
+            app.schedule([tracking_id])
+
+            # The app is paused, so its alarm starts the service, which sends the reminder instead
+            argument = json.loads(app.get_alarm_argument("database.db"))
+            self.assertEqual("database.db", argument["database"])
+            service_clock = FakeClock(2000 + 3600)
+            service_sent = []
+            service = ReminderScheduler(service_sent.append, service_clock, service_clock.time, DAY_BUCKET)
+            service.restore(argument)
+            service.send()
+            self.assertEqual([RECOVERY_MESSAGE], service_sent)
+            self.assertEqual(CHECK_IN_MESSAGE, service.next_reminder[1])
+
+            clock.now = 2000 + 7200
+            app.schedule([tracking_id])
+            self.assertEqual(CHECK_IN_MESSAGE, app.next_reminder[1])
+            self.assertEqual([], app_sent)
+
+
+class FakeExecutor:
+    """ Stands in for the graph workers, only starting and finishing the calculations when asked to. """
+
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, function, *args) -> Future:
+        future = Future()
+        self.submitted.append((future, function, args))
+        return future
+
+    def start(self):
+        """ Starts the calculations that haven't been cancelled, after which they can't be. """
+        for future, _, _ in self.submitted:
+            if not future.done() and not future.running():
+                future.set_running_or_notify_cancel()
+
+    def finish(self):
+        self.start()
+        submitted, self.submitted = self.submitted, []
+        for future, function, args in submitted:
+            if future.running():
+                future.set_result(function(*args))
+
+
+class TestGraphPrefetch(unittest.TestCase):
+
+    def setUp(self):
+        self.repository = SqlRepository(":memory:")
+        self.repository.start()
+        r = self.repository
+        person_id = r.create_person(Person("name", 1, 10, 100))
+        now = int(time.time())
+        AddictionRecovery.substance_tracking_ids = {}
+        for name in ("a", "b", "c"):
+            substance_id = r.create_substance(Substance(name, 60))
+            tracking_id = r.create_substance_tracking(SubstanceTracking(person_id, substance_id))
+            amount_id = r.get_or_create_amount(SubstanceAmount(1.0, 100, name), tracking_id)
+            for i in range(5):
+                r.create_substance_use(SubstanceUse(tracking_id, amount_id, now - i * DAY_BUCKET))
+            AddictionRecovery.substance_tracking_ids[name] = tracking_id
+        self.tracking_ids = list(AddictionRecovery.substance_tracking_ids.values())
+        self.clock = FakeClock()
+        self.workers = FakeExecutor()
+        self.screen = GraphScreen(name="graph")
+        self.screen.clock = self.clock
+        self.screen.workers = self.workers
+        self.screen.tracking_id = self.tracking_ids[0]
+
+    def tearDown(self):
+        self.repository.close()
+        AddictionRecovery.substance_tracking_ids = {}
+
+    def show_first_graphs(self):
+        self.screen.update_graphs()
+        self.workers.finish()
+        # Shows the graphs, then starts prefetching the next substance's in the next frame
+        self.clock.advance(0)
+        self.assertEqual(self.tracking_ids[2:], self.screen.prefetch_queue)
+        self.assertEqual(3, len(self.workers.submitted))
+
+    def test_prefetch(self):
+        """ Tests that the other substances' graphs are calculated one at a time and then shown straight away. """
+        self.show_first_graphs()
+        for _ in self.tracking_ids[1:]:
+            self.workers.finish()
+            self.clock.advance(0)
+        self.assertEqual([], self.screen.prefetch_queue)
+        version = self.repository.get_data_version()
+        for tracking_id in self.tracking_ids:
+            self.assertIsNotNone(self.screen.get_calculated_graphs(tracking_id, "week", version))
+
+        self.screen.select_substance(self.tracking_ids[2])
+        self.assertEqual([], self.workers.submitted)
+
+        # Logging a use makes every graph out of date
+        self.repository.create_substance_use(SubstanceUse(self.tracking_ids[1], 1, int(time.time())))
+        version = self.repository.get_data_version()
+        self.assertIsNone(self.screen.get_calculated_graphs(self.tracking_ids[1], "week", version))
+        self.screen.select_substance(self.tracking_ids[1])
+        self.assertEqual(3, len(self.workers.submitted))
+
+    def test_leave_cancels_prefetch(self):
+        """ Tests that leaving the screen drops the queued substances and cancels the calculations. """
+        self.show_first_graphs()
+        futures = [future for future, _, _ in self.workers.submitted]
+        self.screen.on_leave()
+        self.assertEqual([], self.screen.prefetch_queue)
+        self.assertTrue(all(future.cancelled() for future in futures))
+        self.workers.finish()
+        self.clock.advance(0)
+        self.assertEqual({}, self.screen.calculated_graphs)
+        self.assertEqual([], self.clock.events)
+
+        # Leaving before the selected substance's graphs are shown doesn't start prefetching afterwards
+        self.screen.update_graphs()
+        self.screen.on_leave()
+        self.workers.finish()
+        self.clock.advance(0)
+        self.assertEqual([], self.screen.prefetch_queue)
+        self.assertEqual([], self.workers.submitted)
+        self.assertEqual({}, self.screen.calculated_graphs)
+
+    def test_late_results_ignored(self):
+        """ Tests that calculations that had started when the prefetching was cancelled are ignored. """
+        self.show_first_graphs()
+        self.workers.start()
+        self.screen.on_leave()
+        self.workers.finish()
+        self.clock.advance(0)
+        self.assertEqual({}, self.screen.calculated_graphs)
+        self.assertEqual([], self.screen.prefetch_queue)
+        self.assertEqual([], self.workers.submitted)
+
+
+class TestInstrumentation(unittest.TestCase):
+
+    def tearDown(self):
+        instrumentation.disable()
+        instrumentation.reset()
+
+    def test_repository_stats(self):
+        """ Tests that repository calls are only recorded while instrumentation is enabled. """
+        with instrumentation.instrument_repository(MemoryRepository()) as r:
+            amount_id = r.get_or_create_amount(SubstanceAmount(1, 1, "name"), 1)
+            r.create_substance_use(SubstanceUse(1, amount_id, 10))
+            self.assertEqual({}, instrumentation.get_stats())
+
+            instrumentation.enable()
+            r.get_uses_from_time_period(0, 100, 1)
+            r.get_uses_from_time_period(0, 5, 1)
+            stats = instrumentation.get_stats()["MemoryRepository.get_uses_from_time_period"]
+            self.assertEqual(2, stats.calls)
+            self.assertEqual(1, stats.rows)
+            self.assertEqual(1, stats.max_rows)
+            self.assertEqual(2, sum(stats.histogram))
+
+    def test_only_interface_timed(self):
+        """ Tests that only the methods of the Repository interface are timed, not the helpers they call. """
+        with instrumentation.instrument_repository(SqlRepository(":memory:")) as r:
+            instrumentation.enable()
+            r.get_substance_amount(1)
+            self.assertEqual(["SqlRepository.get_substance_amount"], list(instrumentation.get_stats()))
+            self.assertFalse(hasattr(r.try_execute_query, "__wrapped__"))
+
+    def test_query_tracer(self):
+        """ Tests that queries are traced and that slow queries have their query plan recorded. """
+        tracer = instrumentation.QueryTracer(slow_threshold=0)
+        with SqlRepository(":memory:", tracer) as r:
+            output = io.StringIO()
+            sys.stdout = output
+            r.get_substance_amount(5)
+            r.get_substance_amount(6)
+            sys.stdout = sys.__stdout__
+            self.assertIn("Slow query", output.getvalue())
+
+        sql = "SELECT * FROM SubstanceAmount WHERE id = ?"
+        self.assertEqual(2, tracer.stats[sql].calls)
+        self.assertEqual(("int",), tracer.slow[-1].parameters)
+        self.assertTrue(any("SubstanceAmount" in detail for detail in tracer.plans[sql]))
+        self.assertEqual("SELECT * FROM t WHERE a = ? AND b = ?", instrumentation.normalise_sql(
+            "SELECT *\n  FROM t WHERE a = 'x' AND b = 10"
+        ))
+
+    def test_dump_stats(self):
+        instrumentation.enable()
+        instrumentation.timed("test")(lambda: [1, 2, 3])()
+        with tempfile.TemporaryDirectory() as directory:
+            filepath = os.path.join(directory, "stats.json")
+            instrumentation.dump_stats(filepath)
+            with open(filepath) as file:
+                self.assertEqual(3, json.load(file)["test"]["rows"])
+
+    def test_app_dumps_query_trace(self):
+        """ Tests that the app writes the traced queries when it stops, even if the stats aren't timed. """
+        with tempfile.TemporaryDirectory() as directory:
+            database = os.path.join(directory, "database.db")
+            os.environ["ADDICTION_RECOVERY_SLOW_QUERY_MS"] = "1000"
+            try:
+                app = AddictionRecovery(database)
+            finally:
+                del os.environ["ADDICTION_RECOVERY_SLOW_QUERY_MS"]
+            Repository.instance.start()
+            Repository.instance.get_substance_amount(5)
+            app.on_stop()
+            self.assertIsNone(Repository.instance)
+            self.assertTrue(os.path.exists(f"{database}.queries.json"))
+
+
+class TestFrameProfiler(unittest.TestCase):
+
+    def tearDown(self):
+        instrumentation.disable()
+        instrumentation.reset()
+
+    def test_long_frame_attribution(self):
+        """ Tests that long frames are blamed on the slowest handler that ran during them. """
+        profiler = FrameProfiler(budget=0.016)
+        instrumentation.enable()
+        instrumentation.listeners.append(profiler.record_span)
+        try:
+            profiler.record_frame(0)
+            profiler.record_frame(0.010)
+            profiler.record_span("GraphScreen.update_graphs", 0.011, 0.050)
+            profiler.record_span("SubstanceGraph.update_graph", 0.012, 0.030)
+            profiler.record_frame(0.060)
+            instrumentation.timed("MenuScreen.update_page")(lambda: None)()
+            profiler.record_frame(0.070)
+        finally:
+            instrumentation.listeners.remove(profiler.record_span)
+
+        self.assertEqual(3, len(profiler.frames))
+        self.assertEqual(1, len(profiler.long_frames))
+        self.assertEqual("GraphScreen.update_graphs", profiler.long_frames[0].culprit())
+        # A handler is blamed for its own time, not the time of the handlers it called
+        frame = Frame(0, 0.050, [
+            ("SubstanceGraph.update_graph", 0.002, 0.030),
+            ("GraphScreen.update_graphs", 0.001, 0.045),
+            ("GraphScreen.on_pre_enter", 0, 0.046)
+        ])
+        self.assertEqual("SubstanceGraph.update_graph", frame.culprit())
+        self.assertEqual("MenuScreen.update_page", profiler.frames[-1].spans[0][0])
+
+        with tempfile.TemporaryDirectory() as directory:
+            filepath = os.path.join(directory, "trace.json")
+            profiler.export_trace(filepath)
+            with open(filepath) as file:
+                events = json.load(file)["traceEvents"]
+            self.assertEqual(1, len([event for event in events if event["name"] == "long frame"]))
+            self.assertEqual(3, len([event for event in events if event["tid"] == 1]))
+
+
+class TestImageIndex(unittest.TestCase):
+
+    def create_image(self, directory, filename):
+        # Minimal PNG header with a 3x2 image
+        with open(os.path.join(directory, filename), "wb") as file:
+            file.write(b"\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x00\x03\x00\x00\x00\x02")
+
+    def test_index_and_manifest(self):
+        """ Tests that images are indexed with their sizes and that the manifest is reused. """
+        with tempfile.TemporaryDirectory() as root:
+            os.mkdir(os.path.join(root, "Coffee"))
+            os.mkdir(os.path.join(root, "Alcohol"))
+            for i in range(10):
+                self.create_image(os.path.join(root, "Coffee"), f"{i}.png")
+
+            index = ImageIndex(root)
+            self.assertTrue(index.load())
+            self.assertEqual(10, len(index.get_images("Coffee")))
+            self.assertEqual((3, 2), (index.get_images("Coffee")[0].width, index.get_images("Coffee")[0].height))
+            self.assertIsNone(index.random_image("Alcohol"))
+            self.assertTrue(index.random_image("Coffee").startswith(f"{root}/Coffee/"))
+
+            # Nothing has changed so the manifest doesn't need to be rewritten
+            self.assertFalse(ImageIndex(root).load())
+
+    def test_incremental_refresh(self):
+        """ Tests that adding and removing images updates the index. """
+        with tempfile.TemporaryDirectory() as root:
+            directory = os.path.join(root, "Nicotine")
+            os.mkdir(directory)
+            self.create_image(directory, "1.png")
+            index = ImageIndex(root)
+            index.load()
+
+            self.create_image(directory, "2.png")
+            os.utime(directory, (0, 0))
+            self.assertTrue(index.refresh())
+            self.assertEqual(["1.png", "2.png"], [image.filename for image in index.get_images("Nicotine")])
+
+            os.remove(os.path.join(directory, "1.png"))
+            os.utime(directory, (1, 1))
+            self.assertTrue(index.refresh())
+            self.assertEqual(["2.png"], [image.filename for image in index.get_images("Nicotine")])
 
 
 class TestProfileScreen(GraphicUnitTest):
 
     def test_submit(self):
-        app = AddictionRecovery(database_filepath=":memory:")
+        app = AddictionRecovery(repository=MemoryRepository())
         Repository.instance.reset()
 
         def test(*args):
@@ -263,7 +1311,7 @@ class TestProfileScreen(GraphicUnitTest):
         app.run()
 
     def test_stays_on_profile(self):
-        app = AddictionRecovery(database_filepath=":memory:")
+        app = AddictionRecovery(repository=MemoryRepository())
         Repository.instance.reset()
 
         def test(*args):
@@ -291,7 +1339,7 @@ class TestProfileScreen(GraphicUnitTest):
         app.run()
 
     def test_invalid_weight(self):
-        app = AddictionRecovery(database_filepath=":memory:")
+        app = AddictionRecovery(repository=MemoryRepository())
         Repository.instance.reset()
 
         def test(*args):
@@ -327,7 +1375,7 @@ class TestProfileScreen(GraphicUnitTest):
         app.run()
 
     def test_invalid_height(self):
-        app = AddictionRecovery(database_filepath=":memory:")
+        app = AddictionRecovery(repository=MemoryRepository())
         Repository.instance.reset()
 
         def test(*args):
@@ -355,7 +1403,7 @@ class TestProfileScreen(GraphicUnitTest):
         app.run()
 
     def test_invalid_birth(self):
-        app = AddictionRecovery(database_filepath=":memory:")
+        app = AddictionRecovery(repository=MemoryRepository())
         Repository.instance.reset()
 
         def test(*args):
@@ -383,7 +1431,7 @@ class TestProfileScreen(GraphicUnitTest):
         app.run()
 
     def test_invalid_goal(self):
-        app = AddictionRecovery(database_filepath=":memory:")
+        app = AddictionRecovery(repository=MemoryRepository())
         Repository.instance.reset()
 
         def test(*args):
@@ -424,7 +1472,7 @@ class TestLoggingScreen(GraphicUnitTest):
         profile.Submit()
 
     def test_submit(self):
-        app = AddictionRecovery(database_filepath=":memory:")
+        app = AddictionRecovery(repository=MemoryRepository())
         Repository.instance.reset()
 
         def test(*args):
@@ -463,7 +1511,7 @@ class TestLoggingScreen(GraphicUnitTest):
         app.run()
 
     def test_presets(self):
-        app = AddictionRecovery(database_filepath=":memory:")
+        app = AddictionRecovery(repository=MemoryRepository())
         Repository.instance.reset()
 
         def test(*args):
@@ -491,7 +1539,7 @@ class TestLoggingScreen(GraphicUnitTest):
         app.run()
 
     def test_preset_submit(self):
-        app = AddictionRecovery(database_filepath=":memory:")
+        app = AddictionRecovery(repository=MemoryRepository())
         Repository.instance.reset()
 
         def test(*args):
@@ -536,8 +1584,45 @@ class TestLoggingScreen(GraphicUnitTest):
         Clock.schedule_once(test, 0)
         app.run()
 
+    def test_presets_reuse_buttons(self):
+        app = AddictionRecovery(repository=MemoryRepository())
+        Repository.instance.reset()
+
+        def test(*args):
+            self.create_profile(app)
+            logging = app.screens.get("logging")
+            presets = next(widget for widget in logging.walk() if isinstance(widget, SubstancePresets))
+
+            logging.substance.text = "Coffee"
+            logging.amount.text = "10"
+            logging.cost.text = "2.50"
+            logging.specific_name.text = "small"
+            logging.Submit()
+            buttons = [child for child in presets.children if isinstance(child, PresetButton)]
+            self.assertEqual(1, len(buttons))
+
+            # Logging another use should update the existing button rather than creating a new one
+            logging.substance.text = "Coffee"
+            logging.amount.text = "20"
+            logging.cost.text = "3.00"
+            logging.specific_name.text = "large"
+            logging.Submit()
+            logging.substance.text = "Coffee"
+            logging.amount.text = "20"
+            logging.cost.text = "3.00"
+            logging.specific_name.text = "large"
+            logging.Submit()
+            self.assertIs(buttons[0], presets.preset_buttons[0])
+            self.assertEqual("large", presets.preset_buttons[0].preset.name)
+            self.assertEqual(2, len([child for child in presets.children if isinstance(child, PresetButton)]))
+
+            app.stop()
+
+        Clock.schedule_once(test, 0)
+        app.run()
+
     def test_invalid_substance(self):
-        app = AddictionRecovery(database_filepath=":memory:")
+        app = AddictionRecovery(repository=MemoryRepository())
         Repository.instance.reset()
 
         def test(*args):
@@ -569,7 +1654,7 @@ class TestLoggingScreen(GraphicUnitTest):
         app.run()
 
     def test_invalid_amount(self):
-        app = AddictionRecovery(database_filepath=":memory:")
+        app = AddictionRecovery(repository=MemoryRepository())
         Repository.instance.reset()
 
         def test(*args):
@@ -595,7 +1680,7 @@ class TestLoggingScreen(GraphicUnitTest):
         app.run()
 
     def test_invalid_cost(self):
-        app = AddictionRecovery(database_filepath=":memory:")
+        app = AddictionRecovery(repository=MemoryRepository())
         Repository.instance.reset()
 
         def test(*args):